@@ -0,0 +1,114 @@
+#!/usr/bin/env python2
+
+"""
+run a strategy with many combinations of parameters over a journal
+recorded with bfxtool.py --record, on all cores, and print the results
+"""
+
+# pylint: disable=C0301
+
+import argparse
+import ast
+import itertools
+import multiprocessing
+import time
+import traceback
+
+import journal
+from bfxtool import StrategyManager
+
+
+def parse_value(text):
+    """a parameter value, a python literal or else a string"""
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parameter_grid(specs):
+    """all combinations of the parameters, specs is a list of strings
+    like "name=1,2,3", returns a list of dicts name: value"""
+    names = []
+    values = []
+    for spec in specs:
+        (name, _, text) = spec.partition("=")
+        names.append(name.strip())
+        values.append([parse_value(value.strip()) for value in text.split(",")])
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def run_backtest(job):
+    """run one backtest (in a worker process), job is a tuple (journal
+    filename, ini filename, strategy name, parameters). The strategy is
+    loaded the same way bfxtool loads it and every parameter is set as
+    an attribute of the Strategy object before the replay starts.
+    Returns (parameters, stats) or (parameters, traceback string)."""
+    (filename, ini, strategy, params) = job
+    try:
+        with journal.Replay(filename, journal.ReplayConfig(ini),
+                client_class=journal.BacktestClient) as replay:
+            strategy_manager = StrategyManager(replay.bfx, [strategy])
+            if not strategy_manager.strategy_object_list:
+                raise ImportError("could not load strategy %s" % strategy)
+            for strategy_object in strategy_manager.strategy_object_list:
+                for (name, value) in params.items():
+                    setattr(strategy_object, name, value)
+            started = time.time()
+            replay.run()
+            stats = replay.bfx.client.stats()
+            stats["seconds"] = time.time() - started
+            strategy_manager.unload()
+        return (params, stats)
+    except Exception:
+        return (params, traceback.format_exc())
+
+
+def print_results(results):
+    """print the successful results as a table, best pnl first, and
+    the errors after that"""
+    good = sorted([r for r in results if isinstance(r[1], dict)],
+        key=lambda r: r[1]["pnl"], reverse=True)
+    print "%12s %7s %6s %7s %12s %12s %10s %7s  %s" % (
+        "pnl", "orders", "fills", "cancels", "bought", "sold", "fees", "sec", "parameters")
+    for (params, stats) in good:
+        print "%12.4f %7d %6d %7d %12.6f %12.6f %10.4f %7.2f  %s" % (
+            stats["pnl"], stats["orders"], stats["fills"], stats["cancels"],
+            stats["bought"], stats["sold"], stats["fees"], stats["seconds"],
+            " ".join("%s=%r" % item for item in sorted(params.items())))
+    for (params, error) in results:
+        if not isinstance(error, dict):
+            print "\n*** %s failed:\n%s" % (params, error)
+
+
+def main():
+    """main funtion, called at the start of the program"""
+    argp = argparse.ArgumentParser(description='parallel backtest parameter sweep over recorded market data')
+    argp.add_argument('journal',
+        help="journal file that has been recorded with bfxtool.py --record")
+    argp.add_argument('--strategy', action="store", default="strategy.py",
+        help="name of the strategy module file, default=strategy.py")
+    argp.add_argument('--param', action="append", default=[],
+        help="name=value1,value2,... set this attribute of the strategy to each of the values, "
+            +"can be given more than once, all combinations will be run")
+    argp.add_argument('--processes', action="store", type=int, default=None,
+        help="number of worker processes, default is the number of cores")
+    argp.add_argument('--ini', action="store", default="bfxtool.ini",
+        help="ini file for pair, timeframe and the [backtest] balances and fee, "
+            +"it will not be changed, default=bfxtool.ini")
+    args = argp.parse_args()
+
+    jobs = [(args.journal, args.ini, args.strategy, params)
+        for params in parameter_grid(args.param)]
+    started = time.time()
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        results = list(pool.imap_unordered(run_backtest, jobs))
+    finally:
+        pool.close()
+        pool.join()
+    print_results(results)
+    print "\n%d backtests in %.2f seconds" % (len(jobs), time.time() - started)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+#!/usr/bin/env python2
+
+"""
+micro-benchmarks for the performance sensitive parts of bfxtool
+"""
+
+# pylint: disable=C0301
+
+import argparse
+import base64
+import curses
+import hashlib
+import hmac
+import json
+import os
+import platform
+import random
+import time
+import timeit
+
+import bfxapi
+import bfxtool
+import journal
+import websocket
+
+MASK_PAYLOAD_SIZES = [8, 125, 1024, 16384, 262144]
+
+# the channel ids of the synthetic market data
+CHAN_TRADES = 5
+CHAN_BOOK = 6
+CHAN_TICKER = 7
+
+# how often each kind of message occurs in the synthetic feed
+MESSAGE_MIX = [("book", 70), ("trade", 15), ("ticker", 5), ("heartbeat", 10)]
+
+
+def timed(func, min_time):
+    """seconds per call of func, called often enough to run min_time"""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time:
+            return elapsed / number
+        number *= 2
+
+
+def mask_engines():
+    """return list of (name, func) of all masking engines available here"""
+    engines = [("python", websocket.mask_python),
+               ("words", websocket.mask_words)]
+    if websocket.numpy is not None:
+        engines.append(("numpy", websocket.mask_numpy))
+    return engines
+
+
+def bench_mask(sizes=None, min_time=0.2):
+    """compare the websocket masking engines across payload sizes. Returns
+    a list of (engine, size, seconds per call) tuples. All engines are
+    checked against the pure python implementation before they are timed."""
+    results = []
+    mask_key = os.urandom(4)
+    for size in sizes or MASK_PAYLOAD_SIZES:
+        data = os.urandom(size)
+        expected = websocket.mask_python(mask_key, data)
+        for name, func in mask_engines():
+            if func(mask_key, data) != expected:
+                raise AssertionError("mask engine %s is broken" % name)
+            results.append((name, size,
+                timed(lambda: func(mask_key, data), min_time)))
+    return results
+
+
+def print_mask(results):
+    """print the result of bench_mask() as a table"""
+    print "%-8s %10s %14s %12s" % ("engine", "bytes", "usec/call", "MB/s")
+    for name, size, seconds in results:
+        print "%-8s %10d %14.2f %12.1f" % (
+            name, size, seconds * 1e6, size / seconds / 1e6)
+
+
+def bench_sign(min_time=0.2):
+    """compare signing a typical order/new call the old way (hmac.new()
+    and json.dumps() for every call) with bfxapi.Signer. Returns a list
+    of (method, seconds per signature) tuples."""
+    key = "k" * 43
+    secret = base64.b64encode(os.urandom(32))
+    params = {
+        "request": "/v1/order/new",
+        "nonce": "1476000000000000",
+        "symbol": "BTCUSD",
+        "amount": "0.010000",
+        "price": "600.000000",
+        "exchange": "bitfinex",
+        "side": "buy",
+        "type": "exchange limit"
+    }
+    signer = bfxapi.Signer(key, secret)
+
+    def sign_hmac_new():
+        """the way it was done before there was a Signer"""
+        payload = base64.b64encode(json.dumps(params, ensure_ascii=False))
+        return (payload, hmac.new(secret, payload, hashlib.sha384).hexdigest())
+
+    (payload, headers) = signer.sign_params(params)
+    if (payload, headers["X-BFX-SIGNATURE"]) != sign_hmac_new():
+        raise AssertionError("Signer produces a different signature")
+
+    return [
+        ("hmac.new", timed(sign_hmac_new, min_time)),
+        ("signer", timed(lambda: signer.sign_params(params), min_time)),
+    ]
+
+
+def print_sign(results):
+    """print the result of bench_sign() as a table"""
+    print "%-10s %14s %14s" % ("method", "usec/call", "signatures/s")
+    for name, seconds in results:
+        print "%-10s %14.2f %14.0f" % (name, seconds * 1e6, 1 / seconds)
+
+
+class MarketData(object):
+    """generates synthetic but realistic market data messages like the
+    v1 websocket api sends them: a mid price doing a random walk, book
+    updates near the top of the book (some of them removing a level),
+    trades around the mid price, tickers and heartbeats. The same seed
+    always produces the same messages."""
+
+    def __init__(self, seed=0, price=600.0, tick=0.01):
+        self.random = random.Random(seed)
+        self.price = price
+        self.tick = tick
+        self.time = 1476000000
+        self.seq = 0
+        self.kinds = []
+        for (kind, weight) in MESSAGE_MIX:
+            self.kinds += [kind] * weight
+
+    def subscribed(self):
+        """the subscribe answers for the channels"""
+        return [json.dumps({"event": "subscribed", "channel": channel,
+            "chanId": chan_id, "pair": "BTCUSD"}) for (channel, chan_id) in
+            [("trades", CHAN_TRADES), ("book", CHAN_BOOK), ("ticker", CHAN_TICKER)]]
+
+    def fulldepth(self, levels=250):
+        """a full depth download around the current price"""
+        def side(sign):
+            """levels of one side of the book"""
+            return [{"price": "%.2f" % (self.price + sign * (i + 1) * self.tick),
+                "amount": "%.8f" % self.random.uniform(0.01, 5),
+                "timestamp": "%d" % self.time} for i in range(levels)]
+        return {"bids": side(-1), "asks": side(1)}
+
+    def history(self, count=5000):
+        """a trade history download, oldest first"""
+        return [{"tid": i, "timestamp": self.time - (count - i) * 5,
+            "price": self.price + self.random.uniform(-2, 2),
+            "amount": self.random.uniform(0.01, 2)} for i in range(count)]
+
+    def book(self):
+        """a book update (count 0 removes the level)"""
+        sign = self.random.choice((-1, 1))
+        price = round(self.price + sign * self.random.randint(1, 50) * self.tick, 2)
+        count = self.random.choice((0, 1, 1, 2, 3))
+        amount = sign * -1 * (self.random.uniform(0.01, 5) if count else 1)
+        return [CHAN_BOOK, price, count, round(amount, 8)]
+
+    def trade(self):
+        """a trade update, it also moves the price"""
+        self.price = round(self.price + self.random.choice((-1, 1)) * self.tick * 5, 2)
+        self.time += self.random.randint(0, 3)
+        self.seq += 1
+        return [CHAN_TRADES, "%d-BTCUSD" % self.seq, self.time, self.price,
+            round(self.random.choice((-1, 1)) * self.random.uniform(0.001, 3), 8)]
+
+    def ticker(self):
+        """a ticker update"""
+        return [CHAN_TICKER, self.price - self.tick, 12.5, self.price + self.tick,
+            8.3, -2.1, -0.0035, self.price, 9250.85, self.price + 9, self.price - 9]
+
+    def heartbeat(self):
+        """a heartbeat of some channel"""
+        return [self.random.choice((CHAN_TRADES, CHAN_BOOK, CHAN_TICKER)), "hb"]
+
+    def messages(self, count):
+        """count messages of the mix as json strings"""
+        return [json.dumps(getattr(self, self.random.choice(self.kinds))())
+            for _ in range(count)]
+
+
+class FakeSocket(object):
+    """a socket that delivers a prepared byte string with recv_into(),
+    in pieces of at most chunk bytes like a TLS socket would"""
+
+    def __init__(self, data, chunk=16384):
+        self.data = data
+        self.pos = 0
+        self.chunk = chunk
+
+    def recv_into(self, view):
+        """copy the next piece into view"""
+        count = min(len(view), self.chunk, len(self.data) - self.pos)
+        view[:count] = self.data[self.pos:self.pos + count]
+        self.pos += count
+        return count
+
+
+class FakeWindow(object):
+    """stands in for a curses window, it keeps track of the cursor
+    position but draws nothing, so the paint() methods of the bfxtool
+    windows can be measured without a terminal"""
+
+    def __init__(self):
+        self.posy = 0
+        self.posx = 0
+
+    def getyx(self):
+        """the cursor position"""
+        return (self.posy, self.posx)
+
+    def addstr(self, *args):
+        """move the cursor behind the string"""
+        if len(args) > 2:
+            (self.posy, self.posx) = args[:2]
+            self.posx += len(args[2])
+        else:
+            self.posx += len(args[0])
+
+    def _ignore(self, *_args):
+        """draw nothing"""
+        pass
+
+    addch = bkgd = erase = hline = vline = move = border = _ignore
+
+
+def fake_window(win, bfx, termheight=50, termwidth=160):
+    """set up a bfxtool window object (created without calling its
+    __init__, that would need curses) to paint a snapshot of bfx into
+    a FakeWindow"""
+    win.bfx = bfx
+    win.stdscr = None
+    win.panel = None
+    win.termheight = termheight
+    win.termwidth = termwidth
+    win.posx = win.posy = 0
+    win.width = termwidth
+    win.height = termheight
+    win.calc_size()
+    win.win = FakeWindow()
+    win.data = bfxtool.BfxSnapshot(bfx, win.width)
+    return win
+
+
+class BenchWinOrderBook(bfxtool.WinOrderBook):
+    """the orderbook window on a FakeWindow"""
+
+    # pylint: disable=W0231
+    def __init__(self, bfx):
+        fake_window(self, bfx)
+
+    def __del__(self):
+        pass
+
+
+class BenchWinChart(bfxtool.WinChart):
+    """the chart window on a FakeWindow"""
+
+    # pylint: disable=W0231
+    def __init__(self, bfx):
+        self.pmin = 0
+        self.pmax = 0
+        self.change_type = bfxtool.TYPE_HISTORY
+        self.body_char = " "
+        self.body_attr = curses.A_REVERSE
+        fake_window(self, bfx)
+
+    def __del__(self):
+        pass
+
+
+def latencies(func, args_list):
+    """call func(*args) for every args in args_list, return the list of
+    the seconds each call took"""
+    clock = timeit.default_timer
+    result = []
+    for args in args_list:
+        start = clock()
+        func(*args)
+        result.append(clock() - start)
+    return result
+
+
+def summarize(stage, seconds):
+    """messages per second and latency percentiles (microseconds) of
+    the per message times of a stage"""
+    ordered = sorted(seconds)
+    def percentile(pct):
+        """the latency that pct percent of the messages did not exceed"""
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))] * 1e6
+    total = sum(ordered)
+    return {
+        "stage": stage,
+        "messages": len(ordered),
+        "msgs_per_sec": len(ordered) / total if total else 0,
+        "p50_us": percentile(50),
+        "p90_us": percentile(90),
+        "p99_us": percentile(99),
+        "p999_us": percentile(99.9),
+        "max_us": ordered[-1] * 1e6,
+    }
+
+
+def make_bfx(data):
+    """a Bfx on a ReplayClient (no connections) with the subscriptions,
+    the full depth and the history of data already processed. Its timers
+    run on a SimulatedClock that never moves, so they never fire"""
+    bfxapi.CLOCK = bfxapi.SimulatedClock(data.time)
+    config = journal.ReplayConfig(os.devnull)
+    config.init_defaults(bfxtool.INI_DEFAULTS)
+    config.set("bfx", "history_store", "False")
+    config.set("bfxtool", "set_xterm_title", "False")
+    bfx = bfxapi.Bfx(bfxapi.Secret(config), config, journal.ReplayClient)
+    for msg in data.subscribed():
+        bfx.slot_recv(bfx.client, (msg))
+    bfx.orderbook.slot_fulldepth(bfx.client, (data.fulldepth()))
+    bfx.history.slot_fullhistory(bfx.client, (data.history()))
+    return bfx
+
+
+def bench_hotpath(count=20000, repaints=300, seed=0):
+    """measure each stage of the market data hot path separately with
+    the same synthetic messages. Returns a list of dicts, see summarize()"""
+    # curses only defines these after initscr(), the fake screen needs them
+    for name in ("ACS_CKBOARD", "ACS_HLINE", "ACS_VLINE"):
+        if not hasattr(curses, name):
+            setattr(curses, name, ord("#"))
+    bfxtool.COLOR_PAIR.update((color[0], 0) for color in bfxtool.COLORS)
+
+    data = MarketData(seed)
+    messages = data.messages(count)
+    results = []
+
+    # websocket frame parsing, the frames arrive in TLS record sized pieces
+    frames = "".join(websocket.ABNF(1, 0, 0, 0, websocket.ABNF.OPCODE_TEXT, 0,
+        msg).format() for msg in messages)
+    sock = websocket.WebSocket()
+    sock.io_sock = FakeSocket(frames)
+    results.append(summarize("websocket.recv_frame",
+        latencies(sock.recv_frame, [()] * count)))
+
+    # Bfx.slot_recv: json decoding and dispatch, with everything that
+    # is connected to it (order book, history) but no windows
+    bfx = make_bfx(data)
+    results.append(summarize("Bfx.slot_recv",
+        latencies(bfx.slot_recv, [(bfx.client, msg) for msg in messages])))
+
+    # the single stages behind it, fed with the same updates
+    decoded = [json.loads(msg) for msg in messages]
+    bfx = make_bfx(MarketData(seed))
+    updates = [({True: "bid", False: "ask"}[msg[3] > 0], float(msg[1]),
+        abs(float(msg[3])) if msg[2] else 0) for msg in decoded
+        if msg[0] == CHAN_BOOK and len(msg) == 4]
+    results.append(summarize("OrderBook._update_book",
+        latencies(bfx.orderbook._update_book, updates))) # pylint: disable=W0212
+    trades = [(bfx, (msg[2], msg[3], abs(msg[4]), "bid", False))
+        for msg in decoded if msg[0] == CHAN_TRADES and len(msg) == 5]
+    results.append(summarize("History.slot_trade",
+        latencies(bfx.history.slot_trade, trades)))
+
+    # copying the data for a repaint, bfx.lock is held only for this
+    results.append(summarize("BfxSnapshot",
+        latencies(bfxtool.BfxSnapshot, [(bfx, 160)] * repaints)))
+
+    # repainting the windows with the book and history from above
+    book_win = BenchWinOrderBook(bfx)
+    results.append(summarize("WinOrderBook.paint",
+        latencies(book_win.paint, [()] * repaints)))
+    chart_win = BenchWinChart(bfx)
+    results.append(summarize("WinChart.paint",
+        latencies(chart_win.paint, [()] * repaints)))
+    return results
+
+
+def print_hotpath(results):
+    """print the result of bench_hotpath() as a table"""
+    print "%-24s %8s %12s %9s %9s %9s %9s %9s" % ("stage", "msgs",
+        "msgs/s", "p50 us", "p90 us", "p99 us", "p99.9 us", "max us")
+    for res in results:
+        print "%-24s %8d %12.0f %9.2f %9.2f %9.2f %9.2f %9.2f" % (
+            res["stage"], res["messages"], res["msgs_per_sec"], res["p50_us"],
+            res["p90_us"], res["p99_us"], res["p999_us"], res["max_us"])
+
+
+def main():
+    """main funtion, called at the start of the program"""
+    argp = argparse.ArgumentParser(description='bfxtool micro-benchmarks')
+    argp.add_argument('--mask', action="store_true", default=False,
+        help="benchmark the websocket masking engines")
+    argp.add_argument('--sign', action="store_true", default=False,
+        help="benchmark signing of http api calls")
+    argp.add_argument('--hotpath', action="store_true", default=False,
+        help="benchmark the stages of the market data hot path")
+    argp.add_argument('--messages', action="store", type=int, default=20000,
+        help="number of synthetic messages for --hotpath, default=20000")
+    argp.add_argument('--json', action="store_true", default=False,
+        help="print the results as one json document instead of tables, "
+            +"for comparing runs before and after a change")
+    args = argp.parse_args()
+
+    run_all = not (args.mask or args.sign or args.hotpath)
+    results = {}
+    if args.mask or run_all:
+        results["mask"] = [{"engine": name, "bytes": size, "seconds": seconds}
+            for (name, size, seconds) in bench_mask()]
+    if args.sign or run_all:
+        results["sign"] = [{"method": name, "seconds": seconds}
+            for (name, seconds) in bench_sign()]
+    if args.hotpath or run_all:
+        results["hotpath"] = bench_hotpath(args.messages)
+
+    if args.json:
+        print json.dumps({
+            "time": time.time(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results
+        }, indent=1, sort_keys=True)
+        return
+    if "mask" in results:
+        print_mask([(r["engine"], r["bytes"], r["seconds"]) for r in results["mask"]])
+    if "sign" in results:
+        print_sign([(r["method"], r["seconds"]) for r in results["sign"]])
+    if "hotpath" in results:
+        print_hotpath(results["hotpath"])
+
+if __name__ == "__main__":
+    main()
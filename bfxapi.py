@@ -33,31 +33,44 @@ import base64
 import bisect
 import binascii
 import contextlib
+import errno
+import eventloop
 from Crypto.Cipher import AES
 import getpass
 import gzip
 import hashlib
+import heapq
 import hmac
+import httplib
 import inspect
+import functools
 import io
+import itertools
 import json
 import logging
+import mmap
+import os
 import Queue
+import select
+import socket
+import ssl
+import struct
 import time
 import traceback
 import threading
 from urllib2 import Request as URLRequest
 from urllib2 import urlopen, HTTPError
 from urllib import urlencode
+from urlparse import urlsplit
 import weakref
+import zlib
 import websocket
 import math
-from datetime import datetime, timedelta
-import calendar
 
 input = raw_input  # pylint: disable=W0622,C0103
 
 FORCE_PROTOCOL = ""
+FORCE_ENGINE = ""
 
 #BitFinex provide depth information by orderbook:
 #http://docs.bitfinex.com/#order-books
@@ -80,6 +93,71 @@ HTTP_API_URLS_PREFIX = "api.bitfinex.com/v1"
 
 USER_AGENT = "bfxtool.py"
 
+# the v1 trades call only has a lower time bound and returns the newest
+# trades first, so a busy window can not be paged. The v2 call has both
+# bounds and can sort ascending, the history is downloaded with that.
+HISTORY_URL = "https://api.bitfinex.com/v2/trades/t%s/hist?start=%d&end=%d&limit=%d&sort=1"
+HISTORY_PAGE_LIMIT = 5000
+# seconds until a stalled page download fails, and how many error answers
+# in a row a window retries before it gives up until the next run()
+HISTORY_PAGE_TIMEOUT = 30
+HISTORY_PAGE_RETRIES = 3
+
+# priority lanes of the http api request queue, lower is more urgent.
+# A cancel must never wait behind bookkeeping calls like balances.
+HTTP_PRIORITY_CANCEL = 0
+HTTP_PRIORITY_ORDER = 1
+HTTP_PRIORITY_QUERY = 2
+
+HTTP_PRIORITIES = {
+    "order/cancel": HTTP_PRIORITY_CANCEL,
+    "order/cancel/multi": HTTP_PRIORITY_CANCEL,
+    "order/cancel/all": HTTP_PRIORITY_CANCEL,
+    "order/cancel/replace": HTTP_PRIORITY_CANCEL,
+    "order/new": HTTP_PRIORITY_ORDER,
+    "order/new/multi": HTTP_PRIORITY_ORDER,
+}
+
+# the maximum number of orders the server accepts in one order/new/multi
+ORDER_MULTI_MAX = 10
+
+# seconds after which a cancel that has not been acked is forgotten,
+# the order can then be canceled again
+CANCEL_PENDING_TIMEOUT = 30
+
+# client side rate limits, one budget per priority lane. The numbers
+# are requests per minute and are taken from the ini options named here
+RATE_LIMITS = [
+    (HTTP_PRIORITY_CANCEL, "cancels", "rate_limit_cancels"),
+    (HTTP_PRIORITY_ORDER, "orders", "rate_limit_orders"),
+    (HTTP_PRIORITY_QUERY, "account", "rate_limit_account"),
+]
+
+# seconds between the checks whether the rate limit budget has changed,
+# it is reported by a client timer and never on the way of a request
+RATE_REPORT_INTERVAL = 1
+
+# read-only calls, if one of these is requested again while an identical
+# one is still waiting in the queue both requests are merged into one
+HTTP_IDEMPOTENT = set(["account_infos", "balances", "orders"])
+
+# calls that place orders, when one of them fails after it might have
+# reached the server it is never sent again, it could have been placed
+HTTP_NO_RESEND = set(["order/new", "order/new/multi", "order/cancel/replace"])
+
+# how often a signed call is signed and sent again when the server rejects
+# its nonce. Several http workers send concurrently on separate connections
+# so a call can arrive after one with a larger nonce. It has not been
+# processed then, this is safe even for the calls in HTTP_NO_RESEND.
+HTTP_NONCE_RETRIES = 3
+
+
+def _nonce_rejected(answer):
+    """has the http api rejected a signed call because its nonce was
+    not larger than that of a call it has processed before?"""
+    return isinstance(answer, dict) \
+        and "nonce" in ("%s" % answer.get("message", "")).lower()
+
 
 def http_request(url, post=None, headers=None):
     """request data from the HTTP API, returns the response a string. If a
@@ -94,9 +172,7 @@ def http_request(url, post=None, headers=None):
         """read data from the response object,
         unzip if necessary, return text string"""
         if response.info().get('Content-Encoding') == 'gzip':
-            with io.BytesIO(response.read()) as buf:
-                with gzip.GzipFile(fileobj=buf) as unzipped:
-                    data = unzipped.read()
+            data = _gunzip(response.read())
         else:
             data = response.read()
         return data
@@ -115,6 +191,405 @@ def http_request(url, post=None, headers=None):
 
     return data
 
+def http_stream(url, headers=None, blocksize=65536, timeout=None):
+    """request data from the HTTP API and yield the response body in
+    blocks as they arrive instead of returning it as one string. Gzipped
+    responses are unzipped on the fly. Like http_request() it will *not*
+    raise an exception on http errors, it will yield the error document.
+    If timeout is given connecting and every read will time out after
+    that many seconds."""
+    if not headers:
+        headers = {}
+    request = URLRequest(url, None, headers)
+    request.add_header('Accept-encoding', 'gzip')
+    request.add_header('User-Agent', USER_AGENT)
+    try:
+        if timeout is None:
+            response = urlopen(request)
+        else:
+            response = urlopen(request, timeout=timeout)
+    except HTTPError as err:
+        response = err
+    with contextlib.closing(response):
+        unzip = None
+        if response.info().get('Content-Encoding') == 'gzip':
+            unzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            block = response.read(blocksize)
+            if not block:
+                break
+            if unzip:
+                block = unzip.decompress(block)
+            if block:
+                yield block
+        if unzip:
+            block = unzip.flush()
+            if block:
+                yield block
+
+class JSONArrayStream(object):
+    """incremental decoder for a JSON array of objects or arrays. feed()
+    it the text in pieces of any size, it returns the elements that are
+    complete so far. Each element is decoded by the C scanner of the json
+    module, only the element at the end of the buffer that is still
+    incomplete will be tried again on the next feed()."""
+
+    _WHITESPACE = " \t\n\r"
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._started = False
+        self.finished = False
+
+    def feed(self, data):
+        """add more text, return the list of newly completed elements"""
+        buf = self._buf + data
+        pos = 0
+        end = len(buf)
+        elements = []
+        while pos < end and not self.finished:
+            char = buf[pos]
+            if char in self._WHITESPACE:
+                pos += 1
+            elif not self._started:
+                if char != "[":
+                    raise ValueError("not a JSON array: %r" % buf[pos:pos + 40])
+                self._started = True
+                pos += 1
+            elif char == ",":
+                pos += 1
+            elif char == "]":
+                self.finished = True
+                pos += 1
+            else:
+                try:
+                    (element, pos) = self._decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # incomplete, wait for the rest of it
+                    break
+                elements.append(element)
+        self._buf = buf[pos:]
+        return elements
+
+def _gunzip(data):
+    """unzip gzipped data, return text string"""
+    with io.BytesIO(data) as buf:
+        with gzip.GzipFile(fileobj=buf) as unzipped:
+            return unzipped.read()
+
+class StaleConnectionError(Exception):
+    """a reused keep-alive connection had been closed by the server before
+    it answered anything. The server has most probably not processed the
+    request but that is not guaranteed."""
+    pass
+
+def _connection_closed(exc):
+    """True if exc means the peer had closed the connection, this is
+    not the case for timeouts or any other errors"""
+    if isinstance(exc, socket.timeout):
+        return False
+    if isinstance(exc, httplib.BadStatusLine):
+        return True
+    return isinstance(exc, socket.error) and exc.errno in (
+        errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+class PendingResponse(object):
+    """a request that has been sent over a pooled connection
+    but whose response has not yet been read"""
+
+    def __init__(self, pool, host, conn, reused):
+        self._pool = pool
+        self._host = host
+        self._conn = conn
+        self._reused = reused
+
+    def read(self):
+        """wait for the response and return it as a string, the
+        connection goes back into the pool when this is done. Only
+        if a reused connection is closed before any byte of the answer
+        arrives StaleConnectionError is raised, a timeout is not."""
+        try:
+            response = self._conn.getresponse()
+        except (httplib.HTTPException, socket.error) as exc:
+            self._conn.close()
+            if self._reused and _connection_closed(exc):
+                raise StaleConnectionError()
+            raise
+        try:
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            self._conn.close()
+            raise
+
+        if response.will_close:
+            self._conn.close()
+        else:
+            self._pool.checkin(self._host, self._conn)
+        if response.getheader("Content-Encoding") == "gzip":
+            data = _gunzip(data)
+        return data
+
+class HTTPRequestQueue(object):
+    """the queue of http api requests, it works like a Queue.PriorityQueue
+    but get() can be restricted to the most urgent priority lanes, so a
+    worker can be reserved for them. Requests of the same priority are
+    returned in the order they were put."""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+
+    def put(self, item, priority=HTTP_PRIORITY_QUERY):
+        """enqueue item in the lane priority"""
+        with self._cond:
+            heapq.heappush(self._heap, (priority, next(self._counter), item))
+            self._cond.notify_all()
+
+    def put_front(self, item, priority=HTTP_PRIORITY_QUERY):
+        """enqueue item in front of all other items of its lane"""
+        with self._cond:
+            heapq.heappush(self._heap, (priority, -next(self._counter), item))
+            self._cond.notify_all()
+
+    def get(self, block=True, max_priority=None):
+        """remove and return the most urgent item whose priority is not
+        greater than max_priority, raise Queue.Empty if there is none
+        and block is False"""
+        with self._cond:
+            while True:
+                if self._heap and (max_priority is None
+                        or self._heap[0][0] <= max_priority):
+                    return heapq.heappop(self._heap)[2]
+                if not block:
+                    raise Queue.Empty()
+                self._cond.wait()
+
+    def qsize(self):
+        """number of queued items in all lanes"""
+        with self._cond:
+            return len(self._heap)
+
+class NonceGenerator(object):
+    """produces the nonces for the signed api calls: unique, strictly
+    increasing and in microseconds since the epoch. A high-water mark
+    some time ahead of the last nonce is saved in a file, so after a
+    restart it will never hand out a nonce that has been used already,
+    not even if the clock went backwards. This is thread safe."""
+
+    RESERVE = 60 * 1000000 # microseconds to save the mark ahead
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._last = 0
+        self._saved = 0
+        if filename:
+            try:
+                with open(filename) as nonce_file:
+                    self._last = self._saved = int(nonce_file.read())
+            except (IOError, ValueError):
+                pass
+
+    def get(self):
+        """return the next nonce"""
+        return self.reserve(1)
+
+    def reserve(self, count):
+        """reserve a range of count consecutive nonces at once and return
+        the first one, the caller owns first ... first + count - 1"""
+        with self._lock:
+            first = max(int(time.time() * 1000000), self._last + 1)
+            self._last = first + count - 1
+            if self._last >= self._saved:
+                self._save(self._last + self.RESERVE)
+            return first
+
+    def _save(self, mark):
+        """save the high-water mark (atomically replace the file)"""
+        self._saved = mark
+        if not self.filename:
+            return
+        tmp = self.filename + ".tmp"
+        try:
+            with open(tmp, "w") as nonce_file:
+                nonce_file.write("%d\n" % mark)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError) as exc:
+            logging.warning("could not save nonce to %s: %s", self.filename, exc)
+
+class TokenBucket(object):
+    """token bucket rate limiter. It holds up to burst tokens and refills
+    at rate tokens per second, every request needs one token. This is
+    thread safe."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """add the tokens that have accumulated since the last refill"""
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def take(self):
+        """take one token and return 0 or, if there is none available,
+        take nothing and return the seconds until there will be one"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def drain(self):
+        """throw away all tokens (the server has told us to slow down)"""
+        with self._lock:
+            self._refill()
+            self._tokens = 0
+
+    def available(self):
+        """the number of tokens available right now"""
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+class HTTPConnectionPool(object):
+    """keep-alive HTTPS connections to the http API. Idle connections are
+    kept per host and reused for the next request to the same host, this
+    saves the TCP and TLS handshake on every signed call. An idle
+    connection is health checked before it is reused and evicted when
+    it has been idle for longer than idle_timeout seconds. This is thread
+    safe, each connection is only used by one thread at a time."""
+
+    def __init__(self, idle_timeout=30, timeout=30):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}     # host -> list of (connection, time last used)
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+
+    def request(self, url, post=None, headers=None):
+        """request data from the HTTP API, same semantics as http_request():
+        returns the response as a string, also for http error status"""
+        while True:
+            try:
+                return self.send(url, post, headers).read()
+            except StaleConnectionError:
+                continue
+
+    def send(self, url, post=None, headers=None):
+        """only send the request and return a PendingResponse without
+        waiting for the answer. Its read() raises StaleConnectionError
+        if the request went to an idle connection that the server had
+        already closed, the request must then be sent again (if that
+        is safe, see HTTP_NO_RESEND)."""
+        while True:
+            try:
+                return self.send_on(self.connect(url), url, post, headers)
+            except StaleConnectionError:
+                continue
+
+    def connect(self, url):
+        """return a connection to the host of url that is ready for
+        sending, a healthy idle one or else a new one that has already
+        made the TCP and TLS handshake, which can take a while. It is a
+        tuple (host, connection, reused) to be passed to send_on()"""
+        host = urlsplit(url).netloc
+        (conn, reused) = self._checkout(host)
+        if not reused:
+            try:
+                conn.connect()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                raise
+        return (host, conn, reused)
+
+    def send_on(self, lease, url, post=None, headers=None):
+        """send the request over a connection returned by connect() and
+        return a PendingResponse like send(). Raises StaleConnectionError
+        if the reused connection had already been closed, the request
+        has then not been sent and can be sent over another connection."""
+        (host, conn, reused) = lease
+        path = _url_path(url)
+        all_headers = {
+            "Accept-Encoding": "gzip",
+            "User-Agent": USER_AGENT,
+        }
+        if post is None:
+            method = "GET"
+        else:
+            method = "POST"
+            all_headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if headers:
+            all_headers.update(headers)
+
+        try:
+            conn.request(method, path, post, all_headers)
+        except (httplib.HTTPException, socket.error) as exc:
+            conn.close()
+            if reused and _connection_closed(exc):
+                raise StaleConnectionError()
+            raise
+        return PendingResponse(self, host, conn, reused)
+
+    def close(self):
+        """close all idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                for (conn, _) in idle:
+                    conn.close()
+            self._idle.clear()
+
+    def _checkout(self, host):
+        """return (connection, reused), a healthy idle connection
+        to host if there is one or else a new connection"""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(host, [])
+            while idle:
+                (conn, time_used) = idle.pop()
+                if now - time_used < self.idle_timeout and self._is_healthy(conn):
+                    return (conn, True)
+                conn.close()
+        conn = httplib.HTTPSConnection(host, timeout=self.timeout,
+            context=self._ssl_context)
+        return (conn, False)
+
+    def checkin(self, host, conn):
+        """put the connection back into the pool after a request"""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            # evict expired connections, the oldest are at the front
+            while idle and now - idle[0][1] >= self.idle_timeout:
+                idle.pop(0)[0].close()
+            idle.append((conn, now))
+
+    @staticmethod
+    def _is_healthy(conn):
+        """an idle connection is only usable if it is still open and has
+        nothing to read, readable means the server has closed it"""
+        if conn.sock is None:
+            return False
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+def _url_path(url):
+    """the path and query string part of url"""
+    parts = urlsplit(url)
+    if parts.query:
+        return "%s?%s" % (parts.path, parts.query)
+    return parts.path
+
 def start_thread(thread_func, name=None):
     """start a new thread to execute the supplied function"""
     thread = threading.Thread(None, thread_func)
@@ -152,6 +627,18 @@ class BfxConfig(SafeConfigParser):
                 ,["bfx", "load_fulldepth", "True"]
                 ,["bfx", "load_history", "True"]
                 ,["bfx", "history_timeframe", "15"]
+                ,["bfx", "history_download_threads", "4"]
+                ,["bfx", "history_store", "True"]
+                ,["bfx", "websocket_max_message_size", "33554432"]
+                ,["bfx", "websocket_deflate", "False"]
+                ,["bfx", "http_keepalive", "True"]
+                ,["bfx", "http_keepalive_timeout", "30"]
+                ,["bfx", "http_workers", "3"]
+                ,["bfx", "websocket_orders", "False"]
+                ,["bfx", "rate_limit_orders", "60"]
+                ,["bfx", "rate_limit_cancels", "60"]
+                ,["bfx", "rate_limit_account", "30"]
+                ,["bfx", "rate_limit_burst", "10"]
                 ,["bfx", "secret_key", ""]
                 ,["bfx", "secret_secret", ""]
                 ]
@@ -224,17 +711,29 @@ class Signal():
     """callback functions (so called slots) can be connected to a signal and
     will be called when the signal is called (Signal implements __call__).
     The slots receive two arguments: the sender of the signal and a custom
-    data object. Two different threads won't be allowed to send signals at the
-    same time application-wide, concurrent threads will have to wait until
-    the lock is releaesed again. The lock allows recursive reentry of the same
-    thread to avoid deadlocks when a slot wants to send a signal itself."""
+    data object. Every signal has a lock, two different threads won't be
+    allowed to send the same signal (or signals sharing the same lock) at the
+    same time, concurrent threads will have to wait until the lock is
+    released again. By default each signal has a lock of its own, objects
+    whose slots must never run concurrently pass one lock to all of their
+    signals (Bfx shares its lock with its client, orderbook and history,
+    it is also the default lock of a Timer).
+    The lock allows recursive reentry of the same thread to avoid deadlocks
+    when a slot wants to send a signal itself."""
 
-    _lock = threading.RLock()
     signal_error = None
 
-    def __init__(self):
-        self._functions = weakref.WeakSet()
-        self._methods = weakref.WeakKeyDictionary()
+    def __init__(self, lock=None):
+        if lock is None:
+            lock = threading.RLock()
+        self.lock = lock
+
+        # the connected slots as a tuple of (weakref, function) pairs, the
+        # function is None if the referenced object itself is the slot. The
+        # tuple is never modified, connect() replaces it with a new one, so
+        # it can be iterated while other threads are connecting new slots.
+        self._slots = ()
+        self._slots_lock = threading.Lock()
 
         # the Signal class itself has a static member signal_error where it
         # will send tracebacks of exceptions that might happen. Here we
@@ -249,56 +748,76 @@ class Signal():
         arguments, or it can even be even another signal. the first argument
         is a reference to the sender of the signal and the second argument is
         the payload. The payload can be anything, it totally depends on the
-        sender and type of the signal."""
+        sender and type of the signal. Only a weak reference to the slot (or
+        to the instance of the method) is kept."""
         if inspect.ismethod(slot):
-            instance = slot.__self__
-            function = slot.__func__
-            if instance not in self._methods:
-                self._methods[instance] = set()
-            if function not in self._methods[instance]:
-                self._methods[instance].add(function)
+            (instance, function) = (slot.__self__, slot.__func__)
         else:
-            if slot not in self._functions:
-                self._functions.add(slot)
+            (instance, function) = (slot, None)
+        with self._slots_lock:
+            for (ref, func) in self._slots:
+                if ref() is instance and func is function:
+                    return
+            self._slots += ((weakref.ref(instance), function),)
+
+    def _remove_dead_slots(self):
+        """forget the slots that have been garbage collected"""
+        with self._slots_lock:
+            self._slots = tuple((ref, func) for (ref, func) in self._slots
+                if ref() is not None)
 
     def __call__(self, sender, data, error_signal_on_error=True):
         """dispatch signal to all connected slots. This is a synchronuos
         operation, It will not return before all slots have been called.
-        Also only exactly one thread is allowed to emit signals at any time,
-        all other threads that try to emit *any* signal anywhere in the
-        application at the same time will be blocked until the lock is released
-        again. The lock will allow recursive reentry of the seme thread, this
-        means a slot can itself emit other signals before it returns (or
-        signals can be directly connected to other signals) without problems.
-        If a slot raises an exception a traceback will be sent to the static
-        Signal.signal_error() or to logging.critical()"""
-        with self._lock:
-            sent = False
-            errors = []
-            for func in self._functions:
+        Also only exactly one thread is allowed to emit this signal (or any
+        other signal sharing its lock) at any time, all other threads that
+        try to do the same will be blocked until the lock is released again,
+        signals with other locks can be emitted by other threads meanwhile.
+        The lock will allow recursive reentry of the seme thread, this means
+        a slot can itself emit other signals before it returns (or signals
+        can be directly connected to other signals) without problems. If a
+        slot raises an exception a traceback will be sent to the static
+        Signal.signal_error() or to logging.critical() after the lock has
+        been released again."""
+        sent = False
+        dead = False
+        errors = []
+        with self.lock:
+            for (ref, func) in self._slots:
+                instance = ref()
+                if instance is None:
+                    dead = True
+                    continue
                 try:
-                    func(sender, data)
+                    if func is None:
+                        instance(sender, data)
+                    else:
+                        func(instance, sender, data)
                     sent = True
 
                 except: # pylint: disable=W0702
                     errors.append(traceback.format_exc())
+            instance = None
 
-            for instance, functions in self._methods.items():
-                for func in functions:
-                    try:
-                        func(instance, sender, data)
-                        sent = True
+        if dead:
+            self._remove_dead_slots()
 
-                    except: # pylint: disable=W0702
-                        errors.append(traceback.format_exc())
+        for error in errors:
+            if error_signal_on_error:
+                Signal.signal_error(self, (error), False)
+            else:
+                logging.critical(error)
+
+        return sent
 
-            for error in errors:
-                if error_signal_on_error:
-                    Signal.signal_error(self, (error), False)
-                else:
-                    logging.critical(error)
 
-            return sent
+def replace_signal_lock(objects, old_lock, new_lock):
+    """make all signals (and timers) that are attributes of the objects and
+    use old_lock use new_lock instead"""
+    for obj in objects:
+        for value in vars(obj).values():
+            if isinstance(value, Signal) and value.lock is old_lock:
+                value.lock = new_lock
 
 
 class BaseObject():
@@ -317,12 +836,92 @@ class BaseObject():
             logging.debug(msg)
 
 
+class RealClock(object):
+    """the wall clock, timers run in threads of their own"""
+
+    # pylint: disable=R0201
+    def time(self):
+        """seconds since the epoch"""
+        return time.time()
+
+    def call_later(self, delay, func):
+        """call func in delay seconds, return an object with cancel()"""
+        timer = threading.Timer(delay, func)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+class SimulatedCall(object):
+    """a call scheduled on a SimulatedClock"""
+
+    def __init__(self, due, func):
+        self.due = due
+        self.func = func
+        self.canceled = False
+
+    def cancel(self):
+        """don't call it"""
+        self.canceled = True
+
+
+class SimulatedClock(object):
+    """a clock that only moves when advance_to() is called, for replays
+    and backtests. The calls scheduled with call_later() are made by
+    advance_to() in the order they are due and each one sees the clock
+    at its due time, so timers fire exactly like in real time, only
+    without waiting for it."""
+
+    def __init__(self, now=0):
+        self.now = now
+        self._calls = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def time(self):
+        """seconds since the epoch in the simulation"""
+        return self.now
+
+    def call_later(self, delay, func):
+        """call func when the clock is advanced by delay seconds"""
+        call = SimulatedCall(self.now + delay, func)
+        with self._lock:
+            heapq.heappush(self._calls, (call.due, next(self._seq), call))
+        return call
+
+    def advance_to(self, tim):
+        """move the clock forward to tim, make all calls due until then"""
+        while True:
+            with self._lock:
+                if not self._calls or self._calls[0][0] > tim:
+                    break
+                (due, _, call) = heapq.heappop(self._calls)
+            if not call.canceled:
+                self.now = max(self.now, due)
+                call.func()
+        self.now = max(self.now, tim)
+
+
+# the clock used by the timers and the clients. Replays and backtests
+# replace it with a SimulatedClock before they create their Bfx()
+CLOCK = RealClock()
+
+# the lock of every Bfx and of every Timer that is created without a lock
+# of its own, so the slots of a strategy's timers are never called while
+# a slot of the bfx signals is running. A Timer whose slots may run at any
+# time has to be given a lock of its own.
+BFX_LOCK = threading.RLock()
+
+
 class Timer(Signal):
     """a simple timer (used for stuff like keepalive)."""
 
-    def __init__(self, interval, one_shot=False):
-        """create a new timer, interval is in seconds"""
-        Signal.__init__(self)
+    def __init__(self, interval, one_shot=False, clock=None, lock=None):
+        """create a new timer, interval is in seconds. It runs on
+        clock or on the CLOCK of the module if clock is None, lock
+        is the lock of the signal (see Signal), BFX_LOCK if None"""
+        Signal.__init__(self, lock or BFX_LOCK)
+        self._clock = clock or CLOCK
         self._one_shot = one_shot
         self._canceled = False
         self._interval = interval
@@ -338,9 +937,7 @@ class Timer(Signal):
 
     def _start(self):
         """start the timer"""
-        self._timer = threading.Timer(self._interval, self._fire)
-        self._timer.daemon = True
-        self._timer.start()
+        self._timer = self._clock.call_later(self._interval, self._fire)
 
     def cancel(self):
         """cancel the timer"""
@@ -349,6 +946,60 @@ class Timer(Signal):
         self._timer = None
 
 
+class LoopTimer(Timer):
+    """a timer that is fired by an eventloop.EventLoop instead of
+    running a thread of its own."""
+
+    def __init__(self, loop, interval, one_shot=False, lock=None):
+        """create a new timer on the loop, interval is in seconds"""
+        self._loop = loop
+        Timer.__init__(self, interval, one_shot, None, lock)
+
+    def _start(self):
+        """start the timer"""
+        if self._loop.in_loop_thread():
+            self._timer = self._loop.call_later(self._interval, self._fire)
+        else:
+            self._loop.call_soon_threadsafe(self._start)
+
+    def cancel(self):
+        """cancel the timer"""
+        self._canceled = True
+        if self._timer:
+            self._timer.cancel()
+        self._timer = None
+
+
+# json.dumps() with any non-default option creates a new encoder on
+# every call, the signed calls reuse this one instead
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+class Signer(object):
+    """signs api calls with HMAC-SHA384 of the secret. The key dependent
+    inner and outer hash state is computed only once, every signature
+    starts from a copy of it instead of from hmac.new(). Thread safe."""
+
+    def __init__(self, key, secret):
+        self.key = key
+        self.secret = secret
+        self._hmac = hmac.new(secret, digestmod=hashlib.sha384)
+
+    def sign(self, payload):
+        """return the hex signature of the payload string"""
+        mac = self._hmac.copy()
+        mac.update(payload)
+        return mac.hexdigest()
+
+    def sign_params(self, params):
+        """encode the params of a http api call, return the tuple
+        (payload, headers) with the signature headers"""
+        payload = binascii.b2a_base64(_JSON_ENCODER.encode(params))[:-1]
+        return (payload, {
+            'X-BFX-APIKEY': self.key,
+            'X-BFX-PAYLOAD': payload,
+            'X-BFX-SIGNATURE': self.sign(payload),
+        })
+
 class Secret:
     """Manage the Bitfinex API secret. This class has methods to decrypt the
     entries in the ini file and it also provides a method to create these
@@ -366,6 +1017,7 @@ class Secret:
         self.config = config
         self.key = ""
         self.secret = ""
+        self._signer = None
 
         # pylint: disable=C0103
         self.password_from_commandline_option = None
@@ -496,23 +1148,42 @@ class Secret:
         without secret and then just don't do any account related stuff"""
         return(self.secret != "") and (self.key != "")
 
+    def get_signer(self):
+        """the Signer for the current key and secret, it is created
+        only once and created again only if they have changed"""
+        signer = self._signer
+        if signer is None or signer.key != self.key or signer.secret != self.secret:
+            signer = self._signer = Signer(self.key, self.secret)
+        return signer
+
 
 class BaseClient(BaseObject):
     """abstract base class for SocketIOClient and WebsocketClient"""
 
-    _last_unique_microtime = 0
-    _nonce_lock = threading.Lock()
+    _nonce_generators = {} # one per nonce file, shared by all clients
+    _nonce_generators_lock = threading.Lock()
+    _cid_lock = threading.Lock()
+
+    # held from creating the nonce until the request is written to the
+    # socket, so concurrent http workers reach the server in nonce order
+    _http_send_lock = threading.Lock()
 
     def __init__(self, curr_base, curr_quote, secret, config):
         BaseObject.__init__(self)
 
-        self.signal_recv         = Signal()
-        self.signal_fulldepth    = Signal()
-        self.signal_fullhistory  = Signal()
-        self.signal_connected    = Signal()
-        self.signal_disconnected = Signal()
+        # the lock of all signals and timers of the client, the Bfx
+        # that owns the client replaces it with its own (share_lock)
+        self.lock = threading.RLock()
+
+        self.signal_recv         = Signal(self.lock)
+        self.signal_fulldepth    = Signal(self.lock)
+        self.signal_fullhistory  = Signal(self.lock)
+        self.signal_connected    = Signal(self.lock)
+        self.signal_disconnected = Signal(self.lock)
+        self.signal_ratelimit    = Signal(self.lock)
 
-        self._timer = Timer(60)
+        self.clock = CLOCK
+        self._timer = self.create_timer(60)
         self._timer.connect(self.slot_timer)
 
         self._info_timer = None # used when delayed requesting private/info
@@ -525,28 +1196,80 @@ class BaseClient(BaseObject):
         self.secret = secret
         self.config = config
         self.socket = None
-        self.http_requests = Queue.Queue()
+        self.http_requests = HTTPRequestQueue()
+        self.nonces = self._get_nonce_generator(
+            os.path.splitext(config.filename)[0] + ".nonce")
+        self._http_pending = {}  # coalesced requests waiting in the queue
+        self._http_pending_lock = threading.Lock()
+        self._rate_limits = {}
+        burst = max(1, config.get_int("bfx", "rate_limit_burst"))
+        for (priority, name, option) in RATE_LIMITS:
+            per_minute = config.get_int("bfx", option)
+            if per_minute > 0:
+                self._rate_limits[priority] = (name,
+                    TokenBucket(per_minute / 60.0, min(burst, per_minute)))
+        self._rate_reported = None # whole tokens of the last signal_ratelimit
+        self._rate_timer = None
+        if self._rate_limits:
+            self._rate_timer = self.create_timer(RATE_REPORT_INTERVAL)
+            self._rate_timer.connect(self._slot_rate_timer)
+        self.http_pool = None
+        if config.get_bool("bfx", "http_keepalive"):
+            self.http_pool = HTTPConnectionPool(
+                config.get_int("bfx", "http_keepalive_timeout"))
+
+        self.authenticated = False # auth channel confirmed by the server
+        self._ws_orders = {} # reqids of unacked websocket orders by cid/oid
+        self.orders_requested = None # time of the oldest unanswered request_orders()
+        self._last_cid = 0
 
         self._recv_thread = None
-        self._http_thread = None
+        self._http_threads = []
         self._terminating = False
         self.connected = False
         self._time_last_received = 0
         self._time_last_subscribed = 0
         self.history_last_candle = None
+        self._history_pager = None # unfinished history download
+        self._history_lock = threading.Lock()
 
     def start(self):
         """start the client"""
         self._recv_thread = start_thread(self._recv_thread_func, "socket receive thread")
-        self._http_thread = start_thread(self._http_thread_func, "http thread")
+        workers = max(1, self.config.get_int("bfx", "http_workers"))
+        for i in range(workers):
+            # with more than one worker the first one only sends orders
+            # and cancels, the others take whatever is most urgent
+            if i == 0 and workers > 1:
+                max_priority = HTTP_PRIORITY_ORDER
+            else:
+                max_priority = None
+            self._http_threads.append(start_thread(
+                functools.partial(self._http_thread_func, max_priority),
+                "http thread %i" % i))
 
     def stop(self):
         """stop the client"""
         self._terminating = True
         self._timer.cancel()
+        if self._rate_timer:
+            self._rate_timer.cancel()
         if self.socket:
             self.debug("### closing socket")
             self.socket.sock.close()
+        if self.http_pool:
+            self.http_pool.close()
+
+    def create_timer(self, interval, one_shot=False):
+        """create a Timer for the client, client types that don't use
+        threads for everything will override this"""
+        return Timer(interval, one_shot, self.clock, self.lock)
+
+    def share_lock(self, lock):
+        """use lock instead of self.lock for all signals and timers
+        of the client, this should be done before start()"""
+        replace_signal_lock([self], self.lock, lock)
+        self.lock = lock
 
     def force_reconnect(self):
         """force client to reconnect"""
@@ -569,15 +1292,16 @@ class BaseClient(BaseObject):
 
     def get_unique_mirotime(self):
         """produce a unique nonce that is guaranteed to be ever increasing"""
-        with self._nonce_lock:
-            since_date = datetime.now()
-            microtime = calendar.timegm(since_date.timetuple())*10
-            #without multiplication to 10 bitfinex writes that nonce is too small sometimes...
-            #microtime = int(time.time())
-            if microtime <= self._last_unique_microtime:
-                microtime = self._last_unique_microtime + 1
-            self._last_unique_microtime = microtime
-            return microtime
+        return self.nonces.get()
+
+    @classmethod
+    def _get_nonce_generator(cls, filename):
+        """the NonceGenerator for this nonce file, all clients that
+        use the same file (the same api key) must share it"""
+        with cls._nonce_generators_lock:
+            if filename not in cls._nonce_generators:
+                cls._nonce_generators[filename] = NonceGenerator(filename)
+            return cls._nonce_generators[filename]
 
     def use_http(self):
         """should we use http api? return true if yes"""
@@ -596,19 +1320,23 @@ class BaseClient(BaseObject):
             and then terminate. This is called in a separate thread after
             the streaming API has been connected."""
             self.debug("### requesting initial full depth")
-            use_ssl = self.config.get_bool("bfx", "use_ssl")
-            proto = "https"
-            fulldepth = http_request("%s://%s/book/%s%s" % (
-                proto,
-                HTTP_API_URLS_PREFIX,
-                self.curr_base,
-                self.curr_quote
-            ))
+            fulldepth = http_request(self._fulldepth_url())
             self.signal_fulldepth(self, (json.loads(fulldepth)))
             #self.debug(json.loads(fulldepth))
 
         start_thread(fulldepth_thread, "http request full depth")
 
+    def _fulldepth_url(self):
+        """the url of the full market depth"""
+        #use_ssl = self.config.get_bool("bfx", "use_ssl")
+        proto = "https"
+        return "%s://%s/book/%s%s" % (
+            proto,
+            HTTP_API_URLS_PREFIX,
+            self.curr_base,
+            self.curr_quote
+        )
+
     def request_history(self):
         """request trading history"""
 
@@ -618,41 +1346,42 @@ class BaseClient(BaseObject):
 
         def history_thread():
             """request trading history"""
+            if not self._history_lock.acquire(False):
+                self.debug("### history download is already running")
+                return
+            try:
+                end = int(self.clock.time() * 1000)
+                pager = self._history_pager
+                if pager:
+                    self.debug("### resuming history download")
+                    pager.extend_to(end)
+                else:
+                    self.debug("### requesting history")
+                    pager = HistoryPager(
+                        "%s%s" % (self.curr_base, self.curr_quote),
+                        self._history_start(since) * 1000, end,
+                        self.config.get_int("bfx", "history_download_threads"))
+                    pager.signal_debug.connect(self.signal_debug)
+                    self._history_pager = pager
+                if pager.run(self._emit_history):
+                    self._history_pager = None
+            finally:
+                self._history_lock.release()
 
-            # 1308503626, 218868 <-- last small transacion ID
-            # 1309108565, 1309108565842636 <-- first big transaction ID
+        start_thread(history_thread, "http request trade history")
 
-            if since:
-                querystring = "?timestamp=%i&limit_trades=10000" % (since * 1000000)
-            else:
-                #in seconds
-                history_timeframe = int(self.config.get_string("bfx", "history_timeframe"))*60
-                #number of chart candles is less than 100 on my display,
-                # so I just multiply it with magic number
-                since_date = datetime.utcnow() - timedelta(minutes=15*100)
-                timestamp=calendar.timegm(since_date.utctimetuple())
-                #hack with 10000 is because bitfinex api doesnt handle timestamp argument without limit_trades,
-                # so I've just taken some big value to be sure that for 15min timeframes it will be enough (usually)
-                querystring = "?timestamp=%i&limit_trades=10000" % timestamp
-                #self.debug()
-
-            self.debug("### requesting history")
-            use_ssl = self.config.get_bool("bfx", "use_ssl")
-            proto = "https"
-            json_hist = http_request("%s://%s/trades/%s%s/%s" % (
-                proto,
-                HTTP_API_URLS_PREFIX,
-                self.curr_base,
-                self.curr_quote,
-                querystring
-            ))
-            history = json.loads(json_hist)
-            if history:
-                #we need to reverse order of history in api
-                history.reverse()
-                self.signal_fullhistory(self, history)
+    def _emit_history(self, trades):
+        """emit signal_fullhistory for a part of the history download"""
+        self.signal_fullhistory(self, trades)
 
-        start_thread(history_thread, "http request trade history")
+    def _history_start(self, since):
+        """the POSIX timestamp where the history download begins, since
+        the last known candle or the time span needed for the chart"""
+        if since:
+            return since
+        #number of chart candles is less than 100 on my display,
+        # so I just multiply it with magic number
+        return int(self.clock.time()) - 15 * 100 * 60
 
     def _recv_thread_func(self):
         """this will be executed as the main receiving thread, each type of
@@ -703,7 +1432,7 @@ class BaseClient(BaseObject):
 
         self.subscribe_auth_account_info_channel()
 
-        self._time_last_subscribed = time.time()
+        self._time_last_subscribed = self.clock.time()
 
     def subscribe_auth_account_info_channel(self):
         """
@@ -716,14 +1445,13 @@ class BaseClient(BaseObject):
         if (not self.secret) or (not self.secret.know_secret()):
             self.debug("### don't know secret, cannot subscribe account info channel ")
             return
-        key = self.secret.key
-        sec = self.secret.secret
+        signer = self.secret.get_signer()
         payload = 'AUTH%d' % self.get_unique_mirotime()
-        signature = hmac.new(sec, payload, hashlib.sha384).hexdigest()
+        signature = signer.sign(payload)
         #self.debug("### (socket) calling %s" % api_endpoint)
         self.send(json.dumps({
             'event': "auth",
-            'apiKey': key,
+            'apiKey': signer.key,
             'authSig': signature,
             'authPayload': payload,
         }))
@@ -738,7 +1466,7 @@ class BaseClient(BaseObject):
         """request the private/info in delay seconds from now"""
         if self._info_timer:
             self._info_timer.cancel()
-        self._info_timer = Timer(delay, True)
+        self._info_timer = self.create_timer(delay, True)
         self._info_timer.connect(self._slot_timer_info_later)
 
     def request_info(self):
@@ -754,30 +1482,37 @@ class BaseClient(BaseObject):
 
     def request_orders(self):
         """request the private/orders object"""
+        if self.orders_requested is None:
+            self.orders_requested = self.clock.time()
         #if self.use_http():
         self.enqueue_http_request("orders", {}, "orders")
         #else:
         #    self.send_signed_call("orders", {}, "orders")
 
-    def _http_thread_func(self):
+    def _http_thread_func(self, max_priority=None):
         """send queued http requests to the http API (only used when
-        http api is forced, normally this is much slower)"""
+        http api is forced, normally this is much slower). Several of
+        these run concurrently, max_priority restricts a worker to the
+        more urgent lanes of the queue."""
         while not self._terminating:
             # pop queued request from the queue and process it
-            (api_endpoint, params, reqid) = self.http_requests.get(True)
-            translated = None
+            (api_endpoint, params, reqid) = self.http_requests.get(True, max_priority)
+            wait = self.take_rate_token(api_endpoint)
+            while wait:
+                time.sleep(wait)
+                wait = self.take_rate_token(api_endpoint)
+            reqids = self._http_requesters(api_endpoint, params, reqid)
+            translated = []
             try:
                 answer = self.http_signed_call(api_endpoint, params)
 
                 self.debug(answer)
                 self.debug(api_endpoint)
                 self.debug(params)
-                self.debug(reqid)
+                self.debug(reqids)
 
-                translated = {
-                    "reqid": reqid,
-                    "data": answer,
-                }
+                translated = [self._translate_http_answer(reqid, answer)
+                    for reqid in reqids]
 
                 #if answer["result"] == "success":
                 #    # the following will reformat the answer in such a way
@@ -820,21 +1555,113 @@ class BaseClient(BaseObject):
                 # there is heavy load on their servers. Resubmitting
                 # the API call will then eventally succeed.
                 self.debug("### exception in _http_thread_func:",
-                    exc, api_endpoint, params, reqid)
-
-                # enqueue it again, it will eventually succeed.
-                self.enqueue_http_request(api_endpoint, params, reqid)
-
-            if translated:
-                self.signal_recv(self, (json.dumps(translated)))
+                    exc, api_endpoint, params, reqids)
+
+                # enqueue it again, it will eventually succeed. Orders
+                # are not, their failure is reported instead.
+                translated = self._http_failed_answers(api_endpoint, reqids, exc)
+                if translated is None:
+                    translated = []
+                    for reqid in reqids:
+                        self.enqueue_http_request(api_endpoint, params, reqid)
+
+            for answer in translated:
+                self.signal_recv(self, (json.dumps(answer)))
+
+    def _translate_http_answer(self, reqid, answer):
+        """reformat the answer of a http api call in such a way that we can
+        pass it to signal_recv() as if it had come over the websocket"""
+        return {
+            "reqid": reqid,
+            "data": answer,
+        }
 
-            self.http_requests.task_done()
+    def _http_failed_answers(self, api_endpoint, reqids, exc):
+        """a signed call failed and has no answer. Return None if it can
+        be sent again. Calls that place orders are not sent again because
+        the server might have placed them already, instead this returns
+        error answers for their reqids and requests the order list, the
+        orders that have been placed will then show up in it."""
+        if api_endpoint not in HTTP_NO_RESEND:
+            return None
+        self.request_orders()
+        return [self._translate_http_answer(reqid,
+            {"message": "not sent again after %s: %s" % (exc.__class__.__name__, exc)})
+            for reqid in reqids]
 
     def enqueue_http_request(self, api_endpoint, params, reqid):
         """enqueue a request for sending to the HTTP API, returns
         immediately, behaves exactly like sending it over the websocket."""
         if self.secret and self.secret.know_secret():
-            self.http_requests.put((api_endpoint, params, reqid))
+            key = self._http_coalesce_key(api_endpoint, params)
+            if key:
+                with self._http_pending_lock:
+                    if key in self._http_pending:
+                        # an identical request is already waiting, its
+                        # answer will also be sent to this reqid
+                        if reqid not in self._http_pending[key]:
+                            self._http_pending[key].append(reqid)
+                        return
+                    self._http_pending[key] = [reqid]
+            self.http_requests.put((api_endpoint, params, reqid),
+                HTTP_PRIORITIES.get(api_endpoint, HTTP_PRIORITY_QUERY))
+
+    def take_rate_token(self, api_endpoint):
+        """take a token from the rate limit budget of this endpoint class,
+        return 0 if the request may be sent now or else the number of
+        seconds to wait before trying again. This does not emit the
+        signal_ratelimit, a request must never wait for its slots."""
+        priority = HTTP_PRIORITIES.get(api_endpoint, HTTP_PRIORITY_QUERY)
+        if priority not in self._rate_limits:
+            return 0
+        return self._rate_limits[priority][1].take()
+
+    def _slot_rate_timer(self, _sender, _data):
+        """emit signal_ratelimit if a budget has changed by at least
+        one whole token since it has been emitted last time"""
+        budget = self.rate_budget()
+        tokens = dict((name, int(value)) for (name, value) in budget.items())
+        if tokens != self._rate_reported:
+            self._rate_reported = tokens
+            self.signal_ratelimit(self, (budget))
+
+    def rate_budget(self):
+        """the remaining budget of each endpoint class, a dict
+        like {"orders": 4.5, "cancels": 10, "account": 9.8}"""
+        return dict((name, bucket.available())
+            for (name, bucket) in self._rate_limits.values())
+
+    def rate_limit_exceeded(self, name):
+        """the server has rejected a request for exceeding its limits,
+        empty the budget so we will have to wait for a refill"""
+        for (bucket_name, bucket) in self._rate_limits.values():
+            if bucket_name == name:
+                bucket.drain()
+        self._rate_reported = None
+        self._slot_rate_timer(self, None)
+
+    @staticmethod
+    def _http_coalesce_key(api_endpoint, params):
+        """the key under which identical idempotent requests are
+        merged or None if this request must always be sent"""
+        if api_endpoint not in HTTP_IDEMPOTENT:
+            return None
+        # nonce and request are added by _sign_http_call(), they
+        # are still there when a failed request is enqueued again
+        params = dict((k, v) for (k, v) in params.items()
+            if k not in ("nonce", "request"))
+        return "%s %s" % (api_endpoint, json.dumps(params, sort_keys=True))
+
+    def _http_requesters(self, api_endpoint, params, reqid):
+        """called when a request is taken out of the queue, return the
+        reqids of all requests that have been merged into it. From now
+        on a new identical request will be sent again because the answer
+        to this one might already be outdated when it arrives."""
+        key = self._http_coalesce_key(api_endpoint, params)
+        if key:
+            with self._http_pending_lock:
+                return self._http_pending.pop(key, [reqid])
+        return [reqid]
 
     def http_signed_call(self, api_endpoint, params):
         """send a signed request to the HTTP API"""
@@ -842,20 +1669,49 @@ class BaseClient(BaseObject):
             self.debug("### don't know secret, cannot call %s" % api_endpoint)
             return
 
-        key = self.secret.key
-        sec = self.secret.secret
+        for _ in range(HTTP_NONCE_RETRIES):
+            answer = self._http_signed_call_once(api_endpoint, params)
+            if not _nonce_rejected(answer):
+                break
+            self.debug("### nonce rejected, signing %s again" % api_endpoint)
+        return answer
 
-        params["nonce"] = "%d" % self.get_unique_mirotime()
+    def _http_signed_call_once(self, api_endpoint, params):
+        """sign and send the request, return the decoded answer"""
+        if not self.http_pool:
+            # urlopen() can't send without waiting for the answer
+            with self._http_send_lock:
+                (url, post, headers) = self._sign_http_call(api_endpoint, params)
+                return json.loads(http_request(url, post, headers))
+
+        while True:
+            # a new connection makes its handshake before the lock is
+            # taken, only signing and writing the request hold it
+            lease = self.http_pool.connect("https://%s" % HTTP_API_URLS_PREFIX)
+            try:
+                with self._http_send_lock:
+                    (url, post, headers) = self._sign_http_call(api_endpoint, params)
+                    pending = self.http_pool.send_on(lease, url, post, headers)
+            except StaleConnectionError:
+                # it has not been sent, send it again with a new nonce
+                continue
+            try:
+                return json.loads(pending.read())
+            except StaleConnectionError:
+                if api_endpoint in HTTP_NO_RESEND:
+                    raise
+                # send it again, it needs a new nonce
+                continue
+
+    def _sign_http_call(self, api_endpoint, params, nonce=None):
+        """add nonce and signature to a HTTP API call, this returns
+        a tuple (url, post, headers) that is ready for sending"""
+        if nonce is None:
+            nonce = self.get_unique_mirotime()
+        params["nonce"] = "%d" % nonce
         params["request"] = '/v1/%s' % api_endpoint
 
-        payload = base64.b64encode(json.dumps(params, ensure_ascii=False))
-        signature = hmac.new(sec, payload, hashlib.sha384).hexdigest()
-        post = payload
-        headers = {
-            'X-BFX-APIKEY': key,
-            'X-BFX-PAYLOAD': payload,
-            'X-BFX-SIGNATURE': signature,
-        }
+        (post, headers) = self.secret.get_signer().sign_params(params)
 
         #use_ssl = self.config.get_bool("bfx", "use_ssl")
         proto = "https"
@@ -866,7 +1722,7 @@ class BaseClient(BaseObject):
             api_endpoint
         )
         self.debug("### (%s) calling %s" % (proto, url))
-        return json.loads(http_request(url, post, headers))
+        return (url, post, headers)
 
     #def send_signed_call(self, api_endpoint, params, reqid):
     #    """send a signed (authenticated) API call over the socket.io.
@@ -901,16 +1757,11 @@ class BaseClient(BaseObject):
     #        "context" : "mtgox.com"
     #    }))
 
-    def send_order_add(self, typ, price, volume):
-        """send an order"""
-        #raise Exception("Not implemented send_order_add")
-        reqid = "order_add:%s:%f:%f" % (typ, price, volume)
-
+    def _order_params(self, typ, price, volume):
+        """the parameters that describe one new order"""
         symb = "%s%s" % (self.curr_base, self.curr_quote)
         buy_or_sell = {'bid': 'buy', 'ask': 'sell'}[typ]
-        params = {
-            "request": "/v1/order/new",
-            "nonce": self.get_unique_mirotime(),
+        return {
             "symbol": symb,
             "amount": "%f" % volume,
             "price": "%f" % price,
@@ -918,14 +1769,92 @@ class BaseClient(BaseObject):
             "side": buy_or_sell,
             "type": "exchange limit"
         }
+
+    def use_websocket_orders(self):
+        """should orders be sent over the websocket? Only if this is
+        enabled and the authenticated websocket is up, otherwise they
+        will fall back to the http api"""
+        return (self.config.get_bool("bfx", "websocket_orders")
+            and self.connected and self.authenticated)
+
+    def _websocket_order_allowed(self, api_endpoint):
+        """should this order input go out over the websocket now? This
+        takes a token from the same rate limit budget as the http api,
+        if there is none the order falls back to the http queue which
+        will wait for the refill"""
+        return self.use_websocket_orders() and not self.take_rate_token(api_endpoint)
+
+    def _send_websocket_order(self, msg_type, key, reqid, fields):
+        """send an order input message over the authenticated websocket.
+        The ack will be matched by key (cid or oid) to the reqid."""
+        self._ws_orders[key] = reqid
+        self.debug("### (websocket) sending", msg_type, fields)
+        self.send(json.dumps([0, msg_type, None, fields]))
+
+    def ws_order_acked(self, key):
+        """the ack for the websocket order with this cid or oid has arrived,
+        return its reqid or None if it was not sent by us"""
+        return self._ws_orders.pop(key, None)
+
+    def ws_orders_lost(self):
+        """return the reqids of all websocket orders that have not been
+        acked, the connection is lost and they never will be"""
+        reqids = self._ws_orders.values()
+        self._ws_orders = {}
+        return reqids
+
+    def _next_cid(self):
+        """a new client order id (unique per day, millisecond timestamp)"""
+        with self._cid_lock:
+            cid = int(self.clock.time() * 1000)
+            if cid <= self._last_cid:
+                cid = self._last_cid + 1
+            self._last_cid = cid
+            return cid
+
+    def send_order_add(self, typ, price, volume):
+        """send an order"""
+        #raise Exception("Not implemented send_order_add")
+        reqid = "order_add:%s:%f:%f" % (typ, price, volume)
+
+        if self._websocket_order_allowed("order/new"):
+            cid = self._next_cid()
+            self._send_websocket_order("on", cid, reqid, {
+                "cid": cid,
+                "type": "EXCHANGE LIMIT",
+                "symbol": "t%s%s" % (self.curr_base, self.curr_quote),
+                "amount": "%f" % {"bid": volume, "ask": -volume}[typ],
+                "price": "%f" % price
+            })
+            return
+
+        params = self._order_params(typ, price, volume)
+        params["request"] = "/v1/order/new"
         api = "order/new"
         self.enqueue_http_request(api, params, reqid)
 
+    def send_order_add_multi(self, orders):
+        """send many orders in one single call, orders is a list of
+        (typ, price, volume) tuples, at most ORDER_MULTI_MAX of them"""
+        params = {
+            "request": "/v1/order/new/multi",
+            "orders": [self._order_params(typ, price, volume)
+                for (typ, price, volume) in orders]
+        }
+        # the count is needed when the whole batch is rejected
+        reqid = "order_add_multi:%d:%d" % (len(orders), self._next_cid())
+        api = "order/new/multi"
+        self.enqueue_http_request(api, params, reqid)
+
     def send_order_cancel(self, oid):
         """cancel an order"""
+        if self._websocket_order_allowed("order/cancel"):
+            self._send_websocket_order("oc", oid, "order_cancel:%s" % oid,
+                {"id": int(oid)})
+            return
+
         params = {
             "request": "/v1/order/cancel",
-            "nonce": self.get_unique_mirotime(),
             "order_id": oid}
         reqid = "order_cancel:%s" % oid
         #if self.use_http():
@@ -935,14 +1864,53 @@ class BaseClient(BaseObject):
         #    api = "order/cancel"
         #    self.send_signed_call(api, params, reqid)
 
+    def send_order_cancel_multi(self, oids):
+        """cancel many orders with one single call"""
+        params = {
+            "request": "/v1/order/cancel/multi",
+            "order_ids": [int(oid) for oid in oids]}
+        # the answer won't tell which orders, so the reqid must
+        reqid = "order_cancel_multi:%s" % ",".join(str(oid) for oid in oids)
+        api = "order/cancel/multi"
+        self.enqueue_http_request(api, params, reqid)
+
+    def send_order_replace(self, oid, typ, price, volume):
+        """cancel an order and place a new one in one single call"""
+        if self._websocket_order_allowed("order/cancel/replace"):
+            # over the websocket the order can be updated in place
+            self._send_websocket_order("ou", oid, "order_replace:%s" % oid, {
+                "id": int(oid),
+                "amount": "%f" % {"bid": volume, "ask": -volume}[typ],
+                "price": "%f" % price
+            })
+            return
+
+        params = self._order_params(typ, price, volume)
+        params["request"] = "/v1/order/cancel/replace"
+        params["order_id"] = int(oid)
+        reqid = "order_replace:%s" % oid
+        api = "order/cancel/replace"
+        self.enqueue_http_request(api, params, reqid)
+
+    def send_order_cancel_all(self, oids=()):
+        """cancel all orders of the account (of all currency pairs!),
+        oids are the orders we know of at the time of sending"""
+        params = {
+            "request": "/v1/order/cancel/all"}
+        # only these may be removed when the answer arrives, orders
+        # placed after this call are not affected by it
+        reqid = "order_cancel_all:%s" % ",".join(str(oid) for oid in oids)
+        api = "order/cancel/all"
+        self.enqueue_http_request(api, params, reqid)
+
     def slot_timer(self, _sender, _data):
         """check timeout (last received, dead socket?)"""
         if self.connected:
-            if time.time() - self._time_last_received > 60:
+            if self.clock.time() - self._time_last_received > 60:
                 self.debug("### did not receive anything for a long time, disconnecting.")
                 self.force_reconnect()
                 self.connected = False
-            if time.time() - self._time_last_subscribed > 1800:
+            if self.clock.time() - self._time_last_subscribed > 1800:
                 # sometimes after running for a few hours it
                 # will lose some of the subscriptons for no
                 # obvious reason. I've seen it losing the trades
@@ -960,12 +1928,15 @@ class WebsocketClient(BaseClient):
         BaseClient.__init__(self, curr_base, curr_quote, secret, config)
         self.hostname = WEBSOCKET_HOST_PORT
 
-    def _recv_thread_func(self):
-        """connect to the websocket and start receiving in an infinite loop.
-        Try to reconnect whenever connection is lost. Each received json
-        string will be dispatched with a signal_recv signal"""
-        reconnect_time = 1
-        use_ssl = self.config.get_bool("bfx", "use_ssl")
+    def _create_socket(self):
+        """create a new (not yet connected) websocket"""
+        return websocket.WebSocket(max_message_size=
+            self.config.get_int("bfx", "websocket_max_message_size"))
+
+    def _connect_socket(self, sock):
+        """connect the websocket sock to the server. This will block
+        until the connection is established or raise an exception"""
+        ##use_ssl = self.config.get_bool("bfx", "use_ssl")
         ##wsp = {True: "wss://", False: "ws://"}[use_ssl]
         wsp = "wss://"
         #port = {True: 443, False: 80}[use_ssl]
@@ -973,30 +1944,45 @@ class WebsocketClient(BaseClient):
         #ws_origin = "%s:%d" % (self.hostname, port)
         ws_origin = self.hostname
         ws_headers = ["User-Agent: %s" % USER_AGENT]
+        ws_deflate = self.config.get_bool("bfx", "websocket_deflate")
+
+        # channels separated by "/", wildcards allowed. Available
+        # channels see here: https://mtgox.com/api/2/stream/list_public
+        # example: ws://websocket.mtgox.com/?Channel=depth.LTCEUR/ticker.LTCEUR
+        # the trades and lag channel will be subscribed after connect
+        ws_url = "%s%s" % (wsp, self.hostname)
+        self.debug("### trying plain old Websocket: %s ... " % ws_url)
+
+        # The server is somewhat picky when it comes to the exact
+        # host:port syntax of the origin header, so I am supplying
+        # my own origin header instead of the auto-generated one
+        sock.connect(ws_url, origin=ws_origin, header=ws_headers,
+            deflate=ws_deflate)
+        if sock.tls_handshake_time is not None:
+            self.debug("### TLS handshake took %.1f ms" % (
+                sock.tls_handshake_time * 1000))
+
+    def _recv_thread_func(self):
+        """connect to the websocket and start receiving in an infinite loop.
+        Try to reconnect whenever connection is lost. Each received json
+        string will be dispatched with a signal_recv signal"""
+        reconnect_time = 1
         while not self._terminating:  #loop 0 (connect, reconnect)
             try:
-                # channels separated by "/", wildcards allowed. Available
-                # channels see here: https://mtgox.com/api/2/stream/list_public
-                # example: ws://websocket.mtgox.com/?Channel=depth.LTCEUR/ticker.LTCEUR
-                # the trades and lag channel will be subscribed after connect
-                sym = "%s%s" % (self.curr_base, self.curr_quote)
-                ws_url = "%s%s" % (wsp, self.hostname)
-                self.debug("### trying plain old Websocket: %s ... " % ws_url)
-
-                self.socket = websocket.WebSocket()
-                # The server is somewhat picky when it comes to the exact
-                # host:port syntax of the origin header, so I am supplying
-                # my own origin header instead of the auto-generated one
-                self.socket.connect(ws_url, origin=ws_origin, header=ws_headers)
-                self._time_last_received = time.time()
+                self.socket = self._create_socket()
+                time_connect = time.time()
+                self._connect_socket(self.socket)
+                self._time_last_received = self.clock.time()
                 self.connected = True
                 self.debug("### connected, subscribing needed channels")
                 self.channel_subscribe()
+                self.debug("### subscribed %.1f ms after connect" % (
+                    (time.time() - time_connect) * 1000))
                 self.debug("### waiting for data...")
                 self.signal_connected(self, None)
                 while not self._terminating: #loop1 (read messages)
                     str_json = self.socket.recv()
-                    self._time_last_received = time.time()
+                    self._time_last_received = self.clock.time()
                     #if str_json[0] == "{":
                     self.signal_recv(self, (str_json))
                     #else:
@@ -1017,6 +2003,366 @@ class WebsocketClient(BaseClient):
         self._try_send_raw(json_str)
 
 
+class EventLoopClient(WebsocketClient):
+    """this talks to BitFinex exactly like WebsocketClient does and emits
+    the same signals but instead of a receive thread, a http thread and a
+    thread for every timer it does everything on one eventloop.EventLoop:
+    the websocket, the signed http api calls, the full depth and history
+    downloads and the client timers. All signals are emitted from within
+    the loop thread. Only the websocket connect (which blocks) is done in
+    a short lived helper thread which then hands the socket to the loop."""
+
+    def __init__(self, curr_base, curr_quote, secret, config):
+        self.loop = eventloop.EventLoop()
+        WebsocketClient.__init__(self, curr_base, curr_quote, secret, config)
+        self.loop.on_error = self._on_loop_error
+        host = HTTP_API_URLS_PREFIX.split("/")[0]
+        # signed calls and public downloads use separate connections so
+        # that a large history download can never delay an order
+        self._http_signed = eventloop.HTTPSClient(self.loop, host,
+            user_agent=USER_AGENT)
+        self._http_public = eventloop.HTTPSClient(self.loop, host,
+            user_agent=USER_AGENT)
+        self._socket_fd = None
+        self._rate_limit_handle = None
+
+    def start(self):
+        """start the loop thread and connect"""
+        self._recv_thread = start_thread(self.loop.run_forever, "event loop thread")
+        self.loop.call_soon_threadsafe(self._connect)
+
+    def stop(self):
+        """stop the client and its loop"""
+        self._terminating = True
+        self._timer.cancel()
+        if self._rate_timer:
+            self._rate_timer.cancel()
+        self.loop.call_soon_threadsafe(self._shutdown)
+
+    def create_timer(self, interval, one_shot=False):
+        """timers of this client are fired by the loop"""
+        return LoopTimer(self.loop, interval, one_shot, self.lock)
+
+    def force_reconnect(self):
+        """force client to reconnect"""
+        self._run_in_loop(self._on_socket_error, Exception("forced reconnect"))
+
+    def send(self, json_str):
+        """send the json encoded string over the websocket"""
+        self._run_in_loop(self._try_send_raw, json_str)
+
+    def _try_send_raw(self, raw_data):
+        """send raw data to the websocket or disconnect and reconnect"""
+        if self.connected:
+            try:
+                self.socket.send(raw_data)
+            except Exception as exc:
+                self._on_socket_error(exc)
+
+    def enqueue_http_request(self, api_endpoint, params, reqid):
+        """enqueue a request for sending to the HTTP API, the loop
+        will sign it and send it as soon as it gets to it"""
+        WebsocketClient.enqueue_http_request(self, api_endpoint, params, reqid)
+        self.loop.call_soon_threadsafe(self._send_http_requests)
+
+    def request_fulldepth(self):
+        """download the full depth without blocking the loop"""
+        self.debug("### requesting initial full depth")
+        self._run_in_loop(self._http_get, self._fulldepth_url(),
+            self._on_fulldepth)
+
+    def _emit_history(self, trades):
+        """the pages are downloaded by the HistoryPager threads of
+        request_history(), the loop thread emits the result"""
+        self.loop.call_soon_threadsafe(self.signal_fullhistory, self, trades)
+
+    def _run_in_loop(self, func, *args):
+        """call func(*args) now if we are in the loop thread or
+        schedule it to be called from within the loop otherwise"""
+        if self.loop.in_loop_thread():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _on_loop_error(self, traceback_str):
+        """exception in a loop callback, the loop keeps running"""
+        self.debug("### exception in event loop:", traceback_str)
+
+    def _shutdown(self):
+        """close all connections and stop the loop"""
+        self._http_signed.close()
+        self._http_public.close()
+        self._close_socket()
+        self.loop.stop()
+
+    def _connect(self):
+        """connect the websocket in a helper thread"""
+        if not self._terminating:
+            start_thread(self._connect_thread_func, "websocket connect thread")
+
+    def _connect_thread_func(self):
+        """connect a new websocket and give it to the loop"""
+        sock = self._create_socket()
+        try:
+            self._connect_socket(sock)
+        except Exception as exc:
+            sock.close()
+            self.loop.call_soon_threadsafe(self._on_connect_failed, exc)
+            return
+        self.loop.call_soon_threadsafe(self._on_connected, sock)
+
+    def _on_connect_failed(self, exc):
+        """the connect thread could not connect, try again later"""
+        self.signal_disconnected(self, None)
+        self._reconnect_later(exc)
+
+    def _on_connected(self, sock):
+        """the connect thread has a connected websocket for us"""
+        if self._terminating:
+            sock.close()
+            return
+        self.socket = sock
+        self._socket_fd = sock.fileno()
+        self._time_last_received = self.clock.time()
+        self.connected = True
+        self.loop.add_reader(self._socket_fd, self._on_socket_readable)
+        self.debug("### connected, subscribing needed channels")
+        self.channel_subscribe()
+        self.debug("### waiting for data...")
+        self.signal_connected(self, None)
+
+    def _on_socket_readable(self):
+        """read everything that has arrived and emit every complete
+        message, partial frames stay buffered until the rest arrives"""
+        try:
+            self.socket.recv_available()
+            while self.socket:
+                msg = self.socket.recv_data_nowait()
+                if msg is None:
+                    break
+                (opcode, str_json) = msg
+                if opcode == websocket.ABNF.OPCODE_CLOSE:
+                    raise websocket.WebSocketConnectionClosedException()
+                self._time_last_received = self.clock.time()
+                self.signal_recv(self, (str_json))
+        except Exception as exc:
+            self._on_socket_error(exc)
+
+    def _on_socket_error(self, exc):
+        """the websocket is broken, close it and reconnect"""
+        if self.socket is None:
+            return
+        self._close_socket()
+        self.connected = False
+        self.signal_disconnected(self, None)
+        self._reconnect_later(exc)
+
+    def _close_socket(self):
+        """stop watching the websocket and close it"""
+        if self._socket_fd is not None:
+            self.loop.remove_reader(self._socket_fd)
+            self._socket_fd = None
+        if self.socket:
+            self.debug("### closing socket")
+            # don't wait for the close frame of the server, that would
+            # stop the loop and everything on it for up to 3 seconds
+            self.socket.close(timeout=0)
+            self.socket = None
+
+    def _reconnect_later(self, exc):
+        """schedule the next connection attempt"""
+        reconnect_time = 1
+        if not self._terminating:
+            self.debug("### ", exc.__class__.__name__, exc,
+                "reconnecting in %i seconds..." % reconnect_time)
+            self.loop.call_later(reconnect_time, self._connect)
+
+    def _send_http_requests(self):
+        """sign and send everything that is waiting in http_requests
+        as long as the rate limit allows it"""
+        if self._rate_limit_handle:
+            self._rate_limit_handle.cancel()
+            self._rate_limit_handle = None
+        batch = []
+        while True:
+            try:
+                (api_endpoint, params, reqid) = self.http_requests.get(False)
+            except Queue.Empty:
+                break
+            wait = self.take_rate_token(api_endpoint)
+            if wait:
+                # no budget, put it back in front of its lane
+                self.http_requests.put_front((api_endpoint, params, reqid),
+                    HTTP_PRIORITIES.get(api_endpoint, HTTP_PRIORITY_QUERY))
+                self._rate_limit_handle = self.loop.call_later(wait,
+                    self._send_http_requests)
+                break
+            batch.append((api_endpoint, params,
+                self._http_requesters(api_endpoint, params, reqid)))
+
+        if not batch:
+            return
+        # they all go out over the same connection in this order,
+        # so they can be signed with one range of nonces
+        nonce = self.nonces.reserve(len(batch))
+        for (api_endpoint, params, reqids) in batch:
+            (url, post, headers) = self._sign_http_call(api_endpoint, params, nonce)
+            nonce += 1
+            self._http_signed.request("POST", _url_path(url), post, headers,
+                functools.partial(self._on_http_answer, api_endpoint, params, reqids),
+                api_endpoint not in HTTP_NO_RESEND)
+
+    def _on_http_answer(self, api_endpoint, params, reqids, error, _status, body):
+        """answer of a signed call has arrived (or it failed)"""
+        try:
+            if error:
+                raise error
+            answer = json.loads(body)
+        except Exception as exc:
+            # should this ever happen? HTTP 5xx wont come here,
+            # so we try again a second later, just like the thread
+            self.debug("### exception in _on_http_answer:", exc, api_endpoint, reqids)
+            translated = self._http_failed_answers(api_endpoint, reqids, exc)
+            if translated is None:
+                for reqid in reqids:
+                    self.loop.call_later(1, self.enqueue_http_request,
+                        api_endpoint, params, reqid)
+            else:
+                for answer in translated:
+                    self.signal_recv(self, (json.dumps(answer)))
+            return
+        if _nonce_rejected(answer):
+            # the server has not processed it, it gets a new nonce
+            self.debug("### nonce rejected, signing %s again" % api_endpoint)
+            for reqid in reqids:
+                self.enqueue_http_request(api_endpoint, params, reqid)
+            return
+        for reqid in reqids:
+            self.signal_recv(self, (json.dumps(
+                self._translate_http_answer(reqid, answer))))
+
+    def _http_get(self, url, callback):
+        """GET the public url, callback(error, status, body)"""
+        self._http_public.request("GET", _url_path(url), None, None, callback)
+
+    def _on_fulldepth(self, error, _status, body):
+        """the full depth download has finished"""
+        if error:
+            self.debug("### could not download full depth:", error)
+            return
+        self.signal_fulldepth(self, (json.loads(body)))
+
+
+class HistoryPager(BaseObject):
+    """downloads all trades between start and end (POSIX milliseconds) in
+    pages of HISTORY_PAGE_LIMIT trades. The time span is split into
+    windows that are walked forward in parallel, one thread per window,
+    duplicates at page boundaries are removed by trade id. Completed pages
+    are kept, so when run() fails (network trouble) it can be run() again
+    later and will resume each window after its last completed page."""
+
+    def __init__(self, symbol, start, end, windows):
+        BaseObject.__init__(self)
+        self.symbol = symbol
+        self.end = end
+        self.windows = []
+        step = max(1, (end - start) // max(1, windows))
+        for first in range(start, end, step):
+            self.windows.append(_HistoryWindow(first, min(first + step, end)))
+
+    def extend_to(self, end):
+        """the download is resumed later, also get the trades until end"""
+        if end > self.end:
+            self.windows.append(_HistoryWindow(self.end, end))
+            self.end = end
+
+    def run(self, emit):
+        """download everything that is missing and call emit(trades) for
+        each window, newest window first, each list oldest trade first.
+        Returns True when all windows are complete."""
+        cond = threading.Condition()
+        missing = [window for window in self.windows if not window.done]
+        for window in missing:
+            window.failed = False
+        threads = [start_thread(functools.partial(self._walk, window, cond),
+            "history download thread") for window in missing]
+
+        for window in reversed(self.windows):
+            with cond:
+                while not (window.done or window.failed):
+                    cond.wait(1)
+            if window.failed:
+                break
+            if window.trades:
+                emit([{
+                    "tid": tid,
+                    "timestamp": mts // 1000,
+                    "price": price,
+                    "amount": abs(amount)
+                } for (tid, mts, amount, price) in window.trades])
+
+        for thread in threads:
+            thread.join()
+        return all(window.done for window in self.windows)
+
+    def _walk(self, window, cond):
+        """download all pages of one window (runs in its own thread)"""
+        errors = 0
+        try:
+            while not window.done:
+                url = HISTORY_URL % (self.symbol, window.cursor, window.end - 1,
+                    HISTORY_PAGE_LIMIT)
+                parser = JSONArrayStream()
+                page = []
+                for block in http_stream(url, timeout=HISTORY_PAGE_TIMEOUT):
+                    page.extend(parser.feed(block))
+                if not parser.finished:
+                    raise IOError("incomplete page after %d trades" % len(page))
+                if page and page[0] == "error":
+                    self.debug("### history download:", page)
+                    errors += 1
+                    if errors > HISTORY_PAGE_RETRIES:
+                        raise IOError("server error %d times in a row" % errors)
+                    time.sleep(5)
+                    continue
+                errors = 0
+                with cond:
+                    window.add_page(page)
+                    cond.notify_all()
+        except Exception as exc:
+            self.debug("### history download failed, will resume later:", exc)
+            with cond:
+                window.failed = True
+                cond.notify_all()
+
+
+class _HistoryWindow(object):
+    """one time window of a HistoryPager, start <= time < end"""
+
+    def __init__(self, start, end):
+        self.end = end
+        self.cursor = start
+        self.trades = []    # (tid, mts, amount, price), oldest first
+        self.seen = set()   # trade ids already in trades
+        self.done = False
+        self.failed = False
+
+    def add_page(self, page):
+        """add the next page of (ascending) trades, advance the cursor"""
+        for trade in page:
+            if trade[0] not in self.seen:
+                self.seen.add(trade[0])
+                self.trades.append(tuple(trade[:4]))
+        if len(page) < HISTORY_PAGE_LIMIT:
+            self.done = True
+        else:
+            # the next page starts at the time of the last trade (there
+            # can be more trades in the same millisecond), but it must
+            # move on even if a whole page has the same time stamp.
+            last = page[-1][1]
+            self.cursor = max(last, self.cursor + 1)
+
+
 class OHLCV():
     """represents a chart candle. tim is POSIX timestamp of open time,
     prices and volume are integers like in the other parts of the bfx API"""
@@ -1039,20 +2385,134 @@ class OHLCV():
         self.vol += volume
 
 
+class CandleStore(object):
+    """the closed candles of one pair and timeframe in a memory-mapped
+    file of fixed-width records, sorted by time. A header holds the
+    timeframe and the number of records, the file is grown in steps so
+    appending a candle is only a write into the mapping. Candles can
+    also be overwritten or inserted (a download that revises them)."""
+
+    MAGIC = "BFXCNDL1"
+    HEADER = struct.Struct("<8sqq")     # magic, timeframe, count
+    RECORD = struct.Struct("<qddddd")   # tim, opn, hig, low, cls, vol
+    GROW = 4096                         # records to grow the file by
+
+    def __init__(self, filename, timeframe):
+        self.filename = filename
+        self.timeframe = timeframe
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._map = None
+        if os.path.exists(filename):
+            self._file = open(filename, "r+b")
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            (magic, tframe, count) = self.HEADER.unpack_from(self._map, 0)
+            if magic != self.MAGIC or tframe != timeframe:
+                self.close()
+                raise ValueError("%s is not a candle store for timeframe %d"
+                    % (filename, timeframe))
+            self.count = count
+        else:
+            self._file = open(filename, "w+b")
+            self._file.write(self.HEADER.pack(self.MAGIC, timeframe, 0))
+            self._file.truncate(self.HEADER.size + self.GROW * self.RECORD.size)
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def close(self):
+        """unmap and close the file"""
+        if self._map:
+            self._map.close()
+            self._map = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _offset(self, index):
+        """file offset of record number index"""
+        return self.HEADER.size + index * self.RECORD.size
+
+    def _tim(self, index):
+        """time of record number index"""
+        return struct.unpack_from("<q", self._map, self._offset(index))[0]
+
+    def _find(self, tim):
+        """index of the first record with time >= tim"""
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._tim(mid) < tim:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _set_count(self, count):
+        """update the number of records, grow the file if needed"""
+        if self._offset(count) > len(self._map):
+            self._map.close()
+            self._file.truncate(self._offset(count + self.GROW))
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        self.count = count
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self.timeframe, count)
+
+    def last_tim(self):
+        """time of the newest stored candle or None if empty"""
+        if self.count:
+            return self._tim(self.count - 1)
+        return None
+
+    def put(self, candles):
+        """store a list of closed OHLCV candles, oldest first. A candle
+        replaces a stored one with the same time, candles that are older
+        than the newest stored one are inserted at their place."""
+        with self._lock:
+            for candle in candles:
+                index = self._find(candle.tim)
+                if index == self.count or self._tim(index) != candle.tim:
+                    self._set_count(self.count + 1)
+                    if index < self.count - 1:
+                        self._map.move(self._offset(index + 1), self._offset(index),
+                            self._offset(self.count - 1) - self._offset(index))
+                self.RECORD.pack_into(self._map, self._offset(index), candle.tim,
+                    candle.opn, candle.hig, candle.low, candle.cls, candle.vol)
+
+    def load(self):
+        """return all stored candles as list of OHLCV, oldest first"""
+        with self._lock:
+            return [OHLCV(*self.RECORD.unpack_from(self._map, self._offset(index)))
+                for index in range(self.count)]
+
+    def flush(self):
+        """write the changes to disk"""
+        with self._lock:
+            if self._map:
+                self._map.flush()
+
+
 class History(BaseObject):
     """represents the trading history"""
 
-    def __init__(self, bfx, timeframe):
+    def __init__(self, bfx, timeframe, store=None):
         BaseObject.__init__(self)
 
-        self.signal_fullhistory_processed = Signal()
-        self.signal_changed               = Signal()
+        self.signal_fullhistory_processed = Signal(bfx.lock)
+        self.signal_changed               = Signal(bfx.lock)
 
         self.bfx = bfx
         self.candles = []
         self.timeframe = timeframe
 
         self.ready_history = False
+        self._stream_oldest = None # oldest trade of the last download
+
+        # closed candles are saved in the store, the ones from time
+        # _dirty_since on have changed since they were last saved.
+        self.store = store
+        self._dirty_since = None
+        if store:
+            self.candles = list(reversed(store.load()))
 
         bfx.signal_trade.connect(self.slot_trade)
         bfx.signal_fullhistory.connect(self.slot_fullhistory)
@@ -1074,8 +2534,10 @@ class History(BaseObject):
                     self.signal_changed(self, (1))
                 else:
                     self.debug("### opening new candle")
+                    self._mark_dirty(candle.tim)
                     self.add_candle(OHLCV(
                         time_round, price, price, price, price, volume))
+                    self.save_closed()
             else:
                 self.add_candle(OHLCV(
                     time_round, price, price, price, price, volume))
@@ -1084,47 +2546,110 @@ class History(BaseObject):
         """add a new candle to the history but don't fire signal_changed"""
         self.candles.insert(0, candle)
 
+    def _mark_dirty(self, tim):
+        """the candles from time tim on need to be saved again"""
+        if self._dirty_since is None or tim < self._dirty_since:
+            self._dirty_since = tim
+
+    def save_closed(self):
+        """write the closed candles that have changed to the store. The
+        newest candle is still open, it is never saved."""
+        if not self.store or self._dirty_since is None or len(self.candles) < 2:
+            return
+        closed = []
+        for candle in self.candles[1:]:
+            if candle.tim < self._dirty_since:
+                break
+            closed.append(candle)
+        closed.reverse()
+        self.store.put(closed)
+        self._dirty_since = None
+
+    def _get_time_round(self, date):
+        """round timestamp to current candle timeframe"""
+        return int(date / self.timeframe) * self.timeframe
+
     def slot_fullhistory(self, dummy_sender, data):
-        """process the result of the fullhistory request"""
+        """process the result of the fullhistory request. This is a list of
+        trades, oldest first. A streamed download will arrive in several
+        such chunks with the newest chunk first, every chunk that is older
+        than the oldest trade seen so far is a continuation of it."""
         (history) = data
 
         if not len(history):
             self.debug("### history download was empty")
             return
 
-        def get_time_round(date):
-            """round timestamp to current candle timeframe"""
-            return int(date / self.timeframe) * self.timeframe
+        if self._stream_oldest is not None \
+        and int(history[-1]["timestamp"]) <= self._stream_oldest:
+            self._continue_fullhistory(history)
+            return
 
         #remove existing recent candle(s) if any, we will create them fresh
-        date_begin = get_time_round(int(history[0]["timestamp"]))
+        date_begin = self._get_time_round(int(history[0]["timestamp"]))
         while len(self.candles) and self.candles[0].tim >= date_begin:
             self.candles.pop(0)
 
+        candles = self._make_candles(history)
+        for candle in candles:
+            self._add_candle(candle)
+        self._stream_oldest = int(history[0]["timestamp"])
+        self._mark_dirty(date_begin)
+        self.save_closed()
+        self.debug("### got %d updated candle(s)" % len(candles))
+        self.ready_history = True
+        self.signal_fullhistory_processed(self, None)
+        self.signal_changed(self, (self.length()))
+
+    def _continue_fullhistory(self, history):
+        """add the candles of an older chunk of a streamed download. Its
+        newest candle may be the same as the oldest one we got so far"""
+        candles = self._make_candles(history)
+        boundary_tim = self._get_time_round(self._stream_oldest)
+        index = 0
+        while index < len(self.candles) and self.candles[index].tim > boundary_tim:
+            index += 1
+        if index < len(self.candles) and self.candles[index].tim == boundary_tim:
+            boundary = self.candles[index]
+            if candles[-1].tim == boundary_tim:
+                older = candles.pop()
+                boundary.opn = older.opn
+                boundary.hig = max(boundary.hig, older.hig)
+                boundary.low = min(boundary.low, older.low)
+                boundary.vol += older.vol
+            index += 1
+
+        # candles from before the download in this time span are replaced
+        if candles:
+            while index < len(self.candles) and self.candles[index].tim >= candles[0].tim:
+                self.candles.pop(index)
+        self.candles[index:index] = reversed(candles)
+        self._stream_oldest = int(history[0]["timestamp"])
+        self._mark_dirty(self._get_time_round(self._stream_oldest))
+        self.save_closed()
+        self.signal_changed(self, (self.length()))
+
+    def _make_candles(self, history):
+        """make the candles for a list of trades, oldest first"""
+        candles = []
         new_candle = OHLCV(0, 0, 0, 0, 0, 0) #this is a dummy, not actually inserted
-        count_added = 0
         for trade in history:
             date = int(trade["timestamp"])
             price = float(trade["price"])
             volume = float(trade["amount"])
-            time_round = get_time_round(date)
+            time_round = self._get_time_round(date)
             #self.debug("timeround is %d" % time_round)
             #self.debug("new_candle.tim is %d" % new_candle.tim)
             if time_round > new_candle.tim:
                 if new_candle.tim > 0:
-                    self._add_candle(new_candle)
-                    count_added += 1
+                    candles.append(new_candle)
                 new_candle = OHLCV(
-                    time_round, price, price, price, price, volume)
+                    time_round, price, price, price, price, 0)
             new_candle.update(price, volume)
         #self.debug("len of history is %d" % len(history))
-        # insert current (incomplete) candle
-        self._add_candle(new_candle)
-        count_added += 1
-        self.debug("### got %d updated candle(s)" % count_added)
-        self.ready_history = True
-        self.signal_fullhistory_processed(self, None)
-        self.signal_changed(self, (self.length()))
+        # the current (incomplete) candle
+        candles.append(new_candle)
+        return candles
 
     def last_candle(self):
         """return the last (current) candle or None if empty"""
@@ -1145,29 +2670,37 @@ class Bfx(BaseObject):
     events, it will emit signals you can hook into for all events,
     it has methods to buy and sell"""
 
-    def __init__(self, secret, config):
-        """initialize the bfx API but do not yet connect to it."""
+    def __init__(self, secret, config, client_class=None):
+        """initialize the bfx API but do not yet connect to it. The
+        client_class (a BaseClient) can be given to use some other
+        client than the one for the engine selected with FORCE_ENGINE"""
         BaseObject.__init__(self)
 
-        self.signal_depth           = Signal()
-        self.signal_trade           = Signal()
-        self.signal_ticker          = Signal()
-        self.signal_fulldepth       = Signal()
-        self.signal_fullhistory     = Signal()
-        self.signal_wallet          = Signal()
-        self.signal_userorder       = Signal()
-        self.signal_orderlag        = Signal()
-        self.signal_disconnected    = Signal() # socket connection lost
-        self.signal_ready           = Signal() # connected and fully initialized
-
-        self.signal_order_too_fast  = Signal() # don't use that
+        # the lock of all signals of Bfx, its client, orderbook and history
+        # (but not of their signal_debug), their slots are never called
+        # concurrently. It is BFX_LOCK, the default lock of the timers.
+        self.lock = BFX_LOCK
+
+        self.signal_depth           = Signal(self.lock)
+        self.signal_trade           = Signal(self.lock)
+        self.signal_ticker          = Signal(self.lock)
+        self.signal_fulldepth       = Signal(self.lock)
+        self.signal_fullhistory     = Signal(self.lock)
+        self.signal_wallet          = Signal(self.lock)
+        self.signal_userorder       = Signal(self.lock)
+        self.signal_orderlag        = Signal(self.lock)
+        self.signal_disconnected    = Signal(self.lock) # socket connection lost
+        self.signal_ready           = Signal(self.lock) # connected and fully initialized
+
+        self.signal_order_too_fast  = Signal(self.lock) # don't use that
+        self.signal_ratelimit       = Signal(self.lock) # remaining http api budget
 
         self.strategies = weakref.WeakValueDictionary()
 
         # the following are not fired by bfx itself but by the
         # application controlling it to pass some of its events
-        self.signal_keypress        = Signal()
-        self.signal_strategy_unload = Signal()
+        self.signal_keypress        = Signal(self.lock)
+        self.signal_strategy_unload = Signal(self.lock)
 
         self._idkey      = ""
         self.wallet = {}
@@ -1177,6 +2710,7 @@ class Bfx(BaseObject):
         self.socket_lag = 0 # microseconds
         self.last_tid = 0
         self.count_submitted = 0  # number of submitted orders not yet acked
+        self.cancel_pending = {} # int oid: time sent of not yet acked cancels
         self.msg = {} # the incoming message that is currently processed
 
         # the following will be set to true once the information
@@ -1203,7 +2737,15 @@ class Bfx(BaseObject):
         timeframe = 60 * config.get_int("bfx", "history_timeframe")
         if not timeframe:
             timeframe = 60 * 15
-        self.history = History(self, timeframe)
+        store = None
+        if config.get_bool("bfx", "history_store"):
+            filename = "%s.%s%s.%d.candles" % (os.path.splitext(config.filename)[0],
+                self.curr_base, self.curr_quote, timeframe)
+            try:
+                store = CandleStore(filename, timeframe)
+            except (IOError, OSError, ValueError, mmap.error) as exc:
+                logging.warning("not using candle store %s: %s", filename, exc)
+        self.history = History(self, timeframe, store)
         self.history.signal_debug.connect(self.signal_debug)
 
         self.orderbook = OrderBook(self)
@@ -1211,7 +2753,13 @@ class Bfx(BaseObject):
 
         use_websocket = self.config.get_bool("bfx", "use_plain_old_websocket")
         use_websocket = True
-        self.client = WebsocketClient(self.curr_base, self.curr_quote, secret, config)
+        if client_class:
+            self.client = client_class(self.curr_base, self.curr_quote, secret, config)
+        elif FORCE_ENGINE == "eventloop":
+            self.client = EventLoopClient(self.curr_base, self.curr_quote, secret, config)
+        else:
+            self.client = WebsocketClient(self.curr_base, self.curr_quote, secret, config)
+        self.client.share_lock(self.lock)
         #pairs of chanId - channel names
         #http://docs.bitfinex.com/#authenticated-channels73
         #public channels are dynamic
@@ -1223,8 +2771,16 @@ class Bfx(BaseObject):
         self.client.signal_recv.connect(self.slot_recv)
         self.client.signal_fulldepth.connect(self.signal_fulldepth)
         self.client.signal_fullhistory.connect(self.signal_fullhistory)
+        self.client.signal_ratelimit.connect(self.signal_ratelimit)
+
+        # with stored candles only the trades since the newest of them
+        # need to be downloaded, not the whole chart.
+        last_candle = self.history.last_candle()
+        if last_candle:
+            self.debug("### loaded %d stored candle(s)" % self.history.length())
+            self.client.history_last_candle = last_candle.tim
 
-        self.timer_poll = Timer(120)
+        self.timer_poll = Timer(120, lock=self.lock)
         self.timer_poll.connect(self.slot_poll)
 
         self.history.signal_changed.connect(self.slot_history_changed)
@@ -1232,6 +2788,15 @@ class Bfx(BaseObject):
         self.orderbook.signal_fulldepth_processed.connect(self.slot_fulldepth_processed)
         self.orderbook.signal_owns_initialized.connect(self.slot_owns_initialized)
 
+    def replace_lock(self, lock):
+        """use lock instead of self.lock for all signals of Bfx and its
+        client, orderbook and history. Other than at construction time
+        this is only meant for shutting down when a slot is stuck and
+        will never release self.lock again"""
+        replace_signal_lock([self, self.orderbook, self.history], self.lock, lock)
+        self.client.share_lock(lock)
+        self.lock = lock
+
     def start(self):
         """connect to BitFinex and start receiving events."""
         self.debug("### starting bfx streaming API, trading %s%s" %
@@ -1242,12 +2807,23 @@ class Bfx(BaseObject):
         """shutdown the client"""
         self.debug("### shutdown...")
         self.client.stop()
+        if self.history.store:
+            self.history.store.flush()
 
     def order(self, typ, price, volume):
         """place pending order. If price=0 then it will be filled at market"""
         self.count_submitted += 1
         self.client.send_order_add(typ, price, volume)
 
+    def order_batch(self, orders):
+        """place many pending orders at once, orders is a list of (typ,
+        price, volume) tuples. They are sent in as few order/new/multi
+        calls as possible, the acks will arrive for each order separately
+        just as if they had been placed with order()"""
+        self.count_submitted += len(orders)
+        for i in range(0, len(orders), ORDER_MULTI_MAX):
+            self.client.send_order_add_multi(orders[i:i + ORDER_MULTI_MAX])
+
     def buy(self, price, volume):
         """new buy order, if price=0 then buy at market"""
         self.order("bid", price, volume)
@@ -1258,23 +2834,70 @@ class Bfx(BaseObject):
 
     def cancel(self, oid):
         """cancel order"""
-        self.client.send_order_cancel(oid)
+        self.cancel_multi([oid])
+
+    def cancel_multi(self, oids):
+        """cancel many orders with one single call. Orders that already
+        have a cancel pending are skipped."""
+        self._expire_cancel_pending()
+        oids = [int(oid) for oid in oids if oid != ""]
+        oids = [oid for oid in oids if oid not in self.cancel_pending]
+        if not oids:
+            return
+        self._add_cancel_pending(oids)
+        if len(oids) == 1:
+            self.client.send_order_cancel(oids[0])
+        else:
+            self.client.send_order_cancel_multi(oids)
+
+    def replace(self, oid, price, volume):
+        """move an order to a new price and volume. This cancels it and
+        places the new one in one single call, when it is acked the order
+        in orderbook.owns is updated in place and gets the new oid."""
+        self._expire_cancel_pending()
+        oid = int(oid)
+        for order in self.orderbook.owns:
+            if order.oid == oid:
+                if oid in self.cancel_pending:
+                    return
+                self._add_cancel_pending([oid])
+                self.client.send_order_replace(oid, order.typ, price, volume)
+                return
+        self.debug("### cannot replace unknown order", oid)
+
+    def cancel_all(self):
+        """cancel all orders of the account in one call. Unlike
+        cancel_by_type() this also cancels orders of other currency
+        pairs or orders that are not yet in our owns list"""
+        oids = [int(order.oid)
+            for order in self.orderbook.owns if order.oid != ""]
+        self._add_cancel_pending(oids)
+        self.client.send_order_cancel_all(oids)
+
+    def _add_cancel_pending(self, oids):
+        """remember that cancels for these (int) oids have been sent"""
+        now = self.client.clock.time()
+        for oid in oids:
+            self.cancel_pending[oid] = now
+
+    def _expire_cancel_pending(self):
+        """forget the cancels that have not been acked in time, a
+        websocket cancel might never be answered"""
+        expired = self.client.clock.time() - CANCEL_PENDING_TIMEOUT
+        for (oid, sent) in self.cancel_pending.items():
+            if sent < expired:
+                self.debug("### no ack for cancel of", oid)
+                del self.cancel_pending[oid]
 
     def cancel_by_price(self, price):
         """cancel all orders at price"""
-        for i in reversed(range(len(self.orderbook.owns))):
-            order = self.orderbook.owns[i]
-            if order.price == price:
-                if order.oid != "":
-                    self.cancel(order.oid)
+        self.cancel_multi([order.oid for order in self.orderbook.owns
+            if order.price == price and order.oid != ""])
 
     def cancel_by_type(self, typ=None):
         """cancel all orders of type (or all orders if typ=None)"""
-        for i in reversed(range(len(self.orderbook.owns))):
-            order = self.orderbook.owns[i]
-            if typ == None or typ == order.typ:
-                if order.oid != "":
-                    self.cancel(order.oid)
+        self.cancel_multi([order.oid for order in self.orderbook.owns
+            if (typ == None or typ == order.typ) and order.oid != ""])
 
     def base2float(self, int_number):
         """convert base currency values from mtgox integer to float. Base
@@ -1346,6 +2969,16 @@ class Bfx(BaseObject):
         self.orderbook.ready_depth = False
         self.history.ready_history = False
         self._was_disconnected = True
+        self.client.authenticated = False
+        for reqid in self.client.ws_orders_lost():
+            # we can't know whether these have reached the server, the
+            # order list that is requested after reconnect will add
+            # them to owns if they have.
+            self.debug("### no ack for websocket order", reqid)
+            if reqid.startswith("order_add:"):
+                self.count_submitted -= 1
+            else:
+                self.cancel_pending.pop(int(reqid.split(":")[1]), None)
         self.signal_disconnected(self, None)
 
     def slot_recv(self, dummy_sender, data):
@@ -1387,8 +3020,16 @@ class Bfx(BaseObject):
             #then we handle it as orders, account_info, balances messages
             if msg['reqid'] == "orders":
                 self._on_http_reqid_orders(msg)
+            elif "order_add_multi" in msg['reqid']:
+                self._on_http_reqid_order_add_multi(msg)
             elif "order_add" in msg['reqid']:
                 self._on_http_reqid_order_add(msg)
+            elif "order_replace" in msg['reqid']:
+                self._on_http_reqid_order_replace(msg)
+            elif "order_cancel_multi" in msg['reqid']:
+                self._on_http_reqid_order_cancel_multi(msg)
+            elif msg['reqid'].startswith("order_cancel_all"):
+                self._on_http_reqid_order_cancel_all(msg)
             elif "order_cancel" in msg['reqid']:
                 self._on_http_reqid_order_cancel(msg)
             elif msg['reqid'] == "account_infos":
@@ -1422,6 +3063,11 @@ class Bfx(BaseObject):
         self.debug("### subscribed channel", msg["channel"], msg["chanId"])
         self.channels[msg['chanId']] = msg['channel']
 
+    def _on_event_auth(self, msg):
+        """handle the answer to the websocket authentication"""
+        self.debug("### auth", msg.get("status"), msg.get("msg", ""))
+        self.client.authenticated = (msg.get("status") == "OK")
+
     def _on_event_info(self, msg):
         """handle info message of bitfinex"""
         self.debug("### info", msg)
@@ -1572,6 +3218,10 @@ class Bfx(BaseObject):
             self.debug("### catched the WALLET UPDATE in websocket")
             self._on_channel_auth_wu(msg)
 
+        elif type_code == 'n':
+            self.debug("### catched a NOTIFICATION in websocket")
+            self._on_channel_auth_n(msg)
+
         elif type_code == 'tu':
             self.debug("### catched the TRADE EXECUTION UPDATE in websocket")
         elif type_code == 'te':
@@ -1618,6 +3268,65 @@ class Bfx(BaseObject):
         self.signal_wallet(self, None)
 
 
+    def _on_channel_auth_n(self, msg):
+        """
+        notification, this is how orders sent over the websocket are acked
+        [
+           0,
+           "n",
+           [
+              "<MTS>",
+              "<TYPE>",     on-req, oc-req, ou-req, ...
+              "<MESSAGE_ID>",
+              null,
+              [<ORDER>],    ID, GID, CID, SYMBOL, MTS_CREATE, MTS_UPDATE,
+                            AMOUNT, AMOUNT_ORIG, TYPE, TYPE_PREV, ..., PRICE
+              "<CODE>",
+              "<STATUS>",   SUCCESS, ERROR, FAILURE
+              "<TEXT>"
+           ]
+        ]
+        The ack is translated into the answer of the equivalent http api
+        call and then handled by the same code as that. Fields can be null,
+        if a successful ack does not tell enough about the order to track
+        it then it is handled as failed and the order list is requested
+        again, the order will be in there.
+        """
+        notification = msg[2]
+        ntype = notification[1]
+        order = notification[4]
+        status = notification[6]
+        if not isinstance(order, list) or len(order) < 17:
+            self.debug("### ignoring notification without order", notification)
+            return
+        if ntype == "on-req":
+            reqid = self.client.ws_order_acked(order[2])
+        elif ntype in ("oc-req", "ou-req"):
+            reqid = self.client.ws_order_acked(order[0])
+        else:
+            return
+        if reqid is None:
+            # not sent by us
+            return
+
+        if status == "SUCCESS":
+            try:
+                amount = float(order[7])
+                data = {
+                    "id": int(order[0]),
+                    "symbol": order[3][1:].lower(),
+                    "price": float(order[16]),
+                    "original_amount": abs(amount),
+                    "side": {True: "buy", False: "sell"}[amount > 0],
+                }
+            except (TypeError, ValueError):
+                self.debug("### incomplete ack for websocket order", reqid, order)
+                data = {"message": "incomplete ack, requesting the order list"}
+                self.client.request_orders()
+        else:
+            data = {"message": notification[7]}
+        self.slot_recv(self, (json.dumps({"reqid": reqid, "data": data})))
+
     def _on_channel_auth_on(self, msg):
 
         self.debug("### ON Event")
@@ -1674,10 +3383,55 @@ class Bfx(BaseObject):
         #self.debug(msg)
 
     def _on_http_reqid_orders(self, msg):
-        self.debug("ORDERS")
+        """the list of open orders. It is requested after connect and
+        whenever it is unclear whether an order has reached the server,
+        owns is brought in line with it. Orders that have been added or
+        removed after the list was requested are left alone, the list
+        might not show that yet."""
+        since = self.client.orders_requested
+        self.client.orders_requested = None
+        answer = msg["data"]
+        if not isinstance(answer, list):
+            self.debug("### orders failed:", answer)
+            return
         self.debug("### got own order list")
         self.debug(msg)
 
+        removed = self.orderbook.owns_removed
+        if since is not None:
+            for oid in [oid for (oid, tim) in removed.items() if tim < since]:
+                del removed[oid]
+        symb = ("%s%s" % (self.curr_base, self.curr_quote)).lower()
+        listed = set()
+        for order in answer:
+            if order["symbol"] != symb:
+                continue
+            oid = int(order["id"])
+            listed.add(oid)
+            if oid in removed or self.orderbook.have_own_oid(oid):
+                continue
+            # placed but never acked, for example after a timeout
+            self.debug("### found untracked order", oid)
+            self.signal_userorder(self, (
+                float(order["price"]),
+                float(order["remaining_amount"]),
+                {"buy": "bid", "sell": "ask"}[order["side"]],
+                oid, "open"))
+        if since is not None:
+            for order in list(self.orderbook.owns):
+                if order.oid not in listed and order.time < since:
+                    # filled while we were not looking, or cancelled
+                    # by a request whose answer got lost
+                    status = "removed:completed_passive"
+                    if order.oid in self.cancel_pending:
+                        status = "removed:requested"
+                    self.debug("### order %s is gone" % order.oid)
+                    self.signal_userorder(self, (0, 0, "", order.oid, status))
+
+        if not self.orderbook.ready_owns:
+            self.orderbook.ready_owns = True
+            self.orderbook.signal_owns_initialized(self.orderbook, None)
+
     def _on_http_reqid_balances(self, msg):
         #self.debug("BALANCES")
         self.debug("### got balances")
@@ -1700,6 +3454,10 @@ class Bfx(BaseObject):
     def _on_http_reqid_order_add(self, msg):
 
         order = msg["data"]
+        if "message" in order:
+            self.debug("### order/new failed:", order["message"])
+            self.count_submitted -= 1
+            return
         # these are limit orders.
         #
         # we also need to check whether they belong to our own bfx instance,
@@ -1732,9 +3490,39 @@ class Bfx(BaseObject):
 
         self.debug(msg)
 
+    def _on_http_reqid_order_add_multi(self, msg):
+        """ack for a batch of orders, split it into one order/new
+        ack for every single order and handle them one by one. Orders
+        of the batch that are missing in the answer have been rejected,
+        they are handled like a failed order/new each."""
+        answer = msg["data"]
+        accepted = []
+        if isinstance(answer, dict) and "order_ids" in answer:
+            accepted = answer["order_ids"]
+        else:
+            self.debug("### order/new/multi failed:", answer)
+        for order in accepted:
+            self._on_http_reqid_order_add({
+                "reqid": msg["reqid"],
+                "data": order
+            })
+        message = "rejected in order/new/multi"
+        if isinstance(answer, dict) and "message" in answer:
+            message = answer["message"]
+        rejected = int(msg["reqid"].split(":")[1]) - len(accepted)
+        for _ in range(rejected):
+            self._on_http_reqid_order_add({
+                "reqid": msg["reqid"],
+                "data": {"message": message}
+            })
+
     def _on_http_reqid_order_cancel(self, msg):
         #self.debug("ORDER_CANCEL")
+        self.cancel_pending.pop(int(msg["reqid"].split(":")[1]), None)
         order = msg["data"]
+        if "message" in order:
+            self.debug("### order/cancel failed:", order["message"])
+            return
         oid = order["id"]
         # these are remove messages (cancel or fill)
         # here it is a bit more expensive to check whether they belong to
@@ -1755,6 +3543,46 @@ class Bfx(BaseObject):
 
         self.debug(msg)
 
+    def _on_http_reqid_order_replace(self, msg):
+        """ack for order/cancel/replace, the answer is the new order"""
+        old_oid = int(msg["reqid"].split(":")[1])
+        self.cancel_pending.pop(old_oid, None)
+        order = msg["data"]
+        if "id" not in order:
+            self.debug("### order/cancel/replace failed:", order)
+            return
+        price = float(order["price"])
+        volume = float(order["original_amount"])
+        typ = {"buy": "bid", "sell": "ask"}[order["side"]]
+        self.debug("### got ack for order/cancel/replace:",
+            old_oid, "->", order["id"], typ, price, volume)
+        self.orderbook.replace_own(old_oid,
+            Order(price, volume, typ, order["id"], "open"))
+
+    def _on_http_reqid_order_cancel_multi(self, msg):
+        """ack for order/cancel/multi, it does not contain the oids,
+        we know them from the reqid"""
+        oids = [int(oid) for oid in msg["reqid"].split(":")[1].split(",")]
+        self._on_cancel_ack(oids, msg["data"])
+
+    def _on_http_reqid_order_cancel_all(self, msg):
+        """ack for order/cancel/all, the orders we had when it was sent
+        are gone now, we know them from the reqid"""
+        oids = [int(oid) for oid in msg["reqid"].split(":")[1].split(",") if oid]
+        self._on_cancel_ack(oids, msg["data"])
+
+    def _on_cancel_ack(self, oids, answer):
+        """a bulk cancel has been answered, remove the orders"""
+        for oid in oids:
+            self.cancel_pending.pop(oid, None)
+        if isinstance(answer, dict) and "message" in answer:
+            self.debug("### bulk cancel failed:", answer["message"])
+            return
+        for oid in oids:
+            if self.orderbook.have_own_oid(oid):
+                self.signal_userorder(self, (0, 0, "", oid, "removed:requested"))
+        self.debug(answer)
+
     def _on_op_error(self, msg):
         """handle error mesages (op:error)"""
         self.debug("### _on_op_error()", msg)
@@ -1988,6 +3816,7 @@ class Bfx(BaseObject):
         """server complains too many orders were placd too fast"""
         self.debug("### Server said: '%s" % msg["message"])
         self.count_submitted -= 1
+        self.client.rate_limit_exceeded("orders")
         self.signal_order_too_fast(self, msg)
 
 
@@ -2013,6 +3842,7 @@ class Order:
         self.typ = typ
         self.oid = oid
         self.status = status
+        self.time = CLOCK.time() # when we have learned about it
 
 class OrderBook(BaseObject):
     """represents the orderbook. Each Bfx instance has one
@@ -2025,7 +3855,7 @@ class OrderBook(BaseObject):
         BaseObject.__init__(self)
         self.bfx = bfx
 
-        self.signal_changed             = Signal()
+        self.signal_changed             = Signal(bfx.lock)
         """orderbook state has changed
         param: None
         an update to the state of the orderbook happened, this is emitted very
@@ -2033,27 +3863,27 @@ class OrderBook(BaseObject):
         also after every user_order message. This signal is for example used
         in bfxtool.py to repaint the user interface of the orderbook window."""
 
-        self.signal_fulldepth_processed = Signal()
+        self.signal_fulldepth_processed = Signal(bfx.lock)
         """fulldepth download is complete
         param: None
         The orderbook (fulldepth) has been downloaded from the server.
         This happens soon after connect."""
 
-        self.signal_owns_initialized    = Signal()
+        self.signal_owns_initialized    = Signal(bfx.lock)
         """own order list has been initialized
         param: None
         The owns list has been initialized. This happens soon after connect
         after it has downloaded the authoritative list of pending and open
         orders. This will also happen if it reinitialized after lost connection."""
 
-        self.signal_owns_changed        = Signal()
+        self.signal_owns_changed        = Signal(bfx.lock)
         """owns list has changed
         param: None
         an update to the owns list has happened, this can be order added,
         removed or filled, status or volume of an order changed. For specific
         changes to individual orders see the signal_own_* signals below."""
 
-        self.signal_own_added           = Signal()
+        self.signal_own_added           = Signal(bfx.lock)
         """order was added
         param: (order)
         order is a reference to the Order() instance
@@ -2062,7 +3892,7 @@ class OrderBook(BaseObject):
         some time later there will be signal_own_opened when the status
         changed to open."""
 
-        self.signal_own_removed         = Signal()
+        self.signal_own_removed         = Signal(bfx.lock)
         """order has been removed
         param: (order, reason)
         order is a reference to the Order() instance
@@ -2074,7 +3904,7 @@ class OrderBook(BaseObject):
         reliable way to determine that a trade has fully completed because the
         trade signal alone won't tell you whether its partial or complete"""
 
-        self.signal_own_opened          = Signal()
+        self.signal_own_opened          = Signal(bfx.lock)
         """order status went to "open"
         param: (order)
         order is a reference to the Order() instance
@@ -2083,7 +3913,7 @@ class OrderBook(BaseObject):
         market orders can't have an "open" status, they never move beyond
         "executing", they just execute and emit volume and removed signals."""
 
-        self.signal_own_volume          = Signal()
+        self.signal_own_volume          = Signal(bfx.lock)
         """order volume changed (partial fill)
         param: (order, voldiff)
         order is a reference to the Order() instance
@@ -2107,6 +3937,7 @@ class OrderBook(BaseObject):
 
         self.ready_depth = False
         self.ready_owns = False
+        self.owns_removed = {} # oid: time of recently removed own orders
 
         self.last_change_type = None # ("bid", "ask", None) this can be used
         self.last_change_price = 0   # for highlighting relative changes
@@ -2227,6 +4058,10 @@ class OrderBook(BaseObject):
 
                     # remove it from owns...
                     self.owns.pop(i)
+                    if self.bfx.client.orders_requested is not None:
+                        # the order list that is on its way might
+                        # still contain it, see Bfx._on_http_reqid_orders
+                        self.owns_removed[oid] = CLOCK.time()
 
                     # ...and update own volume cache in the bids or asks
                     self._update_level_own_volume(
@@ -2290,7 +4125,10 @@ class OrderBook(BaseObject):
             #     ]
             #]
 
-            reason = self.bfx.msg[2][5]
+            reason = status
+            msg = self.bfx.msg
+            if isinstance(msg, list) and len(msg) > 2 and msg[1] == "oc":
+                reason = msg[2][5]
             self.signal_own_removed(self, (order, reason))
         if opened:
             self.signal_own_opened(self, (order))
@@ -2602,6 +4440,31 @@ class OrderBook(BaseObject):
             self.signal_changed(self, None)
             self.signal_owns_changed(self, None)
 
+    def replace_own(self, old_oid, new_order):
+        """called by bfx when an order/cancel/replace has been acked. The
+        old order is moved to the price and volume of new_order in place,
+        it keeps its position in the owns list and gets the new oid"""
+        for order in self.owns:
+            if order.oid == old_oid:
+                self.debug("### replacing order %s with %s" % (old_oid, new_order.oid),
+                    "price:", self.bfx.quote2str(new_order.price))
+                old_price = order.price
+                order.oid = new_order.oid
+                order.price = new_order.price
+                order.volume = new_order.volume
+                order.status = new_order.status
+                self._update_level_own_volume(
+                    order.typ, old_price, self.get_own_volume_at(old_price, order.typ))
+                self._update_level_own_volume(
+                    order.typ, order.price, self.get_own_volume_at(order.price, order.typ))
+                self.signal_changed(self, None)
+                self.signal_owns_changed(self, None)
+                return
+
+        # the old one was already removed (filled?) before
+        # the ack came back, so this is just a new order now
+        self.add_own(new_order)
+
     def _add_own(self, order):
         """add order to the list of own orders. This method is used during
         initial download of complete order list."""
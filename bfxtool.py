@@ -24,14 +24,17 @@ framework for experimenting with trading bots
 # pylint: disable=C0301,C0302,R0902,R0903,R0912,R0913,R0914,R0915,R0922,W0703
 
 import argparse
+import copy
 import curses
 import curses.panel
 import curses.textpad
 
 import bfxapi
+import journal
 import logging
 import locale
 import math
+import new
 import os
 import sys
 import time
@@ -90,6 +93,84 @@ INI_DEFAULTS =  [["bfxtool", "set_xterm_title", "True"]
 
 COLOR_PAIR = {}
 
+# curses is not thread safe, all threads that paint hold this lock. It
+# is independent of the lock of the bfx signals, painting never holds
+# bfx.lock, the market data is painted from a copy (see BfxSnapshot).
+# Never acquire bfx.lock while holding this one, slots that write to the
+# console do it the other way round.
+SCREEN_LOCK = threading.RLock()
+
+# the Painter that repaints the windows when their data has changed,
+# without one (benchmark.py) the windows are repainted immediately
+PAINTER = None
+
+def copy_all(objects):
+    """shallow copies of the objects (instances of classic classes
+    like Level), this is a lot faster than copy.copy() for each"""
+    return [new.instance(obj.__class__, obj.__dict__.copy()) for obj in objects]
+
+class BfxSnapshot(object):
+    """a copy of the market data of bfx for painting. It is taken with
+    bfx.lock held, only for as long as copying takes, painting it then
+    won't hold up the receive thread. Only the newest candles are
+    copied. Everything that is not copied (config, currencies, the
+    number formatting methods) is taken from bfx itself"""
+
+    def __init__(self, bfx, candles):
+        self._bfx = bfx
+        self.wallet = dict(bfx.wallet)
+        self.orderbook = copy.copy(bfx.orderbook)
+        self.orderbook.bids = copy_all(bfx.orderbook.bids)
+        self.orderbook.asks = copy_all(bfx.orderbook.asks)
+        self.orderbook.owns = copy_all(bfx.orderbook.owns)
+        self.history = copy.copy(bfx.history)
+        self.history.candles = copy_all(bfx.history.candles[:candles])
+
+    def __getattr__(self, name):
+        return getattr(self._bfx, name)
+
+class Painter(object):
+    """repaints windows in a thread of its own. The slots that want a
+    window repainted are called with bfx.lock held, painting there would
+    hold up the receive thread until curses is done, so they only ask
+    for it with Win.request_paint(). Repaints that are requested while
+    the painter is busy are done once afterwards."""
+
+    def __init__(self):
+        self._dirty = []
+        self._cond = threading.Condition()
+        self._terminating = False
+        bfxapi.start_thread(self._thread_func, "painter")
+
+    def request(self, win):
+        """repaint win soon"""
+        with self._cond:
+            if win not in self._dirty:
+                self._dirty.append(win)
+                self._cond.notify()
+
+    def stop(self):
+        """stop painting, repaints that have not been done are dropped"""
+        with self._cond:
+            self._terminating = True
+            self._dirty = []
+            self._cond.notify()
+
+    def _thread_func(self):
+        """paint the windows that have been requested"""
+        while True:
+            with self._cond:
+                while not (self._dirty or self._terminating):
+                    self._cond.wait()
+                if self._terminating:
+                    return
+                (dirty, self._dirty) = (self._dirty, [])
+            for win in dirty:
+                try:
+                    win.do_paint()
+                except Exception: # pylint: disable=W0703
+                    bfxapi.Signal.signal_error(self, (traceback.format_exc()))
+
 def init_colors():
     """initialize curses color pairs and give them names. The color pair
     can then later quickly be retrieved from the COLOR_PAIR[] dict"""
@@ -121,26 +202,40 @@ def dump_all_stacks():
                 ret += "  %s\n" % (line.strip())
     return ret
 
-def try_get_lock_or_break_open():
-    """this is an ugly hack to workaround possible deadlock problems.
-    It is used during shutdown to make sure we can properly exit even when
-    some slot is stuck (due to a programming error) and won't release the lock.
-    If we can't acquire it within 2 seconds we just break it open forcefully."""
-    #pylint: disable=W0212
-    time_end = time.time() + 2
+def acquire_within(lock, timeout):
+    """try to acquire the lock for timeout seconds, return False if
+    that did not succeed"""
+    time_end = time.time() + timeout
     while time.time() < time_end:
-        if bfxapi.Signal._lock.acquire(False):
-            return
+        if lock.acquire(False):
+            return True
         time.sleep(0.001)
+    return False
+
+def try_get_lock_or_break_open(bfx):
+    """this is an ugly hack to workaround possible deadlock problems.
+    It is used during shutdown to make sure we can properly exit even when
+    some slot is stuck (due to a programming error) and won't release the
+    lock of the bfx signals or the screen lock. If we can't acquire them
+    within 2 seconds each we just break them open forcefully."""
+    global SCREEN_LOCK # pylint: disable=W0603
 
-    # something keeps holding the lock, apparently some slot is stuck
+    # if something keeps holding a lock, apparently some slot is stuck
     # in an infinite loop. In order to be able to shut down anyways
     # we just throw away that lock and replace it with a new one
-    lock = threading.RLock()
-    lock.acquire()
-    bfxapi.Signal._lock = lock
-    print "### could not acquire signal lock, frozen slot somewhere?"
-    print "### please see the stacktrace log to determine the cause."
+    if bfx and not acquire_within(bfx.lock, 2):
+        lock = threading.RLock()
+        lock.acquire()
+        bfx.replace_lock(lock)
+        print "### could not acquire signal lock, frozen slot somewhere?"
+        print "### please see the stacktrace log to determine the cause."
+
+    if not acquire_within(SCREEN_LOCK, 2):
+        lock = threading.RLock()
+        lock.acquire()
+        SCREEN_LOCK = lock
+        print "### could not acquire screen lock, frozen paint somewhere?"
+        print "### please see the stacktrace log to determine the cause."
 
 class Win:
     """represents a curses window"""
@@ -161,10 +256,11 @@ class Win:
         self.__create_win()
 
     def __del__(self):
-        del self.panel
-        del self.win
-        curses.panel.update_panels()
-        curses.doupdate()
+        with SCREEN_LOCK:
+            del self.panel
+            del self.win
+            curses.panel.update_panels()
+            curses.doupdate()
 
     def calc_size(self):
         """override this method to change posx, posy, width, height.
@@ -172,11 +268,28 @@ class Win:
         pass
 
     def do_paint(self):
-        """call this if you want the window to repaint itself"""
-        curses.curs_set(0)
-        if self.win:
-            self.paint()
-            self.done_paint()
+        """call this if you want the window to repaint itself now. The
+        data is copied first (take_snapshot()), only the painting holds
+        the SCREEN_LOCK. Slots must use request_paint() instead."""
+        self.take_snapshot()
+        with SCREEN_LOCK:
+            curses.curs_set(0)
+            if self.win:
+                self.paint()
+                self.done_paint()
+
+    def request_paint(self):
+        """let the PAINTER call do_paint() soon"""
+        if PAINTER:
+            PAINTER.request(self)
+        else:
+            self.do_paint()
+
+    def take_snapshot(self):
+        """copy the data that paint() needs. Override this if it
+        needs data that other threads change, paint() must then
+        use only the copy"""
+        pass
 
     # method could be a function - pylint: disable=R0201
     def done_paint(self):
@@ -198,7 +311,9 @@ class Win:
         """You must call this method from your main loop when the
         terminal has been resized. It will subsequently make it
         recalculate its own new size and then call its paint() method"""
-        del self.win
+        with SCREEN_LOCK:
+            # not del, the painter thread may look at it meanwhile
+            self.win = None
         self.__create_win()
 
     def addstr(self, *args):
@@ -237,10 +352,11 @@ class Win:
         windows won't be moved, they will be deleted and recreated."""
         self.__calc_size()
         try:
-            self.win = curses.newwin(self.height, self.width, self.posy, self.posx)
-            self.panel = curses.panel.new_panel(self.win)
-            self.win.scrollok(True)
-            self.win.keypad(1)
+            with SCREEN_LOCK:
+                self.win = curses.newwin(self.height, self.width, self.posy, self.posx)
+                self.panel = curses.panel.new_panel(self.win)
+                self.win.scrollok(True)
+                self.win.keypad(1)
             self.do_paint()
         except Exception:
             self.win = None
@@ -317,8 +433,9 @@ class WinConsole(Win):
             col = COLOR_PAIR["con_text_buy"] + curses.A_BOLD
         if "trade: ask:" in txt:
             col = COLOR_PAIR["con_text_sell"] + curses.A_BOLD
-        self.win.addstr("\n" + txt,  col)
-        self.done_paint()
+        with SCREEN_LOCK:
+            self.win.addstr("\n" + txt,  col)
+            self.done_paint()
 
 
 class WinOrderBook(Win):
@@ -337,6 +454,11 @@ class WinOrderBook(Win):
         self.posy = HEIGHT_STATUS
         self.width = WIDTH_ORDERBOOK
 
+    def take_snapshot(self):
+        """copy the orderbook and the current candle"""
+        with self.bfx.lock:
+            self.data = BfxSnapshot(self.bfx, 1)
+
     def paint(self):
         """paint the visible portion of the orderbook"""
 
@@ -356,7 +478,7 @@ class WinOrderBook(Win):
         self.win.bkgd(" ",  COLOR_PAIR["book_text"])
         self.win.erase()
 
-        bfx = self.bfx
+        bfx = self.data
         book = bfx.orderbook
 
         mid = self.height / 2
@@ -533,13 +655,13 @@ class WinOrderBook(Win):
                 paint_row(pos, price, vol, ownvol, col_bid, changevol)
 
         # update the xterm title bar
-        if self.bfx.config.get_bool("bfxtool", "set_xterm_title"):
-            last_candle = self.bfx.history.last_candle()
+        if self.data.config.get_bool("bfxtool", "set_xterm_title"):
+            last_candle = self.data.history.last_candle()
             if last_candle:
-                title = self.bfx.quote2str(last_candle.cls).strip()
+                title = self.data.quote2str(last_candle.cls).strip()
                 title += " - bfxtool -"
-                title += " bid:" + self.bfx.quote2str(book.bid).strip()
-                title += " ask:" + self.bfx.quote2str(book.ask).strip()
+                title += " bid:" + self.data.quote2str(book.bid).strip()
+                title += " ask:" + self.data.quote2str(book.ask).strip()
 
                 term = os.environ["TERM"]
                 # the following is incomplete but better safe than sorry
@@ -550,7 +672,7 @@ class WinOrderBook(Win):
 
     def slot_changed(self, _book, _dummy):
         """Slot for orderbook.signal_changed"""
-        self.do_paint()
+        self.request_paint()
 
 
 TYPE_HISTORY = 1
@@ -563,7 +685,8 @@ class WinChart(Win):
         self.bfx = bfx
         self.pmin = 0
         self.pmax = 0
-        self.change_type = None
+        self.change_type = None # what paint() has to repaint
+        self._pending_change = TYPE_HISTORY # what has changed since
         bfx.history.signal_changed.connect(self.slot_history_changed)
         bfx.orderbook.signal_changed.connect(self.slot_orderbook_changed)
 
@@ -585,6 +708,19 @@ class WinChart(Win):
         self.width = self.termwidth - WIDTH_ORDERBOOK
         self.height = self.termheight - HEIGHT_CON - HEIGHT_STATUS
 
+    def resize(self):
+        """the new window has to be painted completely"""
+        self._pending_change = TYPE_HISTORY
+        Win.resize(self)
+
+    def take_snapshot(self):
+        """copy the orderbook and the visible candles, together with
+        what has changed since the last time"""
+        with self.bfx.lock:
+            self.data = BfxSnapshot(self.bfx, self.width)
+            self.change_type = self._pending_change
+            self._pending_change = None
+
     def is_in_range(self, price):
         """is this price in the currently visible range?"""
         return price <= self.pmax and price >= self.pmin
@@ -617,12 +753,12 @@ class WinChart(Win):
         pmax to determine how many digits are needed so that all numbers
         will be nicely aligned at the decimal point"""
 
-        fprice = self.bfx.quote2float(price)
+        fprice = self.data.quote2float(price)
         labelstr = ("%f" % fprice).rstrip("0").rstrip(".")
 
         # look at pmax to determine the max number of digits before the decimal
         # and then pad all smaller prices with spaces to make them align nicely.
-        need_digits = int(math.log10(self.bfx.quote2float(self.pmax))) + 1
+        need_digits = int(math.log10(self.data.quote2float(self.pmax))) + 1
         have_digits = len(str(int(fprice)))
         if have_digits < need_digits:
             padding = " " * (need_digits - have_digits)
@@ -659,7 +795,7 @@ class WinChart(Win):
                 self.addch(posy, posx, curses.ACS_VLINE, COLOR_PAIR["chart_text"])
 
     def paint(self):
-        typ = self.bfx.config.get_string("bfxtool", "display_right")
+        typ = self.data.config.get_string("bfxtool", "display_right")
         if typ == "history_chart":
             self.paint_history_chart()
         elif typ == "depth_chart":
@@ -671,7 +807,7 @@ class WinChart(Win):
         """paint a depth chart"""
 
         # pylint: disable=C0103
-        if self.bfx.curr_quote in "JPY SEK":
+        if self.data.curr_quote in "JPY SEK":
             BAR_LEFT_EDGE = 7
             FORMAT_STRING = "%6.0f"
         else:
@@ -686,7 +822,7 @@ class WinChart(Win):
                 col = col_ask + curses.A_BOLD
             else:
                 col = col_bar
-            pricestr = FORMAT_STRING % self.bfx.quote2float(price)
+            pricestr = FORMAT_STRING % self.data.quote2float(price)
             self.addstr(pos, 0, pricestr, col_price)
             length = int(vol * mult_x)
             # pylint: disable=E1101
@@ -697,7 +833,7 @@ class WinChart(Win):
         self.win.bkgd(" ",  COLOR_PAIR["chart_text"])
         self.win.erase()
 
-        book = self.bfx.orderbook
+        book = self.data.orderbook
         if not (book.bid and book.ask and len(book.bids) and len(book.asks)):
             # orderbook is not initialized yet, paint nothing
             return
@@ -707,17 +843,17 @@ class WinChart(Win):
         col_ask = COLOR_PAIR["book_ask"]
         col_own = COLOR_PAIR["book_own"]
 
-        group = self.bfx.config.get_float("bfxtool", "depth_chart_group")
+        group = self.data.config.get_float("bfxtool", "depth_chart_group")
         if group == 0:
             group = 1
-        group = self.bfx.quote2int(group)
+        group = self.data.quote2int(group)
 
         max_vol_ask = 0
         max_vol_bid = 0
         bin_asks = []
         bin_bids = []
         mid = self.height / 2
-        sum_total = self.bfx.config.get_bool("bfxtool", "depth_chart_sum_total")
+        sum_total = self.data.config.get_bool("bfxtool", "depth_chart_sum_total")
 
         #
         #
@@ -749,7 +885,7 @@ class WinChart(Win):
         bin_price = int(math.floor(float(book.bids[0].price) / group) * group)
         while pos < self.height and bin_price >= 0:
             _bin_vol_base, bin_vol_quote = book.get_total_up_to(bin_price, False)
-            bin_vol = self.bfx.base2int(bin_vol_quote / book.bid)
+            bin_vol = self.data.base2int(bin_vol_quote / book.bid)
             if bin_vol > prev_vol:
                 # add only non-empty bins
                 if sum_total:
@@ -784,7 +920,7 @@ class WinChart(Win):
                             break
 
         # highlight the relative change (optional)
-        if self.bfx.config.get_bool("bfxtool", "highlight_changes"):
+        if self.data.config.get_bool("bfxtool", "highlight_changes"):
             price = book.last_change_price
             if book.last_change_type == "ask":
                 bin_price = int(math.ceil(float(price) / group) * group)
@@ -818,8 +954,8 @@ class WinChart(Win):
             self.win.bkgd(" ",  COLOR_PAIR["chart_text"])
             self.win.erase()
 
-        hist = self.bfx.history
-        book = self.bfx.orderbook
+        hist = self.data.history
+        book = self.data.orderbook
 
         self.pmax = 0
         self.pmin = 9999999999
@@ -891,15 +1027,14 @@ class WinChart(Win):
 
     def slot_history_changed(self, _sender, _data):
         """Slot for history changed"""
-        self.change_type = TYPE_HISTORY
-        self.do_paint()
-        self.change_type = None
+        self._pending_change = TYPE_HISTORY
+        self.request_paint()
 
     def slot_orderbook_changed(self, _sender, _data):
         """Slot for orderbook changed"""
-        self.change_type = TYPE_ORDERBOOK
-        self.do_paint()
-        self.change_type = None
+        if self._pending_change is None:
+            self._pending_change = TYPE_ORDERBOOK
+        self.request_paint()
 
 
 class WinStatus(Win):
@@ -920,28 +1055,33 @@ class WinStatus(Win):
         """place it at the top of the terminal"""
         self.height = HEIGHT_STATUS
 
+    def take_snapshot(self):
+        """copy the wallet and the orderbook"""
+        with self.bfx.lock:
+            self.data = BfxSnapshot(self.bfx, 0)
+
     def sort_currency_list_if_changed(self):
         """sort the currency list in the wallet for better display,
         sort it only if it has changed, otherwise leave it as it is"""
-        currency_list = self.bfx.wallet.keys()
+        currency_list = self.data.wallet.keys()
         if len(currency_list) == len(self.sorted_currency_list):
             return
 
         # now we will bring base and quote currency to the front and sort the
         # the rest of the list of names by acount balance in descending order
-        if self.bfx.curr_base in currency_list:
-            currency_list.remove(self.bfx.curr_base)
-        if self.bfx.curr_quote in currency_list:
-            currency_list.remove(self.bfx.curr_quote)
-        currency_list.sort(key=lambda name: -self.bfx.wallet[name])
-        currency_list.insert(0, self.bfx.curr_quote)
-        currency_list.insert(0, self.bfx.curr_base)
+        if self.data.curr_base in currency_list:
+            currency_list.remove(self.data.curr_base)
+        if self.data.curr_quote in currency_list:
+            currency_list.remove(self.data.curr_quote)
+        currency_list.sort(key=lambda name: -self.data.wallet[name])
+        currency_list.insert(0, self.data.curr_quote)
+        currency_list.insert(0, self.data.curr_base)
         self.sorted_currency_list = currency_list
 
     def paint(self):
         """paint the complete status"""
-        cbase = self.bfx.curr_base
-        cquote = self.bfx.curr_quote
+        cbase = self.data.curr_base
+        cquote = self.data.curr_quote
         self.sort_currency_list_if_changed()
         self.win.bkgd(" ", COLOR_PAIR["status_text"])
         self.win.erase()
@@ -953,12 +1093,12 @@ class WinStatus(Win):
         line1 += "Account: "
         if len(self.sorted_currency_list):
             for currency in self.sorted_currency_list:
-                if currency in self.bfx.wallet:
+                if currency in self.data.wallet:
                     #line1 += currency + " " \
-                    #+ bfxapi.int2str(self.bfx.wallet[currency], currency).strip() \
+                    #+ bfxapi.int2str(self.data.wallet[currency], currency).strip() \
                     #+ " + "
                     line1 += currency + " " \
-                    + "%f" % self.bfx.wallet[currency] \
+                    + "%f" % self.data.wallet[currency] \
                     + " + "
             line1 = line1.strip(" +")
         else:
@@ -968,12 +1108,12 @@ class WinStatus(Win):
         # second line
         #
         line2 = ""
-        if self.bfx.config.get_bool("bfxtool", "show_orderbook_stats"):
-            str_btc = locale.format('%d', self.bfx.orderbook.total_ask, 1)
-            str_fiat = locale.format('%d', self.bfx.orderbook.total_bid, 1)
-            if self.bfx.orderbook.total_ask:
+        if self.data.config.get_bool("bfxtool", "show_orderbook_stats"):
+            str_btc = locale.format('%d', self.data.orderbook.total_ask, 1)
+            str_fiat = locale.format('%d', self.data.orderbook.total_bid, 1)
+            if self.data.orderbook.total_ask:
                 str_ratio = locale.format('%1.2f',
-                    self.bfx.orderbook.total_bid / self.bfx.orderbook.total_ask, 1)
+                    self.data.orderbook.total_bid / self.data.orderbook.total_ask, 1)
             else:
                 str_ratio = "-"
 
@@ -982,20 +1122,20 @@ class WinStatus(Win):
             line2 += "ratio: %s %s/%s " % (str_ratio, cquote, cbase)
 
         #line2 += "o_lag: %s | " % self.order_lag_txt
-        #line2 += "s_lag: %.3f s" % (self.bfx.socket_lag / 1e6)
+        #line2 += "s_lag: %.3f s" % (self.data.socket_lag / 1e6)
         self.addstr(0, 0, line1, COLOR_PAIR["status_text"])
         self.addstr(1, 0, line2, COLOR_PAIR["status_text"])
 
 
     def slot_changed(self, dummy_sender, dummy_data):
         """the callback funtion called by the Bfx() instance"""
-        self.do_paint()
+        self.request_paint()
 
     def slot_orderlag(self, dummy_sender, (usec, text)):
         """slot for order_lag mesages"""
         self.order_lag = usec
         self.order_lag_txt = text
-        self.do_paint()
+        self.request_paint()
 
 
 class DlgListItems(Win):
@@ -1112,8 +1252,9 @@ class DlgCancelOrders(DlgListItems):
         DlgListItems.__init__(self, stdscr, 45, "Cancel order(s)", hlp, keys)
 
     def init_items(self):
-        for order in self.bfx.orderbook.owns:
-            self.items.append(order)
+        with self.bfx.lock:
+            for order in self.bfx.orderbook.owns:
+                self.items.append(order)
         self.items.sort(key = lambda o: -o.price)
 
     def paint_item(self, posy, index):
@@ -1140,18 +1281,13 @@ class DlgCancelOrders(DlgListItems):
     def _do_cancel(self):
         """cancel all selected orders (or the order under cursor if empty)"""
 
-        def do_cancel(order):
-            """cancel a single order"""
-            self.bfx.cancel(order.oid)
-
         if not len(self.items):
             return
         if not len(self.selected):
             order = self.items[self.item_sel]
-            do_cancel(order)
+            self.bfx.cancel(order.oid)
         else:
-            for order in self.selected:
-                do_cancel(order)
+            self.bfx.cancel_multi([order.oid for order in self.selected])
 
 
 class TextBox():
@@ -1206,8 +1342,7 @@ class TextBox():
         position. This is only a cosmetic problem but very annnoying. Try to
         force it into the edit field by repainting it very often."""
         while self.editing:
-            # pylint: disable=W0212
-            with bfxapi.Signal._lock:
+            with SCREEN_LOCK:
                 curses.curs_set(2)
                 self.win.touchwin()
                 self.win.refresh()
@@ -1442,8 +1577,7 @@ class StrategyManager():
 
 def toggle_setting(bfx, alternatives, option_name, direction):
     """toggle a setting in the ini file"""
-    # pylint: disable=W0212
-    with bfxapi.Signal._lock:
+    with bfx.lock:
         setting = bfx.config.get_string("bfxtool", option_name)
         try:
             newindex = (alternatives.index(setting) + direction) % len(alternatives)
@@ -1484,8 +1618,7 @@ def toggle_depth_sum(bfx):
 
 def set_ini(bfx, setting, value, signal, signal_sender, signal_params):
     """set the ini value and then send a signal"""
-    # pylint: disable=W0212
-    with bfxapi.Signal._lock:
+    with bfx.lock:
         bfx.config.set("bfxtool", setting, value)
         bfx.config.save()
     signal(signal_sender, signal_params)
@@ -1503,6 +1636,7 @@ def main():
     debug_tb = []
     def curses_loop(stdscr):
         """Only the code inside this function runs within the curses wrapper"""
+        global PAINTER # pylint: disable=W0603
 
         # this function may under no circumstancs raise an exception, so I'm
         # wrapping everything into try/except (should actually never happen
@@ -1511,13 +1645,18 @@ def main():
         # We have a list debug_tb[] where we can append tracebacks and
         # after curses uninitialized properly and the terminal is restored
         # we can print them.
+        bfx = None
         try:
             init_colors()
             bfx = bfxapi.Bfx(secret, config)
 
             logwriter = LogWriter(bfx)
             printhook = PrintHook(bfx)
+            recorder = None
+            if args.record:
+                recorder = journal.JournalRecorder(bfx.client, args.record)
 
+            PAINTER = Painter()
             conwin = WinConsole(stdscr, bfx)
             bookwin = WinOrderBook(stdscr, bfx)
             statuswin = WinStatus(stdscr, bfx)
@@ -1537,14 +1676,13 @@ def main():
                 elif key == curses.KEY_F6:
                     DlgCancelOrders(stdscr, bfx).modal()
                 elif key == curses.KEY_RESIZE:
-                    # pylint: disable=W0212
-                    with bfxapi.Signal._lock:
+                    with SCREEN_LOCK:
                         stdscr.erase()
                         stdscr.refresh()
-                        conwin.resize()
-                        bookwin.resize()
-                        chartwin.resize()
-                        statuswin.resize()
+                    conwin.resize()
+                    bookwin.resize()
+                    chartwin.resize()
+                    statuswin.resize()
                 elif key == ord("l"):
                     strategy_manager.reload()
 
@@ -1595,10 +1733,12 @@ def main():
         with open("logs/bfxtool.stacktrace.log", "w") as stacklog:
             stacklog.write(dump_all_stacks())
 
-        # we need the signal lock to be able to shut down. And we cannot
-        # wait for any frozen slot to return, so try really hard to get
-        # the lock and if that fails then unlock it forcefully.
-        try_get_lock_or_break_open()
+        # we need the signal lock and the screen lock to be able to shut
+        # down. And we cannot wait for any frozen slot to return, so try
+        # really hard to get them and if that fails unlock them forcefully.
+        try_get_lock_or_break_open(bfx)
+        if PAINTER:
+            PAINTER.stop()
 
         # Now trying to shutdown everything in an orderly manner.it in the
         # Since we are still inside curses but we don't know whether
@@ -1616,6 +1756,12 @@ def main():
         except Exception:
             debug_tb.append(traceback.format_exc())
 
+        try:
+            if recorder:
+                recorder.close()
+        except Exception:
+            debug_tb.append(traceback.format_exc())
+
         try:
             printhook.close()
         except Exception:
@@ -1649,6 +1795,10 @@ def main():
         help="name of strategy module files, comma separated list, default=strategy.py")
     argp.add_argument('--protocol', action="store", default="",
         help="force protocol (socketio or websocket), ignore setting in .ini")
+    argp.add_argument('--engine', action="store", default="threads",
+        choices=["threads", "eventloop"],
+        help="threads: one thread per connection and timer (default), "
+            +"eventloop: everything on one single threaded event loop")
     argp.add_argument('--no-fulldepth', action="store_true", default=False,
         help="do not download full depth (useful for debugging)")
     argp.add_argument('--no-depth', action="store_true", default=False,
@@ -1657,6 +1807,8 @@ def main():
         help="do not request order-lag updates, useful for low traffic")
     argp.add_argument('--no-history', action="store_true", default=False,
         help="do not download full history (useful for debugging)")
+    argp.add_argument('--record', action="store", default=None,
+        help="record all received market data into this journal file")
     argp.add_argument('--use-http', action="store_true", default=False,
         help="use http api for trading (more reliable, recommended")
     argp.add_argument('--no-http', action="store_true", default=False,
@@ -1679,6 +1831,7 @@ def main():
     else:
         strat_mod_list = args.strategy.split(",")
         bfxapi.FORCE_PROTOCOL = args.protocol
+        bfxapi.FORCE_ENGINE = args.engine
         bfxapi.FORCE_NO_FULLDEPTH = args.no_fulldepth
         bfxapi.FORCE_NO_DEPTH = args.no_depth
         bfxapi.FORCE_NO_LAG = args.no_lag
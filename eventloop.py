@@ -0,0 +1,559 @@
+"""
+eventloop - single threaded select() event loop for bfxtool
+
+This is a small reactor that runs timers, callbacks and socket readiness
+handlers in one thread, plus a non-blocking keep-alive HTTPS client that
+runs on top of it. It is used by bfxapi.EventLoopClient to drive the
+websocket, the http api calls and the client timers without a separate
+thread for each of them.
+"""
+
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+# pylint: disable=R0902,R0903,W0703
+
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+import traceback
+import zlib
+
+import websocket
+
+
+class Handle(object):
+    """a callback scheduled on the event loop, can be canceled"""
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.canceled = False
+
+    def cancel(self):
+        """cancel the callback, it will not be called anymore"""
+        self.canceled = True
+
+    def run(self):
+        """call the callback unless it has been canceled"""
+        if not self.canceled:
+            self.func(*self.args)
+
+
+def _set_nonblocking(fd):
+    """put the file descriptor fd into non-blocking mode"""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class EventLoop(object):
+    """a select() based event loop. All methods except call_soon_threadsafe()
+    and stop() must be called from within the loop thread itself (from a
+    callback or before run_forever() was called). Exceptions raised by
+    callbacks are passed to on_error() and don't stop the loop."""
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._scheduled = []
+        self._ready = collections.deque()
+        self._threadsafe = collections.deque()
+        self._counter = itertools.count()
+        self._running = False
+        self._thread_ident = None
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        _set_nonblocking(self._wakeup_read)
+        _set_nonblocking(self._wakeup_write)
+        self.add_reader(self._wakeup_read, self._read_wakeup)
+
+        # called with a traceback string when a callback raised
+        self.on_error = None
+
+    def time(self):
+        """the current time of the loop (POSIX timestamp)"""
+        return time.time()
+
+    def in_loop_thread(self):
+        """are we currently running inside the loop thread?"""
+        return self._thread_ident == threading.current_thread().ident
+
+    def call_soon(self, func, *args):
+        """call func(*args) in the next iteration of the loop"""
+        handle = Handle(0, func, args)
+        self._ready.append(handle)
+        return handle
+
+    def call_soon_threadsafe(self, func, *args):
+        """like call_soon() but can be called from any other thread,
+        it will wake up the loop if it is waiting in select()"""
+        handle = Handle(0, func, args)
+        self._threadsafe.append(handle)
+        try:
+            os.write(self._wakeup_write, "x")
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+        return handle
+
+    def call_later(self, delay, func, *args):
+        """call func(*args) after delay seconds. Returns a Handle"""
+        handle = Handle(self.time() + delay, func, args)
+        heapq.heappush(self._scheduled, (handle.when, next(self._counter), handle))
+        return handle
+
+    def add_reader(self, fd, func, *args):
+        """call func(*args) whenever fd is readable"""
+        self.remove_reader(fd)
+        self._readers[fd] = Handle(0, func, args)
+
+    def remove_reader(self, fd):
+        """stop watching fd for readability"""
+        # cancel it because it might already be in the ready queue
+        handle = self._readers.pop(fd, None)
+        if handle:
+            handle.cancel()
+
+    def add_writer(self, fd, func, *args):
+        """call func(*args) whenever fd is writable"""
+        self.remove_writer(fd)
+        self._writers[fd] = Handle(0, func, args)
+
+    def remove_writer(self, fd):
+        """stop watching fd for writability"""
+        handle = self._writers.pop(fd, None)
+        if handle:
+            handle.cancel()
+
+    def stop(self):
+        """stop the loop, can be called from any thread"""
+        self.call_soon_threadsafe(self._stop)
+
+    def _stop(self):
+        """stop the loop (runs in the loop thread)"""
+        self._running = False
+
+    def _read_wakeup(self):
+        """empty the wakeup pipe"""
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def _run_handle(self, handle):
+        """run a callback and report exceptions"""
+        try:
+            handle.run()
+        except Exception:
+            if self.on_error:
+                self.on_error(traceback.format_exc())
+
+    def run_forever(self):
+        """run the loop until stop() is called"""
+        self._thread_ident = threading.current_thread().ident
+        self._running = True
+        while self._running:
+            self._run_once()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def _run_once(self):
+        """one iteration: wait for sockets or the next timer, then run
+        everything that is due"""
+        if self._ready or self._threadsafe:
+            timeout = 0
+        elif self._scheduled:
+            timeout = max(0, self._scheduled[0][0] - self.time())
+        else:
+            timeout = None
+
+        try:
+            readable, writable, _ = select.select(
+                self._readers.keys(), self._writers.keys(), [], timeout)
+        except select.error as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            readable, writable = [], []
+
+        for fd in readable:
+            handle = self._readers.get(fd, None)
+            if handle:
+                self._ready.append(handle)
+        for fd in writable:
+            handle = self._writers.get(fd, None)
+            if handle:
+                self._ready.append(handle)
+
+        while self._threadsafe:
+            self._ready.append(self._threadsafe.popleft())
+
+        now = self.time()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            self._ready.append(heapq.heappop(self._scheduled)[2])
+
+        # callbacks added while running these will run in the next iteration
+        for _ in range(len(self._ready)):
+            self._run_handle(self._ready.popleft())
+
+
+class HTTPError(Exception):
+    """the http request could not be completed"""
+    pass
+
+
+class _Request(object):
+    """a queued http request"""
+
+    def __init__(self, method, path, body, headers, callback, resend):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers
+        self.callback = callback
+        self.resend = resend
+        self.retried = False
+
+
+class HTTPSClient(object):
+    """non-blocking keep-alive HTTPS connection to one host on an EventLoop.
+    Requests are sent one after the other over the same connection in the
+    order they were made, so signed calls reach the server in nonce order.
+    The callback is called as callback(error, status, body), error is None
+    on success, body is already gunzipped."""
+
+    def __init__(self, loop, host, port=443, ssl_context=None, timeout=30,
+                 user_agent=None):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self._ssl_context = ssl_context
+        self._queue = collections.deque()
+        self._current = None
+        self._sock = None
+        self._fd = None
+        self._address = None    # (family, sockaddr) of host, once resolved
+        self._resolving = False
+        self._reused = False
+        self._timeout_handle = None
+        self._outbuf = ""
+        self._inbuf = ""
+        self._status = None
+        self._resp_headers = None
+        self._body = None
+
+    def request(self, method, path, body, headers, callback, resend=True):
+        """queue a request, it will be sent as soon as the connection
+        is free. Must be called from within the loop thread. If resend
+        is False it is never sent a second time, not even when the
+        connection was found closed, because the server might have
+        processed it already"""
+        self._queue.append(_Request(method, path, body, headers, callback, resend))
+        if self._current is None:
+            self._next()
+
+    def close(self):
+        """close the connection, the request in flight will fail
+        and all queued requests are dropped"""
+        self._queue.clear()
+        self._fail(HTTPError("connection closed"), False)
+
+    def _next(self):
+        """start the next queued request"""
+        if not self._queue:
+            return
+        self._current = self._queue.popleft()
+        self._timeout_handle = self.loop.call_later(self.timeout, self._on_timeout)
+        if self._sock is None:
+            self._connect()
+        else:
+            self._reused = True
+            self._send_request()
+
+    def _connect(self):
+        """start a non-blocking connect, continue in _on_connected(). The
+        host name is looked up in a helper thread, getaddrinfo() blocks,
+        and the address is kept for all later connects."""
+        self._reused = False
+        if self._address is None:
+            if not self._resolving:
+                self._resolving = True
+                thread = threading.Thread(target=self._resolve_thread_func,
+                    name="https resolve thread")
+                thread.daemon = True
+                thread.start()
+            return
+        (family, address) = self._address
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.setblocking(0)
+        self._fd = self._sock.fileno()
+        err = self._sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._address = None
+            self._fail(socket.error(err, os.strerror(err)))
+            return
+        self.loop.add_writer(self._fd, self._on_connected)
+
+    def _resolve_thread_func(self):
+        """look up the address of host (runs in its own thread)"""
+        try:
+            info = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+            self.loop.call_soon_threadsafe(self._on_resolved, (info[0], info[4]), None)
+        except socket.error as exc:
+            self.loop.call_soon_threadsafe(self._on_resolved, None, exc)
+
+    def _on_resolved(self, address, exc):
+        """the address of host has been looked up (or it failed), connect
+        if a request is still waiting for the connection"""
+        self._resolving = False
+        self._address = address
+        if self._current is None or self._sock is not None:
+            return
+        if exc:
+            self._fail(exc)
+        else:
+            self._connect()
+
+    def _on_connected(self):
+        """the socket is connected (or failed to), start TLS handshake"""
+        self.loop.remove_writer(self._fd)
+        err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            # maybe the address has changed, look it up again next time
+            self._address = None
+            self._fail(socket.error(err, os.strerror(err)))
+            return
+        # pylint: disable=W0212
+        context = self._ssl_context or websocket._get_ssl_context()
+        self._sock = context.wrap_socket(self._sock, server_hostname=self.host,
+                                         do_handshake_on_connect=False)
+        self._do_handshake()
+
+    def _do_handshake(self):
+        """continue the non-blocking TLS handshake"""
+        self.loop.remove_reader(self._fd)
+        self.loop.remove_writer(self._fd)
+        try:
+            self._sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.loop.add_reader(self._fd, self._do_handshake)
+            return
+        except ssl.SSLWantWriteError:
+            self.loop.add_writer(self._fd, self._do_handshake)
+            return
+        except Exception as exc:
+            self._fail(exc)
+            return
+        self._send_request()
+
+    def _send_request(self):
+        """format the request and start sending it"""
+        req = self._current
+        lines = ["%s %s HTTP/1.1" % (req.method, req.path),
+                 "Host: %s" % self.host,
+                 "Accept-Encoding: gzip",
+                 "Connection: keep-alive"]
+        if self.user_agent:
+            lines.append("User-Agent: %s" % self.user_agent)
+        for key, value in (req.headers or {}).items():
+            lines.append("%s: %s" % (key, value))
+        body = req.body or ""
+        if body or req.method == "POST":
+            lines.append("Content-Length: %d" % len(body))
+        self._outbuf = "\r\n".join(lines) + "\r\n\r\n" + body
+        self._inbuf = ""
+        self._status = None
+        self._resp_headers = None
+        self._body = None
+        self.loop.remove_reader(self._fd)
+        self._on_writable()
+
+    def _on_writable(self):
+        """send as much of the request as the socket accepts"""
+        self.loop.remove_writer(self._fd)
+        try:
+            while self._outbuf:
+                sent = self._sock.send(self._outbuf)
+                self._outbuf = self._outbuf[sent:]
+        except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            self.loop.add_writer(self._fd, self._on_writable)
+            return
+        except socket.error as exc:
+            if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.loop.add_writer(self._fd, self._on_writable)
+                return
+            self._fail(exc)
+            return
+        self.loop.add_reader(self._fd, self._on_readable)
+
+    def _on_readable(self):
+        """read what is available and try to parse the response"""
+        eof = False
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    eof = True
+                    break
+                self._inbuf += data
+        except ssl.SSLWantReadError:
+            pass
+        except socket.error as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(exc)
+                return
+
+        if self._current is None:
+            # readable while idle, the server has closed the connection
+            if eof:
+                self._close_socket()
+            return
+
+        try:
+            done = self._parse(eof)
+        except Exception as exc:
+            self._fail(exc)
+            return
+        if done:
+            self._finish()
+        elif eof:
+            self._fail(HTTPError("connection closed by server"))
+
+    def _parse(self, eof):
+        """parse the response in _inbuf, return True when complete"""
+        if self._status is None:
+            pos = self._inbuf.find("\r\n\r\n")
+            if pos < 0:
+                return False
+            head = self._inbuf[:pos].split("\r\n")
+            self._inbuf = self._inbuf[pos + 4:]
+            self._status = int(head[0].split(" ", 2)[1])
+            self._resp_headers = {}
+            for line in head[1:]:
+                key, value = line.split(":", 1)
+                self._resp_headers[key.strip().lower()] = value.strip()
+
+        headers = self._resp_headers
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            return self._parse_chunked()
+        if "content-length" in headers:
+            length = int(headers["content-length"])
+            if len(self._inbuf) < length:
+                return False
+            self._body = self._inbuf[:length]
+            self._inbuf = self._inbuf[length:]
+            return True
+        if eof:
+            self._body = self._inbuf
+            self._inbuf = ""
+            headers["connection"] = "close"
+            return True
+        return False
+
+    def _parse_chunked(self):
+        """parse a chunked body, return True when complete"""
+        chunks = []
+        pos = 0
+        while True:
+            end = self._inbuf.find("\r\n", pos)
+            if end < 0:
+                return False
+            size = int(self._inbuf[pos:end].split(";")[0], 16)
+            if size == 0:
+                trailer = self._inbuf.find("\r\n\r\n", end)
+                if trailer < 0:
+                    return False
+                self._body = "".join(chunks)
+                self._inbuf = self._inbuf[trailer + 4:]
+                return True
+            start = end + 2
+            if len(self._inbuf) < start + size + 2:
+                return False
+            chunks.append(self._inbuf[start:start + size])
+            pos = start + size + 2
+
+    def _finish(self):
+        """the response is complete, call back and start the next one"""
+        req = self._current
+        self._current = None
+        self._cancel_timeout()
+        body = self._body
+        if self._resp_headers.get("content-encoding", "") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if self._resp_headers.get("connection", "").lower() == "close":
+            self._close_socket()
+        self._callback(req, None, self._status, body)
+        self._next()
+
+    def _fail(self, exc, retry=True):
+        """the current request failed. A request that failed on a reused
+        keep-alive connection before anything was received is retried once
+        on a new connection (the server may have closed it while idle),
+        unless it must not be sent again."""
+        req = self._current
+        self._current = None
+        self._cancel_timeout()
+        reused = self._reused
+        self._close_socket()
+        if req is not None:
+            received = self._status is not None or self._inbuf
+            if retry and req.resend and reused and not req.retried and not received:
+                req.retried = True
+                self._queue.appendleft(req)
+            else:
+                self._callback(req, exc, None, None)
+        self._next()
+
+    def _on_timeout(self):
+        """the current request took too long"""
+        self._timeout_handle = None
+        self._fail(HTTPError("timeout after %i seconds" % self.timeout), False)
+
+    def _cancel_timeout(self):
+        """cancel the timeout of the current request"""
+        if self._timeout_handle:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+
+    def _close_socket(self):
+        """close the socket and stop watching it"""
+        if self._sock is not None:
+            self.loop.remove_reader(self._fd)
+            self.loop.remove_writer(self._fd)
+            try:
+                self._sock.close()
+            except Exception:
+                pass
+            self._sock = None
+            self._fd = None
+
+    def _callback(self, req, error, status, body):
+        """call the callback of the request, report exceptions"""
+        try:
+            req.callback(error, status, body)
+        except Exception:
+            if self.loop.on_error:
+                self.loop.on_error(traceback.format_exc())
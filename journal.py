@@ -0,0 +1,590 @@
+"""
+journal - compact append-only recording of the raw market data for bfxtool
+
+The JournalRecorder connects to the signals of a bfxapi client and writes
+every raw message it receives (websocket messages and http answers from
+signal_recv, and the fulldepth and fullhistory downloads) into a journal
+file, each record with the time it was received. Records are collected
+into blocks that are compressed with zlib, a small index file with one
+entry per block makes it possible to seek by time without decompressing
+the whole journal. JournalReader reads it back.
+
+Replay feeds a journal into a Bfx instance that has a ReplayClient
+instead of a real one, as fast as possible or at a multiple of the
+recorded speed, so strategies can be run over recorded market data.
+With a BacktestClient the orders of the strategies are executed on a
+simulated account.
+"""
+
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+# pylint: disable=R0902,R0903,W0703
+
+import bisect
+import json
+import logging
+import os
+import Queue
+import struct
+import threading
+import time
+import zlib
+
+import bfxapi
+
+# the record kinds, what signal of the client it has been received from
+KIND_RECV = 0           # signal_recv, a websocket message or http answer
+KIND_FULLDEPTH = 1      # signal_fulldepth
+KIND_FULLHISTORY = 2    # signal_fullhistory
+
+BLOCK_MAGIC = "BFXJ"
+BLOCK_HEADER = struct.Struct("<4sIIdd")   # magic, size, count, first, last
+RECORD_HEADER = struct.Struct("<dBI")     # timestamp, kind, size
+INDEX_ENTRY = struct.Struct("<ddQI")      # first, last, offset, count
+
+BLOCK_SIZE = 256 * 1024     # uncompressed bytes that make a full block
+FLUSH_INTERVAL = 5          # seconds after which a block is written anyways
+
+
+def index_filename(filename):
+    """the name of the index file that belongs to a journal"""
+    return filename + ".idx"
+
+
+class JournalRecorder(object):
+    """records everything the client receives into the journal filename.
+    The slots only put the message into a queue, compressing and writing
+    happens in a separate thread, so the receiving thread will never
+    have to wait for the disk. New records are appended to an existing
+    journal."""
+
+    def __init__(self, client, filename, level=6):
+        self.client = client
+        self.filename = filename
+        self.level = level
+        self._queue = Queue.Queue()
+        self._journal = open(filename, "ab")
+        self._index = open(index_filename(filename), "ab")
+        if self._journal.tell():
+            self._repair()
+        self._thread = threading.Thread(None, self._write_thread_func,
+            "journal writer thread")
+        self._thread.daemon = True
+        self._thread.start()
+
+        client.signal_recv.connect(self.slot_recv)
+        client.signal_fulldepth.connect(self.slot_fulldepth)
+        client.signal_fullhistory.connect(self.slot_fullhistory)
+
+    def close(self):
+        """stop recording, write what is still queued and close the files"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _repair(self):
+        """cut off a block that was not written completely when the last
+        recording was killed and bring the index up to date, new blocks
+        are then appended behind the last complete block."""
+        reader = JournalReader(self.filename)
+        self._journal.truncate(reader.end)
+        self._journal.seek(0, os.SEEK_END)
+        self._index.truncate(0)
+        self._index.seek(0)
+        for entry in reader.index:
+            self._index.write(INDEX_ENTRY.pack(*entry))
+        self._index.flush()
+
+    def slot_recv(self, _sender, data):
+        """slot for client.signal_recv, data is the raw message string"""
+        self._queue.put((time.time(), KIND_RECV, data))
+
+    def slot_fulldepth(self, _sender, data):
+        """slot for client.signal_fulldepth"""
+        self._queue.put((time.time(), KIND_FULLDEPTH, data))
+
+    def slot_fullhistory(self, _sender, data):
+        """slot for client.signal_fullhistory"""
+        self._queue.put((time.time(), KIND_FULLHISTORY, data))
+
+    def _write_thread_func(self):
+        """collect records into blocks and write them"""
+        parts = []
+        size = 0
+        first = last = 0
+        started = 0
+        while True:
+            try:
+                item = self._queue.get(True, FLUSH_INTERVAL)
+            except Queue.Empty:
+                item = False
+            if item:
+                (tim, kind, data) = item
+                if isinstance(data, unicode):
+                    data = data.encode("utf-8")
+                elif not isinstance(data, str):
+                    # the downloads arrive already decoded
+                    data = json.dumps(data, separators=(",", ":"))
+                if not parts:
+                    first = tim
+                    started = time.time()
+                last = tim
+                parts.append(RECORD_HEADER.pack(tim, kind, len(data)))
+                parts.append(data)
+                size += RECORD_HEADER.size + len(data)
+            if parts and (item is None or size >= BLOCK_SIZE
+                    or time.time() - started >= FLUSH_INTERVAL):
+                self._write_block("".join(parts), len(parts) // 2, first, last)
+                parts = []
+                size = 0
+            if item is None:
+                break
+        self._journal.close()
+        self._index.close()
+
+    def _write_block(self, data, count, first, last):
+        """compress and append one block and its index entry"""
+        try:
+            body = zlib.compress(data, self.level)
+            offset = self._journal.tell()
+            self._journal.write(BLOCK_HEADER.pack(
+                BLOCK_MAGIC, len(body), count, first, last))
+            self._journal.write(body)
+            self._journal.flush()
+            self._index.write(INDEX_ENTRY.pack(first, last, offset, count))
+            self._index.flush()
+        except (IOError, OSError) as exc:
+            logging.error("journal %s: could not write block: %s",
+                self.filename, exc)
+
+
+class JournalReader(object):
+    """reads a journal written by JournalRecorder. The index is used to
+    find the first block for a given time, if the index is missing or
+    incomplete (the recorder was killed) it is rebuilt from the journal"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.end = 0    # file offset behind the last complete block
+        self.index = self._read_index()
+
+    def _read_index(self):
+        """return the list of index entries (first, last, offset, count)"""
+        entries = []
+        try:
+            with open(index_filename(self.filename), "rb") as index:
+                data = index.read()
+            for pos in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+                entries.append(INDEX_ENTRY.unpack_from(data, pos))
+        except IOError:
+            pass
+
+        # scan the part of the journal that is not in the index
+        offset = 0
+        if entries:
+            offset = entries[-1][2]
+            entries.pop()
+        filesize = os.path.getsize(self.filename)
+        with open(self.filename, "rb") as journal:
+            journal.seek(offset)
+            while True:
+                header = journal.read(BLOCK_HEADER.size)
+                if len(header) < BLOCK_HEADER.size:
+                    break
+                (magic, size, count, first, last) = BLOCK_HEADER.unpack(header)
+                if magic != BLOCK_MAGIC:
+                    raise ValueError("%s: no block at offset %d" % (self.filename, offset))
+                if offset + BLOCK_HEADER.size + size > filesize:
+                    break # a block that was not written completely
+                journal.seek(size, os.SEEK_CUR)
+                entries.append((first, last, offset, count))
+                offset = journal.tell()
+        self.end = offset
+        return entries
+
+    def count(self):
+        """total number of records in the journal"""
+        return sum(entry[3] for entry in self.index)
+
+    def time_range(self):
+        """(first, last) timestamp of the journal or None if empty"""
+        if self.index:
+            return (self.index[0][0], self.index[-1][1])
+        return None
+
+    def records(self, since=None, until=None):
+        """generate (timestamp, kind, data) for all records, optionally
+        only those with since <= timestamp < until. The data of the
+        fulldepth and fullhistory records is the decoded json."""
+        start = 0
+        if since is not None:
+            start = bisect.bisect_left([entry[1] for entry in self.index], since)
+        with open(self.filename, "rb") as journal:
+            for (_first, _last, offset, _count) in self.index[start:]:
+                journal.seek(offset)
+                (_magic, size, count, first, _last) = BLOCK_HEADER.unpack(
+                    journal.read(BLOCK_HEADER.size))
+                if until is not None and first >= until:
+                    return
+                data = zlib.decompress(journal.read(size))
+                pos = 0
+                for _ in range(count):
+                    (tim, kind, length) = RECORD_HEADER.unpack_from(data, pos)
+                    pos += RECORD_HEADER.size
+                    if since is not None and tim < since:
+                        pos += length
+                        continue
+                    if until is not None and tim >= until:
+                        return
+                    payload = data[pos:pos + length]
+                    pos += length
+                    if kind != KIND_RECV:
+                        payload = json.loads(payload)
+                    yield (tim, kind, payload)
+
+    def __iter__(self):
+        return self.records()
+
+
+class ReplayConfig(bfxapi.BfxConfig):
+    """a BfxConfig that is read from the ini file but never saved to it,
+    whatever a replay changes in it must not end up in the live setup"""
+
+    _DEFAULTS = bfxapi.BfxConfig._DEFAULTS + [
+                 ["backtest", "balance_base", "0"]
+                ,["backtest", "balance_quote", "1000"]
+                ,["backtest", "fee", "0.1"]
+                ]
+
+    def save(self):
+        """don't save"""
+        pass
+
+
+class ReplayClient(bfxapi.BaseClient):
+    """a client that does not open any connections. Everything it
+    receives comes from Replay, everything it would send to the
+    exchange is dropped."""
+
+    def start(self):
+        """no connection, the journal contains everything"""
+        self.connected = True
+        self.signal_connected(self, None)
+
+    def stop(self):
+        """stop the client"""
+        self._terminating = True
+        self.connected = False
+        self._timer.cancel()
+
+    def send(self, json_str):
+        """nothing is sent in a replay"""
+        pass
+
+    def enqueue_http_request(self, api_endpoint, params, reqid):
+        """nothing is sent in a replay"""
+        pass
+
+    def request_fulldepth(self):
+        """the full depth is in the journal"""
+        pass
+
+    def request_history(self):
+        """the history is in the journal"""
+        pass
+
+    def channel_subscribe(self, download_market_data=True):
+        """the subscriptions are in the journal"""
+        pass
+
+    def force_reconnect(self):
+        """there is no connection"""
+        pass
+
+    def slot_timer(self, _sender, _data):
+        """there is no connection to watch"""
+        pass
+
+    def replay(self, kind, data):
+        """emit the signal that a record of this kind was recorded from"""
+        if kind == KIND_RECV:
+            self.signal_recv(self, (data))
+        elif kind == KIND_FULLDEPTH:
+            self.signal_fulldepth(self, (data))
+        elif kind == KIND_FULLHISTORY:
+            self.signal_fullhistory(self, (data))
+
+
+class BacktestClient(ReplayClient):
+    """a ReplayClient with a simulated exchange account. The order api
+    calls are answered like the http api would answer them, a limit
+    order is filled completely at its price as soon as a recorded trade
+    reaches that price, the fill is reported on the authenticated
+    channel like a real one. The answers are delivered after the record
+    that is being replayed, not from within the call. The balances and
+    the fee (percent) are in the [backtest] section of the config."""
+
+    def __init__(self, curr_base, curr_quote, secret, config):
+        ReplayClient.__init__(self, curr_base, curr_quote, secret, config)
+        self.balance = {
+            curr_base: config.get_float("backtest", "balance_base"),
+            curr_quote: config.get_float("backtest", "balance_quote")
+        }
+        self.start_balance = dict(self.balance)
+        self.fee = config.get_float("backtest", "fee") / 100
+        self.orders = {}        # oid: (typ, price, volume)
+        self.last_price = 0
+        self.count_orders = 0
+        self.count_cancels = 0
+        self.count_fills = 0
+        self.volume_bought = 0
+        self.volume_sold = 0
+        self.fees_paid = 0
+        self._next_oid = 1
+        self._trade_channels = set()
+        self._answers = []
+
+    def start(self):
+        """connected, the account balances arrive right away"""
+        ReplayClient.start(self)
+        self.request_info()
+        self._deliver()
+
+    def enqueue_http_request(self, api_endpoint, params, reqid):
+        """answer the api call from the simulated account"""
+        handler = getattr(self, "_api_" + api_endpoint.replace("/", "_"), None)
+        answer = handler(params) if handler else {"message": "not simulated"}
+        self._answers.append(self._translate_http_answer(reqid, answer))
+
+    def replay(self, kind, data):
+        """replay the record, then let the simulated exchange react"""
+        if kind == KIND_RECV:
+            msg = json.loads(data)
+            if isinstance(msg, dict):
+                if msg.get("event") == "subscribed" and msg.get("channel") == "trades":
+                    self._trade_channels.add(msg["chanId"])
+                elif "reqid" in msg:
+                    return # the recorded account, not ours
+            elif msg[0] == 0:
+                return # the recorded account, not ours
+        ReplayClient.replay(self, kind, data)
+        self._deliver()
+        if kind == KIND_RECV and isinstance(msg, list) and len(msg) == 5 \
+                and msg[0] in self._trade_channels:
+            self._match(float(msg[3]))
+            self._deliver()
+
+    def _deliver(self):
+        """emit the answers that are waiting"""
+        while self._answers:
+            self.signal_recv(self, (json.dumps(self._answers.pop(0))))
+
+    def _available(self, currency):
+        """balance that is not reserved for open orders"""
+        available = self.balance[currency]
+        for (typ, price, volume) in self.orders.values():
+            if typ == "bid" and currency == self.curr_quote:
+                available -= price * volume
+            if typ == "ask" and currency == self.curr_base:
+                available -= volume
+        return available
+
+    def _order_answer(self, oid):
+        """an order the way the http api describes it"""
+        (typ, price, volume) = self.orders[oid]
+        return {
+            "id": oid,
+            "symbol": ("%s%s" % (self.curr_base, self.curr_quote)).lower(),
+            "price": "%f" % price,
+            "original_amount": "%f" % volume,
+            "remaining_amount": "%f" % volume,
+            "side": {"bid": "buy", "ask": "sell"}[typ],
+        }
+
+    def _api_order_new(self, params):
+        """place a limit order if the balance is sufficient"""
+        typ = {"buy": "bid", "sell": "ask"}[params["side"]]
+        price = float(params["price"])
+        volume = float(params["amount"])
+        if typ == "bid" and price * volume > self._available(self.curr_quote) \
+        or typ == "ask" and volume > self._available(self.curr_base):
+            return {"message": "Invalid order: not enough exchange balance"}
+        oid = self._next_oid
+        self._next_oid += 1
+        self.orders[oid] = (typ, price, volume)
+        self.count_orders += 1
+        return self._order_answer(oid)
+
+    def _api_order_new_multi(self, params):
+        """place several orders"""
+        return {"order_ids": [self._api_order_new(order)
+            for order in params["orders"]]}
+
+    def _api_order_cancel(self, params):
+        """cancel an open order"""
+        oid = int(params["order_id"])
+        if oid not in self.orders:
+            return {"message": "Order could not be cancelled."}
+        answer = self._order_answer(oid)
+        del self.orders[oid]
+        self.count_cancels += 1
+        return answer
+
+    def _api_order_cancel_multi(self, params):
+        """cancel several orders"""
+        for oid in params["order_ids"]:
+            self._api_order_cancel({"order_id": oid})
+        return {"result": "Orders cancelled"}
+
+    def _api_order_cancel_all(self, _params):
+        """cancel all orders"""
+        return self._api_order_cancel_multi({"order_ids": self.orders.keys()})
+
+    def _api_order_cancel_replace(self, params):
+        """cancel an order and place a new one"""
+        answer = self._api_order_cancel(params)
+        if "message" in answer:
+            return answer
+        return self._api_order_new(params)
+
+    def _api_balances(self, _params):
+        """the exchange wallet"""
+        return [{
+            "type": "exchange",
+            "currency": currency.lower(),
+            "amount": "%f" % amount,
+            "available": "%f" % self._available(currency)
+        } for (currency, amount) in self.balance.items()]
+
+    def _api_account_infos(self, _params):
+        """the fees"""
+        return [{"maker_fees": "%f" % (self.fee * 100),
+            "taker_fees": "%f" % (self.fee * 100)}]
+
+    def _api_orders(self, _params):
+        """the open orders"""
+        return [self._order_answer(oid) for oid in sorted(self.orders)]
+
+    def _match(self, price):
+        """a trade at price happened, fill the orders it has reached"""
+        self.last_price = price
+        for oid in sorted(self.orders):
+            (typ, order_price, volume) = self.orders[oid]
+            if typ == "bid" and price <= order_price \
+            or typ == "ask" and price >= order_price:
+                self._fill(oid)
+
+    def _fill(self, oid):
+        """execute the order completely at its price"""
+        (typ, price, volume) = self.orders.pop(oid)
+        cost = price * volume
+        fee = cost * self.fee
+        if typ == "bid":
+            self.balance[self.curr_base] += volume
+            self.balance[self.curr_quote] -= cost + fee
+            self.volume_bought += volume
+        else:
+            self.balance[self.curr_base] -= volume
+            self.balance[self.curr_quote] += cost - fee
+            self.volume_sold += volume
+        self.fees_paid += fee
+        self.count_fills += 1
+        amount = {"bid": volume, "ask": -volume}[typ]
+        pair = "%s%s" % (self.curr_base, self.curr_quote)
+        self._answers.append([0, "oc", [oid, pair, 0, amount, "EXCHANGE LIMIT",
+            "EXECUTED @ %f(%f)" % (price, amount), price, price, "", None, None]])
+        for currency in (self.curr_base, self.curr_quote):
+            self._answers.append([0, "wu",
+                ["exchange", currency, self.balance[currency], 0]])
+
+    def stats(self):
+        """the result of the backtest. pnl is the value of the balances
+        now minus the value of the starting balances, both at the last
+        price, so it is what trading has gained compared to holding."""
+        def value(balance):
+            """value of the balance in the quote currency"""
+            return balance[self.curr_quote] + balance[self.curr_base] * self.last_price
+        return {
+            "orders": self.count_orders,
+            "cancels": self.count_cancels,
+            "fills": self.count_fills,
+            "bought": self.volume_bought,
+            "sold": self.volume_sold,
+            "fees": self.fees_paid,
+            "base": self.balance[self.curr_base],
+            "quote": self.balance[self.curr_quote],
+            "pnl": value(self.balance) - value(self.start_balance),
+        }
+
+
+class Replay(bfxapi.BaseObject):
+    """drives a Bfx instance from a journal. It has no secret, there are
+    no sockets and the candle store is not used, config (a ReplayConfig)
+    is changed for that. With speed None it runs as fast as possible,
+    otherwise at speed times the recorded speed.
+
+    The time is simulated, it is the receive time of the record that is
+    being replayed. The SimulatedClock is installed as bfxapi.CLOCK, so
+    everything created after the Replay (strategies too) uses it, until
+    run() has finished or close() is called, then the previous clock is
+    put back. It can be used in a with statement to make sure of that."""
+
+    def __init__(self, filename, config, speed=None, client_class=ReplayClient):
+        bfxapi.BaseObject.__init__(self)
+        config.set("bfx", "history_store", "False")
+        self.reader = JournalReader(filename)
+        self.speed = speed
+        time_range = self.reader.time_range()
+        self.clock = bfxapi.SimulatedClock(time_range[0] if time_range else 0)
+        self._previous_clock = bfxapi.CLOCK
+        bfxapi.CLOCK = self.clock
+        self.count = 0
+        self.bfx = bfxapi.Bfx(bfxapi.Secret(config), config, client_class)
+        self.bfx.signal_debug.connect(self.signal_debug)
+
+    def run(self, since=None, until=None):
+        """replay the journal (or the part since <= time < until) and
+        return the number of records that have been replayed"""
+        client = self.bfx.client
+        real_start = None
+        first = 0
+        bfxapi.CLOCK = self.clock
+        try:
+            self.bfx.start()
+            for (tim, kind, data) in self.reader.records(since, until):
+                if self.speed:
+                    if real_start is None:
+                        (real_start, first) = (time.time(), tim)
+                    delay = real_start + (tim - first) / self.speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.clock.advance_to(tim)
+                client.replay(kind, data)
+                self.count += 1
+            self.bfx.stop()
+        finally:
+            self.close()
+        return self.count
+
+    def close(self):
+        """put back the clock that was bfxapi.CLOCK before the Replay"""
+        if bfxapi.CLOCK is self.clock:
+            bfxapi.CLOCK = self._previous_clock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python2
+
+"""
+replay a journal recorded with bfxtool.py --record and run strategies
+over it, without opening any connections
+"""
+
+# pylint: disable=C0301
+
+import argparse
+import time
+
+import journal
+from bfxtool import StrategyManager
+
+
+def main():
+    """main funtion, called at the start of the program"""
+    argp = argparse.ArgumentParser(description='replay recorded market data into bfxapi and strategies')
+    argp.add_argument('journal',
+        help="journal file that has been recorded with bfxtool.py --record")
+    argp.add_argument('--strategy', action="store", default="strategy.py",
+        help="name of strategy module files, comma separated list, default=strategy.py")
+    argp.add_argument('--speed', action="store", type=float, default=None,
+        help="replay at this multiple of the recorded speed, default is as fast as possible")
+    argp.add_argument('--ini', action="store", default="bfxtool.ini",
+        help="ini file for pair and timeframe, it will not be changed, default=bfxtool.ini")
+    argp.add_argument('--verbose', action="store_true", default=False,
+        help="print all debug messages")
+    args = argp.parse_args()
+
+    def slot_debug(sender, msg):
+        """print the debug output"""
+        print "%s: %s" % (sender.__class__.__name__, msg)
+
+    with journal.Replay(args.journal, journal.ReplayConfig(args.ini), args.speed) as replay:
+        if args.verbose:
+            replay.signal_debug.connect(slot_debug)
+        strategy_manager = StrategyManager(replay.bfx, args.strategy.split(","))
+
+        started = time.time()
+        count = replay.run()
+        elapsed = time.time() - started
+        strategy_manager.unload()
+
+    time_range = replay.reader.time_range() or (0, 0)
+    print "%d records, %.0f seconds of market data replayed in %.2f seconds (%.0f records/s)" % (
+        count, time_range[1] - time_range[0], elapsed, count / max(elapsed, 1e-9))
+    print "%d candles, last close %s" % (replay.bfx.history.length(),
+        replay.bfx.history.last_candle() and replay.bfx.history.last_candle().cls)
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,12 @@ To create your own strategy just
 2. fill the slots of strategy with your logic (usually slot_trade or slot_history_changed)
 3. launch the strategy bfxtool with your strategy:
     ./bfxtool.py --strategy <your_strategy_file.py>
+
+Use bfxapi.CLOCK.time() instead of time.time() and bfxapi.Timer for timers,
+then the strategy will also run unchanged (and much faster than real time)
+over recorded market data in replay.py. The slots of a bfxapi.Timer
+won't run concurrently with the slots connected to the bfx signals
+unless the timer is given a lock of its own.
 """
 
 import bfxapi
@@ -21,14 +21,23 @@ Copyright (C) 2010 Hiroki Ohtani(liris)
 
 
 import socket
+import ssl
+import time
 from urlparse import urlparse
 import os
 import array
+import binascii
 import struct
 import uuid
 import hashlib
 import base64
 import logging
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 """
 websocket python client.
@@ -73,6 +82,14 @@ class WebSocketConnectionClosedException(WebSocketException):
     """
     pass
 
+
+class WebSocketMessageTooBigException(WebSocketException):
+    """
+    If a (fragmented) message is bigger than the maximum message size
+    of the WebSocket, this exception will be raised.
+    """
+    pass
+
 default_timeout = None
 traceEnabled = False
 
@@ -195,15 +212,41 @@ _HEADERS_TO_CHECK = {
     }
 
 
-class _SSLSocketWrapper(object):
-    def __init__(self, sock):
-        self.ssl = socket.ssl(sock)
+_ssl_context = None
+
 
-    def recv(self, bufsize):
-        return self.ssl.read(bufsize)
+def _get_ssl_context():
+    """
+    Return the SSLContext that is shared by all connections. It verifies
+    the server certificate and host name, it is created only once because
+    loading the system certificates is expensive.
+    """
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
 
-    def send(self, payload):
-        return self.ssl.write(payload)
+
+def _wrap_ssl(sock, hostname, context = None):
+    """
+    do the TLS handshake on the connected socket sock with SNI and
+    return tuple of the ssl socket and the handshake time in seconds.
+    """
+    context = context or _get_ssl_context()
+    ssl_sock = context.wrap_socket(sock, server_hostname = hostname,
+                                   do_handshake_on_connect = False)
+    time_start = time.time()
+    ssl_sock.do_handshake()
+    return ssl_sock, time.time() - time_start
+
+# size of the WebSocket receive buffer, frames larger than this
+# will make the buffer grow to hold them.
+RECV_BUFFER_SIZE = 65536
+
+# fragmented messages are reassembled into a buffer of this initial size,
+# it grows up to the maximum message size of the WebSocket if needed.
+FRAGMENT_BUFFER_SIZE = 65536
+DEFAULT_MAX_MESSAGE_SIZE = 1 << 25
 
 _BOOL_VALUES = (0, 1)
 
@@ -224,6 +267,7 @@ class ABNF(object):
     """
 
     # operation code values.
+    OPCODE_CONT   = 0x0
     OPCODE_TEXT   = 0x1
     OPCODE_BINARY = 0x2
     OPCODE_CLOSE  = 0x8
@@ -231,11 +275,12 @@ class ABNF(object):
     OPCODE_PONG   = 0xa
 
     # available operation code value tuple
-    OPCODES = (OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE,
+    OPCODES = (OPCODE_CONT, OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE,
                 OPCODE_PING, OPCODE_PONG)
 
     # opcode human readable string
     OPCODE_MAP = {
+        OPCODE_CONT: "cont",
         OPCODE_TEXT: "text",
         OPCODE_BINARY: "binary",
         OPCODE_CLOSE: "close",
@@ -322,11 +367,92 @@ class ABNF(object):
 
         data: data to mask/unmask.
         """
-        _m = array.array("B", mask_key)
-        _d = array.array("B", data)
-        for i in xrange(len(_d)):
-            _d[i] ^= _m[i % 4]
-        return _d.tostring()
+        return _mask_engine(mask_key, data)
+
+
+def mask_python(mask_key, data):
+    """
+    mask or unmask data one byte at a time. This is the reference
+    implementation, all other masking engines must return the same bytes.
+
+    mask_key: 4 byte string(byte).
+
+    data: data to mask/unmask.
+    """
+    _m = array.array("B", mask_key)
+    _d = array.array("B", data)
+    for i in xrange(len(_d)):
+        _d[i] ^= _m[i % 4]
+    return _d.tostring()
+
+
+def mask_words(mask_key, data):
+    """
+    mask or unmask data as one big integer. The payload and the repeated
+    mask key are converted to longs and xored in a single operation, so
+    the work is done on whole machine words in C instead of per byte in
+    the interpreter.
+
+    mask_key: 4 byte string(byte).
+
+    data: data to mask/unmask.
+    """
+    length = len(data)
+    if not length:
+        return ""
+    key = (mask_key * (length // 4 + 1))[:length]
+    masked = long(binascii.hexlify(data), 16) ^ long(binascii.hexlify(key), 16)
+    return binascii.unhexlify("%0*x" % (length * 2, masked))
+
+
+def mask_numpy(mask_key, data):
+    """
+    mask or unmask data with numpy, 4 bytes at a time as uint32 words.
+    Only available if numpy is installed.
+
+    mask_key: 4 byte string(byte).
+
+    data: data to mask/unmask.
+    """
+    length = len(data)
+    words = length // 4
+    _d = numpy.frombuffer(data, dtype=numpy.uint32, count=words)
+    _m = numpy.frombuffer(mask_key, dtype=numpy.uint32)[0]
+    head = (_d ^ _m).tostring()
+    tail = data[words * 4:]
+    if tail:
+        tail = mask_python(mask_key[:len(tail)], tail)
+    return head + tail
+
+
+# payloads shorter than this are masked with the pure python loop, the
+# setup cost of the other engines is higher than the loop itself there.
+MASK_SMALL_PAYLOAD = 8
+
+
+def _mask_auto(mask_key, data):
+    """
+    mask or unmask data with the fastest engine available.
+    """
+    if len(data) < MASK_SMALL_PAYLOAD:
+        return mask_python(mask_key, data)
+    if numpy is not None:
+        return mask_numpy(mask_key, data)
+    return mask_words(mask_key, data)
+
+_mask_engine = _mask_auto
+
+
+def set_mask_engine(func):
+    """
+    Set the function used by ABNF.mask to mask and unmask payloads.
+    Mainly, this is for testing and benchmarking purpose.
+
+    func: callable object with the same signature as mask_python().
+          if you set None, the fastest available engine is used.
+    """
+    global _mask_engine
+    _mask_engine = func or _mask_auto
 
 
 class WebSocket(object):
@@ -349,15 +475,27 @@ class WebSocket(object):
 
     get_mask_key: a callable to produce new mask keys, see the set_mask_key
       function's docstring for more details
+
+    max_message_size: maximum size of a (reassembled) message in bytes,
+      see the set_max_message_size function's docstring for more details
     """
 
-    def __init__(self, get_mask_key = None):
+    def __init__(self, get_mask_key = None, max_message_size = None):
         """
         Initalize WebSocket object.
         """
         self.connected = False
         self.io_sock = self.sock = socket.socket()
         self.get_mask_key = get_mask_key
+        self.max_message_size = max_message_size or DEFAULT_MAX_MESSAGE_SIZE
+        self._reset_buffer()
+        self._frag_buf = bytearray(FRAGMENT_BUFFER_SIZE)
+        self._frag_len = 0
+        self._frag_opcode = None
+        self._frag_compressed = False
+        self._inflater = None
+        self._inflater_takeover = True
+        self.tls_handshake_time = None
 
     def set_mask_key(self, func):
         """
@@ -371,6 +509,17 @@ class WebSocket(object):
         """
         self.get_mask_key = func
 
+    def set_max_message_size(self, size):
+        """
+        set the maximum size of a message. Fragmented messages will be
+        reassembled up to this size, if a message gets bigger the connection
+        is closed with STATUS_MESSAGE_TOO_BIG and
+        WebSocketMessageTooBigException is raised.
+
+        size: size in bytes.
+        """
+        self.max_message_size = size
+
     def settimeout(self, timeout):
         """
         Set the timeout to the websocket.
@@ -400,16 +549,24 @@ class WebSocket(object):
                  if you set None for this value,
                  it means "use default_timeout value"
 
-        options: current support option is only "header".
+        options: "header", "origin" and "deflate".
                  if you set header as dict value,
                  the custom HTTP headers are added.
+                 if you set deflate to True, the permessage-deflate
+                 extension (RFC 7692) is offered to the server. Received
+                 messages are then decompressed with one zlib stream per
+                 connection, sent messages are never compressed.
+                 if you set ssl_context, it is used for wss:// instead of
+                 the default context that verifies the server certificate.
 
         """
         hostname, port, resource, is_secure = _parse_url(url)
         # TODO: we need to support proxy
+        self._reset_buffer()
         self.sock.connect((hostname, port))
         if is_secure:
-            self.io_sock = _SSLSocketWrapper(self.sock)
+            self.io_sock, self.tls_handshake_time = \
+                _wrap_ssl(self.sock, hostname, options.get("ssl_context"))
         self._handshake(hostname, port, resource, **options)
 
     def _handshake(self, host, port, resource, **options):
@@ -432,6 +589,9 @@ class WebSocket(object):
         key = _create_sec_websocket_key()
         headers.append("Sec-WebSocket-Key: %s" % key)
         headers.append("Sec-WebSocket-Version: %s" % VERSION)
+        if options.get("deflate"):
+            headers.append("Sec-WebSocket-Extensions: permessage-deflate; "
+                           "client_max_window_bits")
         if "header" in options:
             headers.extend(options["header"])
 
@@ -455,8 +615,48 @@ class WebSocket(object):
             self.close()
             raise WebSocketException("Invalid WebSocket Header")
 
+        extensions = resp_headers.get("sec-websocket-extensions", None)
+        if extensions:
+            if not options.get("deflate"):
+                self.close()
+                raise WebSocketException("Unexpected WebSocket Extension")
+            self._init_deflate(extensions)
+        else:
+            self._inflater = None
+
         self.connected = True
 
+    def _init_deflate(self, extensions):
+        """
+        set up decompression for the permessage-deflate extension the server
+        has agreed to. Unless the server disables context takeover all
+        messages of this connection are decompressed with the same zlib
+        stream, this is what makes the compression of the many small and
+        similar market data messages efficient.
+        """
+        params = [param.strip() for param in extensions.split(";")]
+        if params[0] != "permessage-deflate":
+            self.close()
+            raise WebSocketException("Unsupported WebSocket Extension %s" % params[0])
+        self._inflater_takeover = "server_no_context_takeover" not in params
+        # a raw deflate stream with the maximum window size can also
+        # decode all streams that use a smaller server_max_window_bits
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def _inflate(self, data):
+        """
+        decompress the payload of a compressed message.
+        """
+        # the server strips the empty final block of every message,
+        # it must be appended again before it can be decompressed.
+        data = self._inflater.decompress(data + "\x00\x00\xff\xff",
+                                         self.max_message_size)
+        if self._inflater.unconsumed_tail:
+            self._message_too_big()
+        if not self._inflater_takeover:
+            self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        return data
+
     def _validate_header(self, headers, key):
         for k, v in _HEADERS_TO_CHECK.iteritems():
             r = headers.get(k, None)
@@ -559,13 +759,116 @@ class WebSocket(object):
                 # handle error:
                 # 'NoneType' object has no attribute 'opcode'
                 raise WebSocketException("Not a valid frame %s" % frame)
-            elif frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+            result = self._process_frame(frame)
+            if result:
+                return result
+
+    def recv_data_nowait(self):
+        """
+        Recieve data with operation code, but only from what has already
+        been read into the receive buffer, this never touches the socket.
+        Use it together with recv_available() in an event loop.
+
+        return  value: tuple of operation code and string(byte array) value
+                       or None if no complete message is buffered.
+        """
+        while self._frame_buffered():
+            result = self._process_frame(self.recv_frame())
+            if result:
+                return result
+        return None
+
+    def recv_available(self):
+        """
+        read what the socket has available into the receive buffer. This
+        must only be called when the socket is readable, it does one read
+        plus as many more as needed to drain the data already decrypted by
+        the TLS layer (select() would not report that as readable).
+        """
+        self._make_room()
+        self._recv()
+        pending = getattr(self.io_sock, "pending", None)
+        while pending and pending():
+            self._make_room()
+            self._recv()
+
+    def fileno(self):
+        """
+        Return the file descriptor of the underlying socket.
+        """
+        return self.sock.fileno()
+
+    def _process_frame(self, frame):
+        """
+        handle one received frame. return a tuple of operation code and
+        string(byte array) value if it completed a message, otherwise None.
+        """
+        if frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+            if self._frag_opcode is not None:
+                raise WebSocketException("Expected continuation frame")
+            compressed = frame.rsv1 and self._inflater is not None
+            if frame.fin:
+                if compressed:
+                    return (frame.opcode, self._inflate(frame.data))
                 return (frame.opcode, frame.data)
-            elif frame.opcode == ABNF.OPCODE_CLOSE:
-                self.send_close()
-                return (frame.opcode, None)
-            elif frame.opcode == ABNF.OPCODE_PING:
-                self.pong(frame.data)
+            self._frag_opcode = frame.opcode
+            self._frag_compressed = compressed
+            self._append_fragment(frame.data)
+        elif frame.opcode == ABNF.OPCODE_CONT:
+            if self._frag_opcode is None:
+                raise WebSocketException("Unexpected continuation frame")
+            self._append_fragment(frame.data)
+            if frame.fin:
+                opcode, data = self._pop_message()
+                if self._frag_compressed:
+                    data = self._inflate(data)
+                return (opcode, data)
+        elif frame.opcode == ABNF.OPCODE_CLOSE:
+            self.send_close()
+            return (frame.opcode, None)
+        elif frame.opcode == ABNF.OPCODE_PING:
+            self.pong(frame.data)
+        return None
+
+    def _append_fragment(self, data):
+        """
+        append the payload of a fragment to the reassembly buffer. The
+        buffer is reused for all messages and grows by doubling, so a message
+        made of many fragments is copied only once into it.
+        """
+        end = self._frag_len + len(data)
+        if end > self.max_message_size:
+            self._frag_len = 0
+            self._frag_opcode = None
+            self._message_too_big()
+        if end > len(self._frag_buf):
+            size = min(max(end, len(self._frag_buf) * 2), self.max_message_size)
+            frag_buf = bytearray(size)
+            frag_buf[:self._frag_len] = self._frag_buf[:self._frag_len]
+            self._frag_buf = frag_buf
+        self._frag_buf[self._frag_len:end] = data
+        self._frag_len = end
+
+    def _message_too_big(self):
+        """
+        close the connection and raise WebSocketMessageTooBigException.
+        It does not wait for the close frame of the server, it is only
+        sent if that does not block.
+        """
+        self.close(STATUS_MESSAGE_TOO_BIG, timeout = 0)
+        raise WebSocketMessageTooBigException(
+            "Message is bigger than %d bytes" % self.max_message_size)
+
+    def _pop_message(self):
+        """
+        return the reassembled message as tuple of operation code and
+        string(byte array) value and reset the reassembly buffer.
+        """
+        data = memoryview(self._frag_buf)[:self._frag_len].tobytes()
+        opcode = self._frag_opcode
+        self._frag_len = 0
+        self._frag_opcode = None
+        return (opcode, data)
 
     def recv_frame(self):
         """
@@ -573,34 +876,52 @@ class WebSocket(object):
 
         return value: ABNF frame object.
         """
-        header_bytes = self._recv_strict(2)
-        if not header_bytes:
-            return None
-        b1 = ord(header_bytes[0])
+        # the whole header (up to 14 bytes) is parsed straight out of the
+        # receive buffer, usually the payload is already in there too, so
+        # most frames don't need a single syscall of their own.
+        self._fill(2)
+        pos = self._rbuf_start
+        b1 = self._rbuf[pos]
         fin = b1 >> 7 & 1
         rsv1 = b1 >> 6 & 1
         rsv2 = b1 >> 5 & 1
         rsv3 = b1 >> 4 & 1
         opcode = b1 & 0xf
-        b2 = ord(header_bytes[1])
+        b2 = self._rbuf[pos + 1]
         mask = b2 >> 7 & 1
         length = b2 & 0x7f
 
-        length_data = ""
+        header_length = 2
+        if length == 0x7e:
+            header_length += 2
+        elif length == 0x7f:
+            header_length += 8
+        if mask:
+            header_length += 4
+        self._fill(header_length)
+        pos = self._rbuf_start
+
         if length == 0x7e:
-            length_data = self._recv_strict(2)
-            length = struct.unpack("!H", length_data)[0]
+            length = struct.unpack_from("!H", self._rbuf, pos + 2)[0]
         elif length == 0x7f:
-            length_data = self._recv_strict(8)
-            length = struct.unpack("!Q", length_data)[0]
+            length = struct.unpack_from("!Q", self._rbuf, pos + 2)[0]
+        # check it before the payload is buffered, a single frame can
+        # announce a payload of up to 2**63 bytes
+        if length > self.max_message_size:
+            self._message_too_big()
 
         mask_key = ""
         if mask:
-            mask_key = self._recv_strict(4)
-        data = self._recv_strict(length)
+            mask_pos = pos + header_length - 4
+            mask_key = str(self._rbuf[mask_pos:mask_pos + 4])
+
+        self._fill(header_length + length)
+        pos = self._rbuf_start
         if traceEnabled:
-            recieved = header_bytes + length_data + mask_key + data
+            recieved = str(self._rbuf[pos:pos + header_length + length])
             logger.debug("recv: " + repr(recieved))
+        self._rbuf_start += header_length
+        data = self._recv_strict(length)
 
         if mask:
             data = ABNF.mask(mask_key, data)
@@ -620,62 +941,141 @@ class WebSocket(object):
             raise ValueError("code is invalid range")
         self.send(struct.pack('!H', status) + reason, ABNF.OPCODE_CLOSE)
 
-    def close(self, status = STATUS_NORMAL, reason = ""):
+    def close(self, status = STATUS_NORMAL, reason = "", timeout = 3):
         """
         Close Websocket object
 
         status: status code to send. see STATUS_XXX.
 
         reason: the reason to close. This must be string.
+
+        timeout: seconds to wait for the close frame of the server. If it
+        is 0 the close frame is only sent if that does not block and the
+        socket is closed without waiting for the answer.
         """
         if self.connected:
             if status < 0 or status >= ABNF.LENGTH_16:
                 raise ValueError("code is invalid range")
 
             try:
+                if not timeout:
+                    self.sock.settimeout(0)
                 self.send(struct.pack('!H', status) + reason, ABNF.OPCODE_CLOSE)
-                timeout = self.sock.gettimeout()
-                self.sock.settimeout(3)
-                try:
-                    frame = self.recv_frame()
-                    if logger.isEnabledFor(logging.DEBUG):
-                        logger.error("close status: " + repr(frame.data))
-                except:
-                    pass
-                self.sock.settimeout(timeout)
+                if timeout:
+                    old_timeout = self.sock.gettimeout()
+                    self.sock.settimeout(timeout)
+                    try:
+                        frame = self.recv_frame()
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.error("close status: " + repr(frame.data))
+                    except:
+                        pass
+                    self.sock.settimeout(old_timeout)
                 self.sock.shutdown(socket.SHUT_RDWR)
             except:
                 pass
         self._closeInternal()
 
     def _closeInternal(self):
+        if self.io_sock is not self.sock:
+            self.io_sock.close()
         self.connected = False
+        self._frag_len = 0
+        self._frag_opcode = None
         self.sock.close()
         self.io_sock = self.sock
 
-    def _recv(self, bufsize):
-        bytes = self.io_sock.recv(bufsize)
-        if not bytes:
+    def _reset_buffer(self):
+        self._rbuf = bytearray(RECV_BUFFER_SIZE)
+        self._rbuf_start = 0
+        self._rbuf_end = 0
+
+    def _recv(self):
+        """
+        read as much as fits into the free end of the receive buffer with
+        one single syscall. return the number of bytes read.
+        """
+        view = memoryview(self._rbuf)[self._rbuf_end:]
+        count = self.io_sock.recv_into(view)
+        if not count:
             raise WebSocketConnectionClosedException()
-        return bytes
+        self._rbuf_end += count
+        return count
 
-    def _recv_strict(self, bufsize):
-        remaining = bufsize
-        bytes = ""
-        while remaining:
-            bytes += self._recv(remaining)
-            remaining = bufsize - len(bytes)
+    def _make_room(self):
+        """
+        make sure there is free space at the end of the receive buffer.
+        """
+        if self._rbuf_end == len(self._rbuf):
+            self._fill(self._rbuf_end - self._rbuf_start + 1, False)
+
+    def _frame_buffered(self):
+        """
+        return True if a complete frame is in the receive buffer.
+        """
+        pos = self._rbuf_start
+        available = self._rbuf_end - pos
+        if available < 2:
+            return False
+        b2 = self._rbuf[pos + 1]
+        length = b2 & 0x7f
+        header_length = 2
+        if length == 0x7e:
+            header_length += 2
+        elif length == 0x7f:
+            header_length += 8
+        if b2 >> 7 & 1:
+            header_length += 4
+        if available < header_length:
+            return False
+        if length == 0x7e:
+            length = struct.unpack_from("!H", self._rbuf, pos + 2)[0]
+        elif length == 0x7f:
+            length = struct.unpack_from("!Q", self._rbuf, pos + 2)[0]
+        if length > self.max_message_size:
+            # recv_frame() will raise, don't grow the buffer for it
+            return True
+        return available >= header_length + length
 
-        return bytes
+    def _fill(self, bufsize, read = True):
+        """
+        make sure there are at least bufsize unread bytes in the receive
+        buffer, move the unread bytes to the front or grow the buffer if
+        there is not enough room left at its end. If read is False only
+        make room for them but don't read from the socket.
+        """
+        available = self._rbuf_end - self._rbuf_start
+        if available >= bufsize:
+            return
+        if self._rbuf_start + bufsize > len(self._rbuf):
+            if bufsize > len(self._rbuf):
+                rbuf = bytearray(max(bufsize, len(self._rbuf) * 2))
+            else:
+                rbuf = self._rbuf
+            rbuf[:available] = self._rbuf[self._rbuf_start:self._rbuf_end]
+            self._rbuf = rbuf
+            self._rbuf_start = 0
+            self._rbuf_end = available
+        while read and self._rbuf_end - self._rbuf_start < bufsize:
+            self._recv()
+
+    def _recv_strict(self, bufsize):
+        self._fill(bufsize)
+        start = self._rbuf_start
+        self._rbuf_start += bufsize
+        if self._rbuf_start == self._rbuf_end:
+            self._rbuf_start = self._rbuf_end = 0
+        return memoryview(self._rbuf)[start:start + bufsize].tobytes()
 
     def _recv_line(self):
-        line = []
+        scanned = 0
         while True:
-            c = self._recv(1)
-            line.append(c)
-            if c == "\n":
-                break
-        return "".join(line)
+            start = self._rbuf_start
+            index = self._rbuf.find("\n", start + scanned, self._rbuf_end)
+            if index >= 0:
+                return self._recv_strict(index + 1 - start)
+            scanned = self._rbuf_end - start
+            self._fill(scanned + 1)
 
 
 class WebSocketApp(object):